@@ -1,25 +1,44 @@
 import arrow
-import collections
+import contextlib
+import glob
+import hashlib
 import itertools
 import json
 import logging
+import math
 import os
 import PIL.Image
 import re
+import shutil
 import sqlalchemy
 import sqlalchemy.ext.associationproxy
 import tempfile
+import time
 
 from . import celery
 from . import db
 from . import ffmpeg
 from . import metadata
+from . import pack
+from . import pillow
+from . import similarity
 from .hashes import Hash
 from .tags import Tag
 
 
 _DEFAULT_EXTENSIONS = dict(audio='mp3', photo='jpg', video='mp4')
 
+# Suffix for files marking that an export has been queued but not written.
+PENDING_SUFFIX = '.pending'
+
+# Directory under the thumbnails root for low-resolution proxies of videos.
+# It's hidden so that removing an asset's exports leaves the proxy in place.
+PROXY_DIR = '.proxy'
+
+# Directory under the thumbnails root for rendered exports, named by the hash
+# of everything that goes into a render. See :func:`render_key`.
+RENDER_DIR = '.renders'
+
 
 asset_tags = db.Table(
     'asset_tags', db.Model.metadata,
@@ -28,13 +47,427 @@ asset_tags = db.Table(
     db.PrimaryKeyConstraint('asset_id', 'tag_id'))
 
 
-class Asset(db.Model):
+# Number of assets with each tag, kept current by triggers on asset_tags so
+# that library-wide tag counts don't need to group the whole association table.
+tag_counts = sqlalchemy.table(
+    'tag_counts',
+    sqlalchemy.column('tag_id'),
+    sqlalchemy.column('count'))
+
+db.auxiliary(
+    asset_tags,
+    create=[
+        '''CREATE TABLE IF NOT EXISTS tag_counts (
+               tag_id INTEGER PRIMARY KEY REFERENCES tags (id) ON DELETE CASCADE,
+               count INTEGER NOT NULL)''',
+        '''CREATE TRIGGER IF NOT EXISTS tag_counts_insert
+           AFTER INSERT ON asset_tags BEGIN
+               INSERT INTO tag_counts (tag_id, count) VALUES (new.tag_id, 1)
+               ON CONFLICT (tag_id) DO UPDATE SET count = count + 1;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS tag_counts_delete
+           AFTER DELETE ON asset_tags BEGIN
+               UPDATE tag_counts SET count = count - 1 WHERE tag_id = old.tag_id;
+               DELETE FROM tag_counts WHERE tag_id = old.tag_id AND count <= 0;
+           END''',
+    ],
+    rebuild=[
+        'DELETE FROM tag_counts',
+        '''INSERT INTO tag_counts (tag_id, count)
+           SELECT tag_id, COUNT(*) FROM asset_tags GROUP BY tag_id''',
+    ],
+    drop=['DROP TABLE IF EXISTS tag_counts'])
+
+
+# MinHash LSH buckets for each asset's tag set, used to find candidates for
+# tag similarity without scoring every asset that shares a common tag. These
+# can't be computed in SQL, so they're written when sessions flush tag changes.
+db.auxiliary(
+    asset_tags,
+    create=[
+        '''CREATE TABLE IF NOT EXISTS tag_lsh (
+               asset_id INTEGER NOT NULL REFERENCES assets (id) ON DELETE CASCADE,
+               band INTEGER NOT NULL,
+               bucket INTEGER NOT NULL,
+               PRIMARY KEY (asset_id, band))''',
+        '''CREATE INDEX IF NOT EXISTS tag_lsh_bucket ON tag_lsh (band, bucket)''',
+        # Tag rows deleted in SQL cascade to asset_tags without passing
+        # through the session, so drop the buckets of the assets involved.
+        # Sessions write new buckets for their own changes after this fires.
+        '''CREATE TRIGGER IF NOT EXISTS tag_lsh_delete
+           AFTER DELETE ON asset_tags BEGIN
+               DELETE FROM tag_lsh WHERE asset_id = old.asset_id;
+           END''',
+    ],
+    rebuild=[similarity.rebuild_buckets],
+    drop=['DROP TABLE IF EXISTS tag_lsh'])
+
+
+# Asset fields that identify its source media; see :attr:`_AssetMixin.fingerprint`.
+FINGERPRINT = ('slug', 'file_size', 'file_mtime', 'width', 'height', 'orientation',
+               'duration')
+
+
+def render_key(source, filters, kwargs):
+    '''Get a key identifying the content of a rendered export.
+
+    Parameters
+    ----------
+    source : list
+        Fingerprint of the source media; see :attr:`_AssetMixin.fingerprint`.
+    filters : str
+        JSON-encoded list of filters applied to the source.
+    kwargs : dict
+        Formatting arguments for the export (bounding box, extension, etc.).
+
+    Returns
+    -------
+    A hex digest, which is the same for any two identical renders.
+    '''
+    blob = json.dumps([source, json.loads(filters or '[]'), kwargs], sort_keys=True)
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()[:20]
+
+
+def render_version(source, filters, formats):
+    '''Get a short version string for all the renders of an asset.
+
+    Renders depend only on the source media, the filters and the export
+    formats, so this identifies the content of an asset's exports, e.g. for
+    versioned URLs.
+
+    Parameters
+    ----------
+    source : list
+        Fingerprint of the source media; see :attr:`_AssetMixin.fingerprint`.
+    filters : str
+        JSON-encoded list of filters applied to the source.
+    formats : dict
+        Export formats for the asset's medium, as in the "formats" config.
+    '''
+    return render_key(source, filters, formats)[:12]
+
+
+def collect_renders(root, keep, min_age=7 * 86400):
+    '''Remove renders that are no longer used from a thumbnails root.
+
+    Parameters
+    ----------
+    root : str
+        Root directory for thumbnails.
+    keep : set of str
+        Keys of renders that are in use; see :func:`render_key`.
+    min_age : float, optional
+        Keep unused renders modified less than this many seconds ago, so
+        that undoing a recent edit can still reuse them. Defaults to a week.
+
+    Returns
+    -------
+    The number of renders removed. Packed renders are only dropped from the
+    index; compacting the store reclaims their space.
+    '''
+    store = pack.store(root)
+    removed = store.collect(keep, min_age) if store else 0
+    cutoff = time.time() - min_age
+    for path in loose_renders(root):
+        key = os.path.basename(path).split('.')[0]
+        if key in keep or os.stat(path).st_mtime > cutoff:
+            continue
+        os.unlink(path)
+        removed += 1
+    return removed
+
+
+def collect_proxies(root, keep, min_age=86400):
+    '''Remove video proxies whose assets are gone from a thumbnails root.
+
+    Parameters
+    ----------
+    root : str
+        Root directory for thumbnails.
+    keep : set of str
+        Slugs of assets in the database.
+    min_age : float, optional
+        Keep proxies modified less than this many seconds ago, e.g. ones
+        made for assets that are still being imported. Defaults to a day.
+
+    Returns
+    -------
+    The number of proxies removed.
+    '''
+    removed, cutoff = 0, time.time() - min_age
+    for dirpath, _, filenames in os.walk(os.path.join(root, PROXY_DIR)):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.splitext(name)[0] in keep or os.stat(path).st_mtime > cutoff:
+                continue
+            os.unlink(path)
+            removed += 1
+    return removed
+
+
+def evict_renders(root, paths, budget, read_times):
+    '''Remove the least recently read renders until the rest fit a budget.
+
+    Evicted renders are rendered again the next time they're requested.
+
+    Parameters
+    ----------
+    root : str
+        Root directory for thumbnails.
+    paths : list of str
+        Paths of renders to consider, e.g. one format's renders of every
+        asset. Renders that don't exist are skipped.
+    budget : int
+        Number of bytes the renders may take up.
+    read_times : dict
+        Time that each render key was last read. Renders that haven't been
+        read since they were made count from their modification time.
+
+    Returns
+    -------
+    removed : int
+        Number of renders removed.
+    freed : int
+        Number of bytes freed.
+    '''
+    store = pack.store(root)
+    renders = []
+    for path in paths:
+        key = os.path.basename(path).split('.')[0]
+        files = [fn for fn in glob.glob(os.path.splitext(path)[0] + '.*')
+                 if not fn.endswith(PENDING_SUFFIX)]
+        # Size and mtime (in ns) of each of the render's files.
+        stats = [(st.st_size, st.st_mtime_ns) for st in map(os.stat, files)]
+        if store:
+            stats.extend(store.find(name)[2:] for name in store.names(key))
+        if stats:
+            when = read_times.get(key, max(mtime for _, mtime in stats) / 1e9)
+            renders.append((when, sum(size for size, _ in stats), key, files))
+    total = sum(size for _, size, _, _ in renders)
+    removed = freed = 0
+    for _, size, key, files in sorted(renders):
+        if total - freed <= budget:
+            break
+        for fn in files:
+            os.unlink(fn)
+        if store:
+            store.remove([key])
+        removed += 1
+        freed += size
+    return removed, freed
+
+
+def loose_renders(root):
+    '''Get the paths of finished render files under a thumbnails root.'''
+    for dirpath, dirnames, filenames in os.walk(os.path.join(root, RENDER_DIR)):
+        # Skip scratch directories of exports in progress.
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for name in filenames:
+            if not name.endswith(PENDING_SUFFIX):
+                yield os.path.join(dirpath, name)
+
+
+def link_render(render, output):
+    '''Link a render, and any poster image beside it, to another path.'''
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    stem = os.path.splitext(render)[0]
+    for source in glob.glob(f'{stem}.*'):
+        if source.endswith(PENDING_SUFFIX):
+            continue
+        target = os.path.splitext(output)[0] + os.path.splitext(source)[1]
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+
+
+class _AssetMixin:
+    '''Read-side helpers shared by :class:`Asset` and :class:`AssetRecord`.'''
+
+    __slots__ = ()
+
+    @property
+    def fingerprint(self):
+        '''Identify this asset's source media, for keying its renders.
+
+        Slugs are derived from paths, and the rest is read from the file when
+        it's imported. The file's size and modification time change when its
+        content is edited in place, so it gets new renders once it's
+        reimported, even if its dimensions stay the same.
+        '''
+        return [getattr(self, field) for field in FINGERPRINT]
+
+    def version(self, formats):
+        '''Get a version string for this asset's renders; see :func:`render_version`.
+
+        Parameters
+        ----------
+        formats : dict
+            Export formats for each medium, as in the "formats" config.
+        '''
+        return render_version(self.fingerprint, self.filters, formats.get(self.medium))
+
+    @property
+    def is_audio(self):
+        return self.medium == 'audio'
+
+    @property
+    def is_photo(self):
+        return self.medium == 'photo'
+
+    @property
+    def is_video(self):
+        return self.medium == 'video'
+
+    def to_dict(self):
+        return dict(
+            id=self.id,
+            slug=self.slug,
+            medium=self.medium,
+            path=self.path,
+            width=self.width,
+            height=self.height,
+            orientation=self.orientation,
+            duration=self.duration,
+            video_fps=self.video_fps,
+            audio_fps=self.audio_fps,
+            lat=self.lat,
+            lng=self.lng,
+            stamp=arrow.get(self.stamp).isoformat(),
+            caption=self.caption,
+            filters=json.loads(self.filters or '[]'),
+            hashes=[h.to_dict() for h in self.hashes],
+            tags=list(self.tags),
+        )
+
+    def path_for_export(self, root, name, ext):
+        '''Get the default path to use for exporting this asset.
+
+        Parameters
+        ----------
+        root : str
+            Root directory for the export.
+        name : str
+            Subdirectory name.
+        ext : str
+            Extension for the exported file.
+
+        Returns
+        -------
+        The full export file path for default exports.
+        '''
+        return os.path.join(root, name, self.slug[0], f'{self.slug}.{ext}')
+
+    def path_for_render(self, root, kwargs, ext=None, filters=None):
+        '''Get the path of a rendered export in a thumbnails root.
+
+        Parameters
+        ----------
+        root : str
+            Root directory for thumbnails.
+        kwargs : dict
+            Formatting arguments for the export.
+        ext : str, optional
+            Extension to use in place of the export's own, e.g. for the
+            poster image written alongside a video export.
+        filters : str, optional
+            JSON-encoded filters to use in place of the asset's own.
+
+        Returns
+        -------
+        The path where the render is stored.
+        '''
+        if filters is None:
+            filters = self.filters
+        key = render_key(self.fingerprint, filters, kwargs)
+        ext = ext or kwargs.get('ext', _DEFAULT_EXTENSIONS[self.medium])
+        return os.path.join(root, RENDER_DIR, key[:2], f'{key}.{ext}')
+
+    def renders(self, root, formats, filters=None):
+        '''Get the render path for each of this asset's thumbnail formats.'''
+        return {name: self.path_for_render(root, kwargs, filters=filters)
+                for name, kwargs in formats[self.medium].items()}
+
+    def proxy_path(self, root):
+        '''Get the path of this asset's low-resolution proxy under a root.'''
+        return self.path_for_export(root, PROXY_DIR, 'mp4')
+
+    def export_for_web(self, root, formats, overwrite):
+        '''Export asset thumbnails asynchronously to a root dir.
+
+        Parameters
+        ----------
+        root : str
+            A directory for holding thumbnails.
+        formats : dict
+            Thumbnail format configuration.
+        overwrite : bool
+            If True, overwrite existing thumbnails; otherwise renders that
+            already exist, e.g. from before an edit that was undone, are kept.
+
+        Yields
+        ------
+        Asynchronous results from the export tasks.
+        '''
+        paths = self.renders(root, formats)
+        outputs = [(paths[name], kwargs) for name, kwargs in formats[self.medium].items()]
+        store = pack.store(root)
+        if store and not overwrite:
+            outputs = [(o, kw) for o, kw in outputs
+                       if not store.find(os.path.basename(o))]
+        if not outputs:
+            return
+        # Render all formats from one decode, in one task.
+        kw = dict(slug=self.slug, outputs=outputs, overwrite=overwrite)
+        yield celery.export_all.apply_async(kwargs=kw, queue=self.medium)
+
+    def export_for_zip(self, root, formats, thumbnails=None):
+        '''Export assets asynchronously to a root directory for zipping.
+
+        Parameters
+        ----------
+        root : str
+            A directory containing thumbnails to include in the zip.
+        formats : str
+            The name of a thumbnail format configuration file to load.
+        thumbnails : str, optional
+            Root directory for thumbnails. If given, exports are linked from
+            its renders, which are rendered first if they don't exist yet.
+
+        Yields
+        ------
+        Asynchronous results from the export tasks.
+        '''
+        stems = [self.stamp.isoformat()[:10], self.slug[:4]]
+        stems.extend(sorted(t for t in self.tags if Tag.classify(t) == Tag.USER))
+        stem = '-'.join(stems)
+        for name, kwargs in formats[self.medium].items():
+            ext = kwargs.get('ext', _DEFAULT_EXTENSIONS[self.medium])
+            output = os.path.join(root, name, f'{stem}.{ext}')
+            kw = dict(slug=self.slug, output=output, **kwargs)
+            if thumbnails:
+                render = self.path_for_render(thumbnails, kwargs)
+                if os.path.exists(render):
+                    link_render(render, output)
+                    continue
+                store = pack.store(thumbnails)
+                key = os.path.basename(render).split('.')[0]
+                if store and store.extract(key, os.path.splitext(output)[0]):
+                    continue
+                kw.update(output=render, link=output)
+            # Use celery to call self.export(...) asynchronously.
+            yield celery.export.apply_async(kwargs=kw, queue=self.medium)
+
+
+class Asset(_AssetMixin, db.Model):
     __tablename__ = 'assets'
 
     id = db.Column(db.Integer, primary_key=True)
     slug = db.Column(db.String, unique=True, nullable=False)
     medium = db.Column(db.String, index=True, nullable=False)
     path = db.Column(db.String, nullable=False)
+    file_size = db.Column(db.Integer)
+    file_mtime = db.Column(db.Float)
 
     width = db.Column(db.Integer)
     height = db.Column(db.Integer)
@@ -59,42 +492,33 @@ class Asset(db.Model):
     def __repr__(self):
         return self.slug
 
-    @property
-    def is_audio(self):
-        return self.medium == 'audio'
-
-    @property
-    def is_photo(self):
-        return self.medium == 'photo'
+    def similar_by_tag(self, sess, min_sim=0.5, limit=20, exhaustive=False):
+        '''Find assets with similar tags.
 
-    @property
-    def is_video(self):
-        return self.medium == 'video'
+        Parameters
+        ----------
+        sess : SQLAlchemy
+            Database session.
+        min_sim : float
+            Minimum IDF-weighted Jaccard similarity of returned assets.
+        limit : int
+            Return at most this many assets.
+        exhaustive : bool
+            If True, score every asset sharing a tag with this one. Otherwise
+            only score assets sharing an LSH bucket with this one, which
+            can miss assets with low similarity. Assets without buckets
+            (e.g. after their tags were deleted in SQL) are always scored
+            exhaustively.
 
-    def similar_by_tag(self, sess, min_sim=0.5, limit=20):
-        '''
+        Returns
+        -------
+        A list of :class:`Asset`s, most similar first.
         '''
-        if not hasattr(Asset, '_idf'):
-            Asset._tags_per_asset = collections.defaultdict(set)
-            Asset._assets_per_tag = collections.defaultdict(set)
-            for tag, asset in sess.query(asset_tags.c.tag_id, asset_tags.c.asset_id):
-                Asset._assets_per_tag[tag].add(asset)
-                Asset._tags_per_asset[asset].add(tag)
-            Asset._idf = {t: 1 / len(a) for t, a in Asset._assets_per_tag.items()}
-
-        my_tags = Asset._tags_per_asset[self.id]
-        candidates = set()
-        for tag in my_tags:
-            candidates.update(Asset._assets_per_tag[tag])
-        scores = {}
-        for candidate in candidates - {self.id}:
-            cand_tags = Asset._tags_per_asset[candidate]
-            sim = (sum(Asset._idf[t] for t in (my_tags & cand_tags)) /
-                   sum(Asset._idf[t] for t in (my_tags | cand_tags)))
-            if sim >= min_sim:
-                scores[candidate] = sim
+        candidates = None if exhaustive else similarity.candidates(sess, self.id)
+        scores = dict(similarity.tag_index(sess).similar(
+            self.id, min_sim, limit, candidates))
         return sorted(sess.query(Asset).filter(Asset.id.in_(scores)),
-                      key=lambda a: scores[a.id], reverse=True)[:limit]
+                      key=lambda a: scores[a.id], reverse=True)
 
     def similar_by_content(self, sess, method, max_distance=1):
         '''
@@ -105,27 +529,6 @@ class Asset(db.Model):
                 dupes.update(n.asset for n in h.neighbors(sess, max_distance))
         return dupes - {self}
 
-    def to_dict(self):
-        return dict(
-            id=self.id,
-            slug=self.slug,
-            medium=self.medium,
-            path=self.path,
-            width=self.width,
-            height=self.height,
-            orientation=self.orientation,
-            duration=self.duration,
-            video_fps=self.video_fps,
-            audio_fps=self.audio_fps,
-            lat=self.lat,
-            lng=self.lng,
-            stamp=arrow.get(self.stamp).isoformat(),
-            caption=self.caption,
-            filters=json.loads(self.filters or '[]'),
-            hashes=[h.to_dict() for h in self.hashes],
-            tags=list(self.tags),
-        )
-
     def update_stamp(self, when):
         '''Update the timestamp for this asset.
 
@@ -233,95 +636,114 @@ class Asset(db.Model):
         filters.pop(index)
         self.filters = json.dumps(filters)
 
-    def path_for_export(self, root, name, ext):
-        '''Get the default path to use for exporting this asset.
+    def export(self, output, overwrite=False, proxy=None, **kwargs):
+        '''Export a version of an asset to another file.
 
         Parameters
         ----------
-        root : str
-            Root directory for the export.
-        name : str
-            Subdirectory name.
-        ext : str
-            Extension for the exported file.
-
-        Returns
-        -------
-        The full export file path for default exports.
+        output : str
+            Save exported asset to this file.
+        overwrite : bool, optional
+            If an exported file already exists, this flag determines what to
+            do. If `True` overwrite it; otherwise (the default), return.
+        proxy : str, optional
+            Path of a low-resolution proxy to render from, if it exists and
+            is big enough for the export.
+        **kwargs :
+            Additional keyword arguments to pass to ffmpeg: frame rate,
+            bounding box, etc.
         '''
-        return os.path.join(root, name, self.slug[0], f'{self.slug}.{ext}')
+        self.export_all([(output, kwargs)], overwrite=overwrite, proxy=proxy)
 
-    def export_for_web(self, root, formats, overwrite):
-        '''Export asset thumbnails asynchronously to a root dir.
+    def export_all(self, outputs, overwrite=False, proxy=None):
+        '''Export several versions of an asset.
 
-        Parameters
-        ----------
-        root : str
-            A directory for holding thumbnails.
-        formats : dict
-            Thumbnail format configuration.
-        overwrite : bool
-            If True, overwrite existing thumbnails.
-
-        Yields
-        ------
-        Asynchronous results from the export tasks.
-        '''
-        for name, kwargs in formats[self.medium].items():
-            ext = kwargs.get('ext', _DEFAULT_EXTENSIONS[self.medium])
-            output = self.path_for_export(root, name, ext)
-            kw = dict(slug=self.slug, output=output, overwrite=overwrite, **kwargs)
-            # Use celery to call self.export(...) asynchronously.
-            yield celery.export.apply_async(kwargs=kw, queue=self.medium)
-
-    def export_for_zip(self, root, formats):
-        '''Export assets asynchronously to a root directory for zipping.
+        Photos are rendered in-process with Pillow; everything else is
+        rendered by one ffmpeg process. Either way the source is decoded once
+        for all outputs. Exports that fit inside the frame of a video's proxy
+        are rendered from the proxy, and the rest from the original.
 
         Parameters
         ----------
-        root : str
-            A directory containing thumbnails to include in the zip.
-        formats : str
-            The name of a thumbnail format configuration file to load.
-
-        Yields
-        ------
-        Asynchronous results from the export tasks.
+        outputs : list of (str, dict)
+            Output path and formatting arguments (frame rate, bounding box,
+            etc.) for each exported file.
+        overwrite : bool, optional
+            If `True` overwrite existing exported files; otherwise (the
+            default), skip them.
+        proxy : str, optional
+            Path of a low-resolution proxy of the asset, if one may exist.
         '''
-        stems = [self.stamp.isoformat()[:10], self.slug[:4]]
-        stems.extend(tag.name for tag in
-                     sorted(self._tags, key=lambda t: t.name)
-                     if tag.is_user)
-        stem = '-'.join(stems)
-        for name, kwargs in formats[self.medium].items():
-            ext = kwargs.get('ext', _DEFAULT_EXTENSIONS[self.medium])
-            output = os.path.join(root, name, f'{stem}.{ext}')
-            kw = dict(slug=self.slug, output=output, **kwargs)
-            # Use celery to call self.export(...) asynchronously.
-            yield celery.export.apply_async(kwargs=kw, queue=self.medium)
-
-    def export(self, output, overwrite=False, **kwargs):
-        '''Export a version of an asset to another file.
+        outputs = [(output, kwargs) for output, kwargs in outputs
+                   if overwrite or not os.path.exists(output)]
+        if not outputs:
+            return
+        with contextlib.ExitStack() as stack:
+            # Render into scratch directories and then move the results
+            # (including any poster images) into place, so readers never see
+            # partial files.
+            scratch, staged = {}, []
+            for output, kwargs in outputs:
+                dirname = os.path.dirname(output)
+                if dirname not in scratch:
+                    os.makedirs(dirname, exist_ok=True)
+                    scratch[dirname] = stack.enter_context(
+                        tempfile.TemporaryDirectory(prefix='.export-', dir=dirname))
+                staged.append((os.path.join(scratch[dirname], os.path.basename(output)),
+                               kwargs))
+            if self.is_photo:
+                staged = pillow.render(self, staged)
+            size = ffmpeg.frame_size(proxy) if proxy and os.path.exists(proxy) else None
+            if size:
+                small = [(o, kw) for o, kw in staged
+                         if max(kw.get('bbox') or [math.inf]) <= max(size)]
+                if small:
+                    ffmpeg.run_all(self, small, source=proxy)
+                staged = [(o, kw) for o, kw in staged if (o, kw) not in small]
+            if staged:
+                ffmpeg.run_all(self, staged)
+            for dirname, tmp in scratch.items():
+                for name in os.listdir(tmp):
+                    os.replace(os.path.join(tmp, name), os.path.join(dirname, name))
+        # Clear markers left by a server that queued these exports on demand.
+        for output, _ in outputs:
+            try:
+                os.unlink(output + PENDING_SUFFIX)
+            except FileNotFoundError:
+                pass
+
+    def export_proxy(self, output, bbox, overwrite=False):
+        '''Export a low-resolution proxy of a video for repeated processing.
+
+        Thumbnails, previews and content hashes can be computed from the
+        proxy, which is much quicker to decode and seek than the original.
 
         Parameters
         ----------
         output : str
-            Save exported asset to this file.
+            Path for the proxy.
+        bbox : (int, int)
+            Bounding box for frames of the proxy.
         overwrite : bool, optional
-            If an exported file already exists, this flag determines what to
-            do. If `True` overwrite it; otherwise (the default), return.
-        **kwargs :
-            Additional keyword arguments to pass to ffmpeg: frame rate,
-            bounding box, etc.
+            If `True` overwrite an existing proxy.
         '''
-        if os.path.exists(output) and not overwrite:
+        if not self.is_video or (os.path.exists(output) and not overwrite):
             return
-        if not os.path.exists(os.path.dirname(output)):
-            os.makedirs(os.path.dirname(output))
-        ffmpeg.run(self, output, **kwargs)
+        dirname = os.path.dirname(output)
+        os.makedirs(dirname, exist_ok=True)
+        with tempfile.TemporaryDirectory(prefix='.export-', dir=dirname) as tmp:
+            staged = os.path.join(tmp, os.path.basename(output))
+            if ffmpeg.make_proxy(self.path, staged, bbox).returncode == 0:
+                os.replace(staged, output)
+
+    def update_from_file(self):
+        '''Update this asset's record of the size and mtime of its file.'''
+        stat = os.stat(self.path)
+        self.file_size, self.file_mtime = stat.st_size, stat.st_mtime
 
     def update_from_metadata(self):
         '''Update this asset based on metadata in the file.'''
+        self.update_from_file()
         meta = metadata.Metadata(self.path)
         self.lat, self.lng = meta.latitude, meta.longitude
         self.width, self.height = meta.width, meta.height
@@ -337,8 +759,15 @@ class Asset(db.Model):
         for tag in candidate_tags:
             self.maybe_add_tag(tag)
 
-    def compute_content_hashes(self):
-        '''Compute hashes of asset content.'''
+    def compute_content_hashes(self, proxy=None):
+        '''Compute hashes of asset content.
+
+        Parameters
+        ----------
+        proxy : str, optional
+            Path of a low-resolution proxy to read video frames from, if it
+            exists.
+        '''
         if self.is_photo:
             rgb = self.open_and_auto_orient()
             #self.hashes.add(Hash.compute_resnet_hash(rgb))
@@ -362,9 +791,10 @@ class Asset(db.Model):
                 self.hashes.add(Hash.compute_audio_dhash(spec, t, 8))
 
         if self.is_video and self.duration:
+            source = proxy if proxy and os.path.exists(proxy) else self.path
             for t in range(0, int(self.duration), 10):
                 with tempfile.NamedTemporaryFile(suffix='.jpg') as ntf:
-                    ffmpeg.extract_frame(self.path, t, ntf.name)
+                    ffmpeg.extract_frame(source, t, ntf.name)
                     img = PIL.Image.open(ntf.name).convert('L')
                 self.hashes.add(Hash.compute_video_dhash(img, t, 8))
 
@@ -393,6 +823,118 @@ class Asset(db.Model):
         return img
 
 
+class AssetRecord(_AssetMixin):
+    '''A compact, read-only view of an asset, built straight from a table row.
+
+    Records skip the ORM's identity map and attribute instrumentation, and
+    keep tags as an array of ids that resolve to names through a mapping
+    shared by all records from one query. See :func:`query.records`.
+    '''
+
+    FIELDS = ('id', 'slug', 'medium', 'path', 'file_size', 'file_mtime', 'width',
+              'height', 'orientation', 'duration', 'video_fps', 'audio_fps', 'lat',
+              'lng', 'stamp', 'caption', 'filters')
+
+    __slots__ = FIELDS + ('tag_ids', 'hashes', '_names')
+
+    def __init__(self, values, tag_ids, names, hashes=()):
+        for field, value in zip(AssetRecord.FIELDS, values):
+            setattr(self, field, value)
+        self.tag_ids = tag_ids
+        self.hashes = hashes
+        self._names = names
+
+    def __repr__(self):
+        return self.slug
+
+    @property
+    def tags(self):
+        return {self._names[t] for t in self.tag_ids}
+
+
+# Full-text index over asset paths and captions. The trigram tokenizer lets
+# substring searches use the index instead of scanning the assets table.
+asset_text = sqlalchemy.table(
+    'asset_text',
+    sqlalchemy.column('rowid'),
+    sqlalchemy.column('path'),
+    sqlalchemy.column('caption'))
+
+db.auxiliary(
+    Asset.__table__,
+    create=[
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS asset_text USING fts5(
+               path, caption, content='assets', content_rowid='id',
+               tokenize='trigram')''',
+        '''CREATE TRIGGER IF NOT EXISTS asset_text_insert
+           AFTER INSERT ON assets BEGIN
+               INSERT INTO asset_text (rowid, path, caption)
+               VALUES (new.id, new.path, new.caption);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS asset_text_delete
+           AFTER DELETE ON assets BEGIN
+               INSERT INTO asset_text (asset_text, rowid, path, caption)
+               VALUES ('delete', old.id, old.path, old.caption);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS asset_text_update
+           AFTER UPDATE OF path, caption ON assets BEGIN
+               INSERT INTO asset_text (asset_text, rowid, path, caption)
+               VALUES ('delete', old.id, old.path, old.caption);
+               INSERT INTO asset_text (rowid, path, caption)
+               VALUES (new.id, new.path, new.caption);
+           END''',
+    ],
+    rebuild=["INSERT INTO asset_text (asset_text) VALUES ('rebuild')"],
+    drop=['DROP TABLE IF EXISTS asset_text'])
+
+
+# Spatial index over asset locations. Each geotagged asset is stored as a
+# degenerate box, so "near" and "bbox" queries become R*Tree range lookups.
+asset_locations = sqlalchemy.table(
+    'asset_locations',
+    sqlalchemy.column('id'),
+    sqlalchemy.column('min_lat'),
+    sqlalchemy.column('max_lat'),
+    sqlalchemy.column('min_lng'),
+    sqlalchemy.column('max_lng'))
+
+db.auxiliary(
+    Asset.__table__,
+    create=[
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS asset_locations USING rtree(
+               id, min_lat, max_lat, min_lng, max_lng)''',
+        '''CREATE TRIGGER IF NOT EXISTS asset_locations_insert
+           AFTER INSERT ON assets
+           WHEN new.lat IS NOT NULL AND new.lng IS NOT NULL BEGIN
+               INSERT INTO asset_locations
+               VALUES (new.id, new.lat, new.lat, new.lng, new.lng);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS asset_locations_delete
+           AFTER DELETE ON assets BEGIN
+               DELETE FROM asset_locations WHERE id = old.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS asset_locations_update
+           AFTER UPDATE OF lat, lng ON assets BEGIN
+               DELETE FROM asset_locations WHERE id = old.id;
+               INSERT INTO asset_locations
+               SELECT new.id, new.lat, new.lat, new.lng, new.lng
+               WHERE new.lat IS NOT NULL AND new.lng IS NOT NULL;
+           END''',
+    ],
+    rebuild=[
+        'DELETE FROM asset_locations',
+        '''INSERT INTO asset_locations
+           SELECT id, lat, lat, lng, lng FROM assets
+           WHERE lat IS NOT NULL AND lng IS NOT NULL''',
+    ],
+    drop=['DROP TABLE IF EXISTS asset_locations'])
+
+
+# Writes to these tables make shared read snapshots stale (see snapshot.py).
+db.track_writes(Asset.__table__)
+db.track_writes(asset_tags)
+
+
 @sqlalchemy.event.listens_for(db.Session, 'before_flush')
 def use_existing_tags(sess, context, instances):
     for asset in itertools.chain(sess.new, sess.dirty):
@@ -404,3 +946,31 @@ def use_existing_tags(sess, context, instances):
                     asset.tags.discard(tag.name)
                     asset._tags.add(existing[tag.name])
                     sess.expunge(tag)
+
+
+# Track tag changes in every session (including the web server's), so that
+# in-process similarity indexes can be updated when the changes commit.
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_flush')
+def collect_tag_changes(sess, context):
+    changes = {}
+    for asset in itertools.chain(sess.new, sess.dirty):
+        if isinstance(asset, Asset) and (
+                asset in sess.new or
+                sqlalchemy.inspect(asset).attrs._tags.history.has_changes()):
+            changes[asset.id] = {t.id for t in asset._tags}
+    for asset in sess.deleted:
+        if isinstance(asset, Asset):
+            changes[asset.id] = set()
+    if changes:
+        similarity.write_buckets(sess.connection(), changes)
+        sess.info.setdefault('tag_changes', {}).update(changes)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def apply_tag_changes(sess):
+    similarity.tags_changed(sess.info.pop('tag_changes', {}))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def discard_tag_changes(sess):
+    sess.info.pop('tag_changes', None)
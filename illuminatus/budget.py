@@ -0,0 +1,152 @@
+import contextlib
+import fcntl
+import itertools
+import json
+import os
+import tempfile
+import time
+
+# Relative CPU shares for jobs on each medium. Video decodes and encodes many
+# frames, so it gets the most threads; a photo needs few.
+WEIGHTS = dict(video=4, audio=2, photo=1)
+
+# Default path of the file where jobs on this host register themselves.
+PATH = os.path.join(tempfile.gettempdir(), 'illuminatus-cpu.json')
+
+# Threads allotted to the job running in this process, if any.
+_THREADS = None
+_CLAIMS = itertools.count()
+
+
+def threads():
+    '''Get the number of threads the current job may use.
+
+    Outside of a :func:`claim`, e.g. when exporting from the command line,
+    this falls back to a quarter of the host's CPUs.
+    '''
+    return _THREADS or max(1, os.cpu_count() // 4)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextlib.contextmanager
+def _jobs(path):
+    '''Lock and load the jobs registered on this host, saving any changes.'''
+    with open(path, 'a+') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            handle.seek(0)
+            try:
+                jobs = json.loads(handle.read() or '{}')
+            except ValueError:
+                jobs = {}
+            # Drop jobs whose processes died without releasing their claims.
+            jobs = {k: v for k, v in jobs.items() if _alive(v['pid'])}
+            yield jobs
+            handle.seek(0)
+            handle.truncate()
+            handle.write(json.dumps(jobs))
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def allot(budget, weight, others, claimed=0, slots=1):
+    '''Get the threads for a job, given the other jobs running on the host.
+
+    Threads held by running jobs can't be taken back, so a job gets at most
+    what's left of the budget after their claims.
+
+    Parameters
+    ----------
+    budget : int
+        Number of CPUs for all jobs on the host.
+    weight : float
+        CPU weight of the job.
+    others : list of float
+        CPU weights of the other jobs running on the host.
+    claimed : int, optional
+        Number of threads claimed by the other jobs.
+    slots : int, optional
+        Number of jobs expected to run at once, e.g. the worker concurrency.
+        Slots without a running job are counted as jobs like this one, so
+        the first jobs to start leave threads for the ones that follow.
+
+    Returns
+    -------
+    The job's share of the budget, as a whole number of threads, or 0 if the
+    other jobs have claimed the whole budget.
+    '''
+    idle = max(0, slots - 1 - len(others))
+    share = budget * weight // (weight * (1 + idle) + sum(others))
+    return min(max(1, share), budget - claimed)
+
+
+def _register(path, key, weight, budget, slots):
+    '''Register a job's claim, returning its threads or 0 if none are free.'''
+    with _jobs(path) as jobs:
+        threads = allot(budget, weight,
+                        [j['weight'] for j in jobs.values()],
+                        sum(j.get('threads', 1) for j in jobs.values()),
+                        slots)
+        if threads > 0:
+            jobs[key] = dict(pid=os.getpid(), weight=weight, threads=threads)
+    return threads
+
+
+@contextlib.contextmanager
+def claim(medium, budget=None, path=PATH, slots=None, poll=0.5):
+    '''Claim a share of the host's CPU budget for a job.
+
+    While the claim is held, :func:`threads` gives the job's thread count,
+    which ffmpeg and Pillow use, and NumPy's thread pools are limited to it
+    (if threadpoolctl is installed). Threads claimed on the host never add up
+    to more than the budget: if other jobs hold all of it, this waits until
+    one of them finishes. A claim nested in another in the same process
+    shares the enclosing claim's threads.
+
+    Parameters
+    ----------
+    medium : str
+        Medium of the asset the job works on, a key of :data:`WEIGHTS`.
+    budget : int, optional
+        Number of CPUs for all jobs on the host. Defaults to all of them.
+    path : str, optional
+        File where jobs on the host register their claims.
+    slots : int, optional
+        Number of jobs expected to run at once on the host; see :func:`allot`.
+    poll : float, optional
+        Seconds between attempts while the budget is used up.
+    '''
+    global _THREADS
+    if _THREADS is not None:
+        yield _THREADS
+        return
+    budget = budget or os.cpu_count()
+    weight = WEIGHTS.get(medium, 1)
+    key = f'{os.getpid()}-{next(_CLAIMS)}'
+    while True:
+        threads = _register(path, key, weight, budget, slots or 1)
+        if threads > 0:
+            break
+        time.sleep(poll)
+    _THREADS = threads
+    try:
+        try:
+            import threadpoolctl
+        except ImportError:
+            yield _THREADS
+        else:
+            with threadpoolctl.threadpool_limits(_THREADS):
+                yield _THREADS
+    finally:
+        _THREADS = None
+        with _jobs(path) as jobs:
+            jobs.pop(key, None)
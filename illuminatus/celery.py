@@ -17,6 +17,11 @@ app.conf.update(
     result_backend='redis://localhost',
     timezone='UTC',
     enable_utc=True,
+    # With redis, lower numbers are higher priority. Exports requested by the
+    # web server for missing thumbnails are sent with priority 0.
+    broker_transport_options=dict(
+        queue_order_strategy='priority', priority_steps=list(range(10))),
+    task_default_priority=5,
 )
 
 
@@ -30,12 +35,38 @@ class Task(celery.Task):
     def asset(self, sess, slug):
         return sess.query(illuminatus.Asset).filter_by(slug=slug).scalar()
 
+    def proxy(self, asset):
+        '''Get the path of a video's low-resolution proxy, or None.'''
+        root = app.conf.get('illuminatus_thumbnails')
+        return asset.proxy_path(root) if root and asset.is_video else None
+
+    def claim(self, asset):
+        '''Claim this worker's share of the host CPU budget for an asset.'''
+        return illuminatus.budget.claim(
+            asset.medium, app.conf.get('illuminatus_cpu_budget'),
+            slots=app.conf.get('worker_concurrency'))
+
+
+@app.task(base=Task, bind=True)
+def export(self, slug, output, overwrite=False, link=None, **kwargs):
+    '''Export an asset (usually resized/edited/etc.) to a file on disk.
+
+    If a link path is given, the exported file is also linked there.
+    '''
+    asset = self.asset(self.session(), slug)
+    with self.claim(asset):
+        asset.export(output, overwrite=overwrite, proxy=self.proxy(asset), **kwargs)
+    if link:
+        illuminatus.assets.link_render(output, link)
+
 
 @app.task(base=Task, bind=True)
-def export(self, slug, output, overwrite=False, **kwargs):
-    '''Export an asset (usually resized/edited/etc.) to a file on disk.'''
-    self.asset(self.session(), slug).export(
-        output, overwrite=overwrite, **kwargs)
+def export_all(self, slug, outputs, overwrite=False):
+    '''Export several versions of an asset, given as (output, kwargs) pairs.'''
+    asset = self.asset(self.session(), slug)
+    with self.claim(asset):
+        asset.export_all([(output, kwargs) for output, kwargs in outputs],
+                         overwrite=overwrite, proxy=self.proxy(asset))
 
 
 @app.task(base=Task, bind=True)
@@ -47,7 +78,11 @@ def update_from_content(self, slug):
         if not asset:
             raise ValueError(slug)
         asset.update_from_metadata()
-        asset.compute_content_hashes()
+        proxy, settings = self.proxy(asset), app.conf.get('illuminatus_proxy')
+        with self.claim(asset):
+            if proxy and settings:
+                asset.export_proxy(proxy, settings['bbox'])
+            asset.compute_content_hashes(proxy=proxy)
         for h in asset.hashes:
             sess.add(h)
         try:
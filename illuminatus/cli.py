@@ -6,6 +6,7 @@ import PIL.ImageOps
 import re
 import shutil
 import sys
+import tempfile
 import time
 import yaml
 
@@ -14,7 +15,9 @@ from . import db
 from . import importexport
 from . import query
 
-from .assets import Asset
+from .assets import Asset, collect_proxies, collect_renders, evict_renders, loose_renders
+from .pack import Store
+from .usage import usage
 from .tags import Tag
 
 
@@ -37,6 +40,8 @@ def normalize_path(p):
 
 
 query_assets = query.assets
+query_facets = query.facets
+query_records = query.records
 
 
 def matching_assets(query, **kwargs):
@@ -45,6 +50,12 @@ def matching_assets(query, **kwargs):
         yield from query_assets(sess, query, **kwargs)
 
 
+def matching_records(query, **kwargs):
+    '''Get read-only records of assets matching a query.'''
+    with transaction() as sess:
+        return query_records(sess, query, **kwargs)
+
+
 def progressbar(items, label):
     '''Show a progress bar using the given items and label.'''
     items = list(items)
@@ -89,8 +100,14 @@ def cli(ctx, config, log_sql, log_ffmpeg):
     ctx.obj = dict(config=config, log_sql=log_sql, **parsed)
 
     # Configure sqlalchemy sessions to connect to our database.
-    db.Session.configure(bind=db.engine(path=parsed['db'], echo=log_sql))
+    engine = db.engine(path=parsed['db'], echo=log_sql)
+    db.Session.configure(bind=engine)
+    with engine.begin() as conn:
+        db.upgrade(conn)
     celery.app.conf['illuminatus_db'] = parsed['db']
+    celery.app.conf['illuminatus_cpu_budget'] = parsed.get('cpu-budget')
+    celery.app.conf['illuminatus_thumbnails'] = parsed.get('thumbnails')
+    celery.app.conf['illuminatus_proxy'] = parsed.get('proxy')
 
     if log_ffmpeg:
         from . import ffmpeg
@@ -115,6 +132,10 @@ def queries(ctx):
     - during:YYYY-MM -- assets with timestamps in the range YYYY-MM
     - after:YYYY-MM-DD -- assets with timestamps on or after YYYY-MM-DD
     - path:STRING -- assets whose source path contains the given STRING
+    - text:STRING -- assets whose path or caption contains the given STRING
+    - near:LAT,LNG,KM -- assets located within KM kilometers of LAT,LNG
+    - bbox:LAT,LNG,LAT,LNG -- assets located inside the given corners; use
+      longitudes past 180 (e.g. 170 to 190) for boxes across the antimeridian
     - hash:STRING -- assets whose hash contains the given STRING
     - audio/photo/video -- assets that are audio, photo, or video
 
@@ -153,13 +174,46 @@ db: {db}
 thumbnails: {thumbnails}
 {trash}
 
+# The server renders missing thumbnails on demand: small photo thumbnails
+# while the client waits, and everything else in a high-priority export task.
+# read-through: true
+# render-inline-max: 640
+
+# To let a front-end server (e.g. nginx) send thumbnails, set this to an
+# internal location that maps to the thumbnails directory.
+# accel-redirect: /thumbnails-internal
+
+# Thumbnails moved into a packed store ("illuminatus pack") are sent by the
+# server itself. With a WSGI server whose file wrapper stops at the content
+# length, like gunicorn, set this to send them with sendfile(2).
+# pack-sendfile: true
+
+# Byte budgets for thumbnail formats. The server notes when thumbnails of
+# these formats are read, and "illuminatus evict" removes the least recently
+# read ones until each format fits its budget. Evicted thumbnails are
+# rendered again on demand, so this needs read-through.
+# budgets: {{full: 50_000_000_000}}
+
+# Workers on a host share this many CPUs (by default, all of them). Each
+# export or hashing job gets threads for ffmpeg, Pillow and NumPy according to
+# the other jobs running at the time, with video jobs getting the most. Jobs
+# wait while the others hold the whole budget.
+# cpu-budget: 8
+
+# When importing a video, also make a low-resolution proxy of it. Hashes,
+# previews, and exports that fit inside the proxy's frame are made from the
+# proxy; larger exports still read the original.
+# proxy: {{bbox: [640, 640]}}
+
+# Video formats can set an encoder tier: fast, balanced (the default) or
+# archive, trading encoding speed for quality and size.
 formats:
   photo:
     thumb: {{ext: png, bbox: [320, 320]}}
     full: {{ext: jpg, bbox: [1080, 1080]}}
   video:
-    thumb: {{ext: webp, bbox: [320, 320], fps: 6}}
-    full: {{ext: webm, bbox: [1080, 1080], fps: 24}}
+    thumb: {{ext: webp, bbox: [320, 320], fps: 6, tier: fast}}
+    full: {{ext: webm, bbox: [1080, 1080], fps: 24, tier: balanced}}
   audio:
     thumb: {{ext: png, bbox: [320, 320]}}
     full: {{ext: mp3, abr: 100}}
@@ -215,12 +269,20 @@ def init(ctx, database, thumbnails, trash):
                                 trash=f'trash: {trash}' if trash else ''))
 
 
+@cli.command()
+@click.pass_context
+def reindex(ctx):
+    '''Create and rebuild auxiliary database indexes.'''
+    with db.engine(ctx.obj['db']).begin() as conn:
+        db.reindex(conn)
+
+
 def display(asset, include_tags='.*', exclude_tags=None):
-    tags = sorted((t for t in asset._tags if re.match(include_tags, t.name)),
-                  key=lambda t: (t.pattern, t.name))
+    tags = sorted((t for t in asset.tags if re.match(include_tags, t)),
+                  key=lambda t: (Tag.classify(t), t))
     yield asset.slug
     yield ' '.join(sorted(str(h) for h in asset.hashes if len(h.nibbles) < 10))
-    yield ' '.join(str(t) for t in tags)
+    yield ' '.join(Tag.style(t) for t in tags)
     yield click.style(asset.path)
 
 
@@ -235,10 +297,33 @@ def ls(ctx, query, order, limit):
 
     See "illuminatus help" for help on QUERY syntax.
     '''
-    for asset in matching_assets(query, order=order, limit=limit):
+    for asset in matching_records(query, order=order, limit=limit, hashes=True):
         click.echo(' '.join(display(asset)))
 
 
+@cli.command()
+@click.option('--by', default='month', type=click.Choice(list(query.GRANULARITIES)),
+              help='Bucket the date histogram by this unit of time.')
+@click.option('--limit', default=20, metavar='N', help='Show the N most common tags.')
+@click.argument('query', nargs=-1)
+@click.pass_context
+def facets(ctx, query, by, limit):
+    '''Count tags, media, and dates of assets matching a QUERY.
+
+    See "illuminatus help" for help on QUERY syntax.
+    '''
+    with transaction() as sess:
+        counts = query_facets(sess, query, by)
+    for facet, items in counts.items():
+        click.echo(click.style(facet, bold=True))
+        if facet == 'tags':
+            items = sorted(items.items(), key=lambda kv: -kv[1])[:limit]
+        else:
+            items = sorted(items.items())
+        for key, count in items:
+            click.echo(f'{count:8d} {key}')
+
+
 @cli.command()
 @click.option('--method', default='dhash-8', metavar='[dhash-8|rgb-16|...]',
               help='Check for asset neighbors using this hashing method.')
@@ -252,7 +337,7 @@ def dupe(ctx, query, method, max_distance):
     See "illuminatus help" for help on QUERY syntax.
     '''
     with transaction() as sess:
-        for asset in query_assets(sess, query):
+        for asset in query_assets(sess, query, load='detail'):
             neighbors = asset.dupes(sess, method, max_distance)
             if neighbors:
                 click.echo(' '.join(display(asset)))
@@ -274,7 +359,7 @@ def rm(ctx, query):
     script) can garbage-collect these files as needed.
     '''
     with transaction() as sess:
-        for asset in query_assets(sess, query):
+        for asset in query_assets(sess, query, load='bulk-write'):
             if 'trash' in ctx.obj:
                 asset.move_to_trash(ctx.obj['trash'])
             sess.delete(asset)
@@ -301,7 +386,7 @@ def view(ctx, query):
     aspect = columns / lines
     try:
         with transaction() as sess:
-            assets = list(query_assets(sess, query))
+            assets = list(query_assets(sess, query, load='listing'))
             idx = 0
             while True:
                 asset = assets[idx]
@@ -341,14 +426,15 @@ def export(ctx, query, output, hide_tags, hide_omnipresent_tags):
 
     See "illuminatus help" for help on QUERY syntax.
     '''
-    assets = list(matching_assets(query))
-    with tempfile.NamedTemporaryDirectory() as root:
+    assets = matching_records(query, hashes=True)
+    with tempfile.TemporaryDirectory() as root:
         def items():
             for asset in assets:
-                yield from asset.export_for_zip(root.name, ctx.obj['formats'])
+                yield from asset.export_for_zip(
+                    root, ctx.obj['formats'], ctx.obj['thumbnails'])
         progressbar(items(), 'Export')
         importexport.export_zip(
-            assets, root.name, output, hide_tags, hide_omnipresent_tags)
+            assets, root, output, hide_tags, hide_omnipresent_tags)
     click.echo(output)
 
 
@@ -408,7 +494,7 @@ def modify(ctx, query, stamp, add_tag, remove_tag, add_path_tags):
     earlier. Here x can be 'y' (year), 'm' (month), 'd' (day), or 'h' (hour).
     '''
     with transaction() as sess:
-        for asset in query_assets(sess, query):
+        for asset in query_assets(sess, query, load='bulk-write'):
             asset.tags -= set(remove_tag)
             for tag in add_tag:
                 asset.maybe_add_tag(tag)
@@ -431,7 +517,7 @@ def thumbnail(ctx, query, overwrite, wait):
     See "illuminatus help" for help on QUERY syntax.
     '''
     def items():
-        for asset in matching_assets(query):
+        for asset in matching_records(query):
             yield from asset.export_for_web(
                 ctx.obj['thumbnails'],
                 ctx.obj['formats'],
@@ -442,6 +528,62 @@ def thumbnail(ctx, query, overwrite, wait):
         list(items())
 
 
+@cli.command()
+@click.option('--min-age', default=7.0, metavar='DAYS',
+              help='Keep unused renders modified in the last DAYS.')
+@click.pass_context
+def gc(ctx, min_age):
+    '''Remove thumbnails that no asset uses any more.
+
+    Thumbnails are stored under a hash of the source, filters and format, so
+    edits and format changes leave the old ones behind. Video proxies of
+    assets that were deleted are removed too.
+    '''
+    keep, slugs = set(), set()
+    for asset in matching_records(()):
+        slugs.add(asset.slug)
+        for path in asset.renders(ctx.obj['thumbnails'], ctx.obj['formats']).values():
+            keep.add(os.path.basename(path).split('.')[0])
+    removed = collect_renders(ctx.obj['thumbnails'], keep, min_age * 86400)
+    removed += collect_proxies(ctx.obj['thumbnails'], slugs, min_age * 86400)
+    click.echo(f'Removed {removed} files.')
+
+
+@cli.command()
+@click.pass_context
+def evict(ctx):
+    '''Remove the least recently viewed thumbnails of formats over budget.
+
+    Byte budgets for formats are set in the config file. Evicted thumbnails
+    are rendered again the next time they're requested.
+    '''
+    root, formats = ctx.obj['thumbnails'], ctx.obj['formats']
+    read_times = usage(root).times()
+    records = matching_records(())
+    for fmt, budget in (ctx.obj.get('budgets') or {}).items():
+        paths = [asset.renders(root, formats)[fmt] for asset in records
+                 if fmt in formats[asset.medium]]
+        removed, freed = evict_renders(root, paths, budget, read_times)
+        click.echo(f'{fmt}: removed {removed} files, {freed} bytes.')
+
+
+@cli.command('pack')
+@click.option('--compact/--no-compact', default=True,
+              help='Also rewrite segments that are mostly removed thumbnails.')
+@click.pass_context
+def pack_(ctx, compact):
+    '''Move thumbnails into a packed store.
+
+    Packing many small files into a few large segments makes backups and
+    cold reads quicker. Once the store exists, the server reads from it, and
+    thumbnails rendered later can be packed by running this again.
+    '''
+    store = Store(ctx.obj['thumbnails'])
+    click.echo(f'Packed {store.add(loose_renders(ctx.obj["thumbnails"]))} files.')
+    if compact:
+        click.echo(f'Reclaimed {store.compact()} bytes.')
+
+
 @cli.command()
 @click.option('--concurrency', default=1, metavar='N', help='Run N concurrent workers.')
 @click.option('--uid', type=int, metavar='N', help='Run as UID N.')
@@ -499,7 +641,7 @@ def train(ctx, query, feature_tags, label_tags, epochs, validation_split, save):
     print(f'Got validation split: {validation_split}')
 
     train, valid = [], []
-    for asset in matching_assets('photo not untouched'):
+    for asset in matching_records(['photo not untouched']):
         if any(asset.slug.endswith(s) for s in validation_split):
             valid.append(asset.to_dict())
         else:
@@ -528,9 +670,19 @@ def serve(ctx, host, port, debug, slug_size):
     '''Start an HTTP server for asset metadata.'''
     from .serve import app
     from .serve import sql
+    from . import snapshot
     import multiprocessing
 
+    # Workers share read-only indexes by mapping a snapshot file, which a
+    # separate process rebuilds whenever the database records a write.
+    path = snapshot.path_for(ctx.obj['db'])
+    with db.Session() as sess:
+        snapshot.rebuild(sess, path)
+    multiprocessing.Process(
+        target=snapshot.watch, args=(ctx.obj['db'], path), daemon=True).start()
+
     app.config.update(ctx.obj)
+    app.config['snapshot'] = path
     app.config['SQLALCHEMY_ECHO'] = ctx.obj['log_sql']
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{ctx.obj['db']}"
@@ -1,3 +1,4 @@
+import math
 import sqlalchemy
 import sqlalchemy.ext.declarative
 
@@ -15,6 +16,26 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
     cur.execute('PRAGMA journal_mode = WAL')
     cur.execute('PRAGMA synchronous = NORMAL')
     cur.close()
+    dbapi_connection.create_function('distance', 4, _distance, deterministic=True)
+    dbapi_connection.create_function('mercator', 1, _mercator, deterministic=True)
+
+
+def _distance(lat1, lng1, lat2, lng2):
+    '''Great-circle distance in km between two points, in degrees.'''
+    if None in (lat1, lng1, lat2, lng2):
+        return None
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * 6371.0088 * math.asin(min(1, math.sqrt(a)))
+
+
+def _mercator(lat):
+    '''Web mercator y coordinate in [0, 1] (from north) for a latitude.'''
+    if lat is None:
+        return None
+    lat = math.radians(max(-85.0511, min(85.0511, lat)))
+    return (1 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi) / 2
 
 
 def engine(path, echo=False):
@@ -23,3 +44,138 @@ def engine(path, echo=False):
 
 # Session gets bound to an engine in cli.py using db.Session.configure(...).
 Session = sqlalchemy.orm.sessionmaker(autoflush=False)
+
+
+# Auxiliary SQL (virtual tables, triggers) attached to model tables, as
+# (table name, create statements, rebuild statements) tuples.
+_AUXILIARY = []
+
+
+def auxiliary(table, create, rebuild=(), drop=()):
+    '''Attach auxiliary SQL structures to a model table.
+
+    Parameters
+    ----------
+    table : :class:`sqlalchemy.Table`
+        Model table that the auxiliary structures depend on.
+    create : list of str
+        Statements that create the structures. These run after the table is
+        created, and again from :func:`reindex`, so they should use "IF NOT
+        EXISTS".
+    rebuild : list of str or callable, optional
+        Statements that repopulate the structures from the table contents. A
+        callable is called with a database connection instead.
+    drop : list of str, optional
+        Statements that remove the structures before the table is dropped.
+    '''
+    for stmt in create:
+        sqlalchemy.event.listen(table, 'after_create', sqlalchemy.DDL(stmt))
+    for stmt in drop:
+        sqlalchemy.event.listen(table, 'before_drop', sqlalchemy.DDL(stmt))
+    _AUXILIARY.append((table.name, tuple(create), tuple(rebuild)))
+
+
+def track_writes(table):
+    '''Count writes to a table in the database's write generation.
+
+    Parameters
+    ----------
+    table : :class:`sqlalchemy.Table`
+        Model table whose inserts, updates, and deletes should increment the
+        generation returned by :func:`write_generation`.
+    '''
+    name = table.name
+    auxiliary(
+        table,
+        create=[
+            '''CREATE TABLE IF NOT EXISTS write_generation (
+                   id INTEGER PRIMARY KEY CHECK (id = 0),
+                   generation INTEGER NOT NULL)''',
+            'INSERT OR IGNORE INTO write_generation (id, generation) VALUES (0, 0)',
+        ] + [
+            f'''CREATE TRIGGER IF NOT EXISTS {name}_write_{op.lower()}
+                AFTER {op} ON {name} BEGIN
+                    UPDATE write_generation SET generation = generation + 1;
+                END''' for op in ('INSERT', 'UPDATE', 'DELETE')
+        ],
+        drop=[f'DROP TRIGGER IF EXISTS {name}_write_{op.lower()}'
+              for op in ('insert', 'update', 'delete')] + [
+            'DROP TABLE IF EXISTS write_generation'])
+
+
+def write_generation(conn):
+    '''Get a number that increases whenever a tracked table is written.
+
+    Parameters
+    ----------
+    conn : :class:`sqlalchemy.engine.Connection` or session
+        A connection to the database.
+
+    Returns
+    -------
+    The current write generation, or None if the database doesn't track one.
+    '''
+    try:
+        return conn.execute(sqlalchemy.text(
+            'SELECT generation FROM write_generation')).scalar()
+    except sqlalchemy.exc.OperationalError:
+        return None
+
+
+def reindex(conn):
+    '''Create any missing auxiliary structures and rebuild their contents.
+
+    Parameters
+    ----------
+    conn : :class:`sqlalchemy.engine.Connection`
+        A connection to the database to reindex.
+    '''
+    for _, create, rebuild in _AUXILIARY:
+        _execute(conn, create + rebuild)
+
+
+def upgrade(conn):
+    '''Create columns and auxiliary structures an existing database is missing.
+
+    Databases made before a column or structure was added don't have it; this
+    adds missing (nullable) columns to model tables, and creates missing
+    structures and fills them in from their table, as :func:`reindex` would,
+    leaving those that already exist alone.
+
+    Parameters
+    ----------
+    conn : :class:`sqlalchemy.engine.Connection`
+        A connection to the database to upgrade.
+    '''
+    def names():
+        return set(conn.execute(sqlalchemy.text(
+            'SELECT name FROM sqlite_master')).scalars())
+
+    existing = names()
+    for table in Model.metadata.sorted_tables:
+        if table.name not in existing:
+            continue
+        have = {row[1] for row in conn.execute(sqlalchemy.text(
+            f'PRAGMA table_info({table.name})'))}
+        for column in table.columns:
+            if column.name not in have:
+                kind = column.type.compile(conn.dialect)
+                conn.execute(sqlalchemy.text(
+                    f'ALTER TABLE {table.name} ADD COLUMN {column.name} {kind}'))
+    for table, create, rebuild in _AUXILIARY:
+        # Before "illuminatus init", there's nothing to attach structures to.
+        if table not in existing:
+            continue
+        _execute(conn, create)
+        created = names()
+        if created - existing:
+            _execute(conn, rebuild)
+        existing = created
+
+
+def _execute(conn, stmts):
+    for stmt in stmts:
+        if callable(stmt):
+            stmt(conn)
+        else:
+            conn.execute(sqlalchemy.text(stmt))
@@ -1,11 +1,16 @@
 import click
+import collections
+import functools
 import itertools
 import json
 import math
 import os
+import re
 import subprocess
 import tempfile
 
+from . import budget
+
 _DEBUG = 0
 
 
@@ -90,120 +95,324 @@ def _sigmoid(ratio):
     return ' '.join(f'{x}/{curve(x)}' for x in (0.0, 0.1, 0.3, 0.5, 0.7, 0.9, 1.0))
 
 
-def _apply_filters(asset):
-    '''Apply a filter using this tool.
+# Filters that undo the EXIF orientation of a photo.
+# http://stackoverflow.com/q/4228530
+# https://magnushoff.com/articles/jpeg-orientation/
+_AUTOORIENT = {
+    2: [dict(filter='hflip')],
+    3: [dict(filter='hflip'), dict(filter='vflip')],
+    4: [dict(filter='vflip')],
+    5: [dict(filter='transpose')],
+    6: [dict(filter='transpose'), dict(filter='hflip')],
+    7: [dict(filter='transpose'), dict(filter='hflip'), dict(filter='vflip')],
+    8: [dict(filter='transpose'), dict(filter='vflip')],
+}
+
+
+# A compiled stack of filters. The slices of the source are joined, and then
+# each step is applied in order. Steps are (name, args) pairs, where args are
+# sorted (key, value) pairs, with any geometry given in pixels of the frames
+# that the step applies to. Size is the width and height of the result.
+Graph = collections.namedtuple('Graph', 'slices steps size')
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_filters(orientation, width, height, filters):
+    '''Compile a stack of filters for frames of a given size.
+
+    Graphs are cached, so callers must not modify them. Renderers map steps
+    to their own operations; see :func:`_apply_filters` and
+    :func:`pillow._operations`.
 
     Parameters
     ----------
-    asset : :class:`Asset`
-        Asset to use for media data.
+    orientation : int
+        EXIF orientation of a photo, or None to leave frames as they are.
+    width : int
+        Width in pixels of the frames being filtered.
+    height : int
+        Height in pixels of the frames being filtered.
+    filters : str
+        JSON-encoded list of filters.
 
     Returns
     -------
-    slices : list of (float, float)
-        List of slices from the source asset.
-    filters : list of str
-        List of filters to apply.
+    A :class:`Graph`.
     '''
-    # A list of extracted parts from the original video; these will be extracted
-    # and concatenated (in the order in this list) before applying filters.
-    slices = []
-    filters = []
-
-    runners = dict(
-        autocontrast=lambda percent: filters.append(f'histeq=strength={percent / 100}'),
-        brightness=lambda percent: filters.append(f'hue=b={percent / 100 - 1}'),
-        contrast=lambda percent: filters.append(f"curves=m='{_sigmoid(percent / 100)}'"),
-        crop=lambda w, h, x, y: filters.append(f'crop={w}:{h}:{x}:{y}'),
-        extract=lambda start, duration: slices.append((start, duration)),
-        fps=lambda fps: filters.append(f'fps={fps}'),
-        hflip=lambda: filters.append('hflip'),
-        hue=lambda degrees: filters.append(f'hue=h={degrees}'),
-        rotate=lambda degrees: filters.append(_rotate(math.radians(degrees))),
-        saturation=lambda percent: filters.append(f'hue=s={percent / 100}'),
-        scale=lambda w, h: filters.append(_scale(w, h)),
-        transpose=lambda: filters.append('transpose'),
-        vflip=lambda: filters.append('vflip'),
-    )
-
-    # http://stackoverflow.com/q/4228530
-    # https://magnushoff.com/articles/jpeg-orientation/
-    autoorient = {
-        2: [dict(filter='hflip')],
-        3: [dict(filter='hflip'), dict(filter='vflip')],
-        4: [dict(filter='vflip')],
-        5: [dict(filter='transpose')],
-        6: [dict(filter='transpose'), dict(filter='hflip')],
-        7: [dict(filter='transpose'), dict(filter='hflip'), dict(filter='vflip')],
-        8: [dict(filter='transpose'), dict(filter='vflip')],
-    }.get(asset.orientation if asset.is_photo else None, [])
-
-    w, h, t = asset.width, asset.height, asset.duration
-    for kwargs in autoorient + json.loads(asset.filters or '[]'):
-        flt = kwargs.pop('filter')
+    slices, steps = [], []
+    w, h = width, height
+
+    def step(name, **args):
+        steps.append((name, tuple(sorted(args.items()))))
+
+    for kwargs in _AUTOORIENT.get(orientation, []) + json.loads(filters or '[]'):
+        flt = kwargs['filter']
+        args = {k: v for k, v in kwargs.items() if k != 'filter'}
         if flt == 'rotate':
-            angle = kwargs['degrees']
-            runners['rotate'](angle)
+            angle = args['degrees']
+            step('rotate', degrees=angle)
+            t = math.radians(angle)
+            W = round(w * abs(math.cos(t)) + h * abs(math.sin(t)))
+            H = round(w * abs(math.sin(t)) + h * abs(math.cos(t)))
             if angle % 90 != 0:
-                w, h, x, y = _crop_after_rotate(w, h, angle)
-                runners['crop'](w, h, x, y)
+                W, H, x, y = _crop_after_rotate(w, h, angle)
+                step('crop', w=W, h=H, x=x, y=y)
+            w, h = W, H
         elif flt == 'crop':
-            px1, py1 = kwargs['x1'], kwargs['y1']
-            px2, py2 = kwargs['x2'], kwargs['y2']
-            x1, y1 = int(w * px1), int(h * py1)
-            x2, y2 = int(w * px2), int(h * py2)
-            w, h = x2 - x1, y2 - y1
-            runners['crop'](w, h, x1, y1)
+            x1, y1 = int(w * args['x1']), int(h * args['y1'])
+            x2, y2 = int(w * args['x2']), int(h * args['y2'])
+            w, h = max(1, x2 - x1), max(1, y2 - y1)
+            step('crop', w=w, h=h, x=x1, y=y1)
         elif flt == 'scale':
-            f = kwargs['factor']
-            w = int(f * w)
-            w -= w % 2
-            h = int(f * h)
-            h -= h % 2
-            runners['scale'](w, h)
-        elif flt == 'cut':
-            start = kwargs.get('start', 0)
-            duration = kwargs.get('duration', t - start)
-            t -= duration
-            runners['cut'](t, start, duration)
+            f = args['factor']
+            w, h = max(2, int(f * w) // 2 * 2), max(2, int(f * h) // 2 * 2)
+            step('scale', w=w, h=h)
+        elif flt == 'transpose':
+            step('transpose')
+            w, h = h, w
+        elif flt == 'extract':
+            slices.append((args['start'], args['duration']))
         else:
-            runners[flt](**kwargs)
-
-    return slices, filters
-
-
-def _generate_chains(use_video, use_audio, slices, filters):
-    # https://superuser.com/questions/681885
-    pads = []
-    for i, (start, duration) in enumerate(slices):
-        if use_video:
-            pads.append(f'{i+1}v')
-            yield ['0:v'], [f'trim={start}:{start + duration}',
-                            'setpts=PTS-STARTPTS',
-                            'format=yuv420p'], [pads[-1]]
-        if use_audio:
-            pads.append(f'{i+1}a')
-            yield ['0:a'], [f'atrim={start}:{start + duration}',
-                            'asetpts=PTS-STARTPTS'], [pads[-1]]
-    if pads:
-        outs = (([f'outv'] if use_video else []) +
-                ([f'outa'] if use_audio else []))
-        use_v = int(use_video)
-        use_a = int(use_audio)
-        n = len(pads) // (use_v + use_a)
-        yield pads, [f'concat=n={n}:v={use_v}:a={use_a}'], outs
-    if filters:
-        yield [], filters, ['outv']
-
-
-_ENCODER_ARGS = dict(
-    # https://superuser.com/questions/1296374
-    mp4=('-c:v h264_nvenc -level:v 4.1 -profile:v main -rc:v vbr_hq '
-         '-rc-lookahead:v 32 -c:a aac -pix_fmt yuv420p'),
-    webm='-c:v libvpx-vp9 -c:a libopus -row-mt 1',
+            step(flt, **args)
+
+    return Graph(tuple(slices), tuple(steps), (w, h))
+
+
+def graph(asset, size=None, filters=None):
+    '''Compile an asset's filters; see :func:`compile_filters`.
+
+    Parameters
+    ----------
+    asset : :class:`Asset`
+        Asset to use for filters and orientation.
+    size : (int, int), optional
+        Width and height of the frames being filtered, if they differ from
+        the asset's (e.g. when reading from a proxy).
+    filters : str, optional
+        JSON-encoded filters to use in place of the asset's own.
+    '''
+    w, h = size or (asset.width, asset.height)
+    return compile_filters(asset.orientation if asset.is_photo else None, w, h,
+                           asset.filters if filters is None else filters)
+
+
+# Ffmpeg filters for each step of a compiled graph.
+_FILTERS = dict(
+    autocontrast=lambda percent: f'histeq=strength={percent / 100}',
+    brightness=lambda percent: f'hue=b={percent / 100 - 1}',
+    contrast=lambda percent: f"curves=m='{_sigmoid(percent / 100)}'",
+    crop=lambda w, h, x, y: f'crop={w}:{h}:{x}:{y}',
+    fps=lambda fps: f'fps={fps}',
+    hflip=lambda: 'hflip',
+    hue=lambda degrees: f'hue=h={degrees}',
+    rotate=lambda degrees: _rotate(math.radians(degrees)),
+    saturation=lambda percent: f'hue=s={percent / 100}',
+    scale=_scale,
+    transpose=lambda: 'transpose',
+    vflip=lambda: 'vflip',
 )
 
 
+@functools.lru_cache(maxsize=1024)
+def _filter_chain(steps):
+    return tuple(_FILTERS[name](**dict(args)) for name, args in steps)
+
+
+def _apply_filters(asset, size=None):
+    '''Get the ffmpeg filters for an asset.
+
+    Parameters
+    ----------
+    asset : :class:`Asset`
+        Asset to use for media data.
+    size : (int, int), optional
+        Width and height of the frames being filtered, if they differ from
+        the asset's (e.g. when reading from a proxy).
+
+    Returns
+    -------
+    slices : tuple of (float, float)
+        Slices from the source asset, to join before applying filters.
+    filters : tuple of str
+        Filters to apply.
+    '''
+    compiled = graph(asset, size)
+    return compiled.slices, _filter_chain(compiled.steps)
+
+
+# Speed/quality tiers for encoding, fastest first.
+TIERS = ('fast', 'balanced', 'archive')
+
+# Encoders and their arguments at each tier, for each output format. The
+# alternatives for a format are in order of preference; the first one whose
+# encoders are in this ffmpeg build is used. Hardware encoders are left out:
+# ffmpeg lists them whether or not the machine has the hardware.
+_ENCODERS = dict(
+    mp4=[
+        ('libx264', 'aac', dict(
+            fast='-preset veryfast -crf 26',
+            balanced='-preset medium -crf 23',
+            archive='-preset slow -crf 18')),
+        ('mpeg4', 'aac', dict(fast='-q:v 8', balanced='-q:v 5', archive='-q:v 2')),
+    ],
+    webm=[
+        ('libvpx-vp9', 'libopus', dict(
+            fast='-deadline realtime -cpu-used 8 -row-mt 1 -crf 36 -b:v 0',
+            balanced='-deadline good -cpu-used 4 -row-mt 1 -crf 32 -b:v 0',
+            archive='-deadline good -cpu-used 1 -row-mt 1 -crf 28 -b:v 0')),
+        ('libvpx', 'libvorbis', dict(
+            fast='-deadline realtime -cpu-used 8 -crf 20 -b:v 1M',
+            balanced='-deadline good -cpu-used 4 -crf 10 -b:v 1M',
+            archive='-deadline good -cpu-used 1 -crf 6 -b:v 2M')),
+    ],
+    webp=[
+        ('libwebp_anim', None, dict(
+            fast='-compression_level 1', balanced='-compression_level 4',
+            archive='-compression_level 6')),
+        ('libwebp', None, dict(
+            fast='-compression_level 1', balanced='-compression_level 4',
+            archive='-compression_level 6')),
+    ],
+)
+
+# Extra arguments for each output container.
+_CONTAINER_ARGS = dict(mp4='-pix_fmt yuv420p -movflags +faststart')
+
+
+@functools.lru_cache(maxsize=None)
+def encoders():
+    '''Get the names of the encoders in this ffmpeg build.'''
+    proc = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                          capture_output=True, text=True)
+    return frozenset(re.findall(r'^ [VAS][\w.]{5} (?!=)(\S+)', proc.stdout, re.M))
+
+
+def encoder_args(ext, tier='balanced'):
+    '''Get ffmpeg arguments for encoding an output format.
+
+    Parameters
+    ----------
+    ext : str
+        Output file extension.
+    tier : str, optional
+        Speed/quality tier, one of :data:`TIERS`.
+
+    Returns
+    -------
+    A list of ffmpeg arguments; empty if there are no preferred encoders for
+    the format, in which case ffmpeg picks its default.
+    '''
+    if tier not in TIERS:
+        raise ValueError(f'Unknown encoder tier {tier!r}, expected one of {TIERS}')
+    available = encoders()
+    for video, audio, args in _ENCODERS.get(ext, ()):
+        if video in available and (audio is None or audio in available):
+            codecs = ['-c:v', video] + (['-c:a', audio] if audio else [])
+            return codecs + args[tier].split() + _CONTAINER_ARGS.get(ext, '').split()
+    return _CONTAINER_ARGS.get(ext, '').split()
+
+
+# Output extensions that hold only images, or only audio.
+_IMAGE_EXTS = frozenset(('gif', 'jpeg', 'jpg', 'png', 'webp'))
+_AUDIO_EXTS = frozenset(('flac', 'm4a', 'mp3', 'ogg', 'opus', 'wav'))
+
+
+@functools.lru_cache(maxsize=1024)
+def _probe(path):
+    '''Get the types of streams in a media file, and its frame size.
+
+    Returns
+    -------
+    streams : frozenset of str
+        Types of streams ("video", "audio", ...) in the file.
+    size : (int, int)
+        Width and height of the first video stream, or None.
+    '''
+    # With no output file, ffmpeg describes the input streams and exits.
+    proc = subprocess.run(['ffmpeg', '-hide_banner', '-i', path],
+                          capture_output=True, text=True)
+    streams = re.findall(r'^\s*Stream #0:\d+.*?: (Video|Audio|Subtitle|Data):(.*)$',
+                         proc.stderr, re.M)
+    sizes = [re.search(r', (\d+)x(\d+)\b', rest)
+             for kind, rest in streams if kind == 'Video']
+    size = tuple(map(int, sizes[0].groups())) if sizes and sizes[0] else None
+    return frozenset(kind.lower() for kind, _ in streams), size
+
+
+def frame_size(path):
+    '''Get the width and height of the video in a media file, or None.'''
+    return _probe(path)[1]
+
+
+def _window(slices, start, duration):
+    '''Map a window of an export's timeline to slices of the source media.
+
+    Parameters
+    ----------
+    slices : list of (float, float)
+        Start and duration of the source slices that are joined to make the
+        export, or an empty list if the export uses the whole source.
+    start : float
+        Start of the window, in seconds from the start of the export.
+    duration : float
+        Length of the window, in seconds.
+
+    Returns
+    -------
+    A list of (start, duration) slices of the source covering the window.
+    '''
+    if not slices:
+        return [(start, duration)]
+    pieces, offset = [], 0
+    for s, d in slices:
+        lo, hi = max(start, offset), min(start + duration, offset + d)
+        if hi > lo:
+            pieces.append((s + lo - offset, hi - lo))
+        offset += d
+    return pieces
+
+
+def _base_graph(inputs, use_video, use_audio, filters, label):
+    '''Build filter chains that join input slices and apply filters.
+
+    Parameters
+    ----------
+    inputs : list of int
+        Indices of the ffmpeg inputs to join, in order.
+    use_video : bool
+        True to join the video streams of the inputs.
+    use_audio : bool
+        True to join the audio streams of the inputs.
+    filters : list of str
+        Filters to apply to the joined video.
+    label : str
+        Prefix for labels of the joined streams.
+
+    Returns
+    -------
+    chains : list of str
+        Filter graph chains.
+    video : str
+        Label of the filtered video stream.
+    audio : str
+        Label of the filtered audio stream.
+    '''
+    chains = []
+    video, audio = f'{inputs[0]}:v', f'{inputs[0]}:a'
+    if len(inputs) > 1:
+        # https://superuser.com/questions/681885
+        video, audio = f'{label}v', f'{label}a'
+        pads = ''.join((f'[{i}:v]' if use_video else '') +
+                       (f'[{i}:a]' if use_audio else '') for i in inputs)
+        outs = (f'[{video}]' if use_video else '') + (f'[{audio}]' if use_audio else '')
+        chains.append(f'{pads}concat=n={len(inputs)}:'
+                      f'v={int(use_video)}:a={int(use_audio)}{outs}')
+    if filters and use_video:
+        chains.append(f'[{video}]{",".join(filters)}[{label}f]')
+        video = f'{label}f'
+    return chains, video, audio
+
+
 def run(asset, output, **kwargs):
     '''Ffmpeg is a tool for manipulating audio and video files.
 
@@ -216,104 +425,151 @@ def run(asset, output, **kwargs):
     **kwargs : dict
         Formatting arguments for output.
     '''
-    slices, filters = _apply_filters(asset)
-    if 'bbox' in kwargs:
-        filters.append(_scale(*kwargs['bbox']))
-    if 'fps' in kwargs:
-        filters.append(f'fps={kwargs["fps"]}')
+    run_all(asset, [(output, kwargs)])
 
-    threads = str(max(1, os.cpu_count() // 4))
 
-    def run(*args):
-        cmd = ['ffmpeg', '-y',
-               '-threads', threads,
-               '-filter_threads', threads,
-               '-filter_complex_threads', threads,
-               '-i', asset.path,
-               '-threads', threads]
-        for attr in 'ar ac crf quality speed'.split():
-            if attr in kwargs:
-                cmd.extend((f'-{attr}', f'{kwargs[attr]}'))
-        cmd.extend(args)
-        if _DEBUG > 0:
-            click.echo('FFMPEG {}'.format(
-                click.style(' '.join(cmd), bold=True, fg='cyan')))
-        return subprocess.run(cmd, capture_output=_DEBUG == 0)
+def run_all(asset, outputs, source=None):
+    '''Render several outputs from a single decode of an asset's media.
+
+    The asset's filters are applied once, and the result is split to one
+    branch per output (animations, poster images, spectrograms, transcodes).
+    Outputs that only show a clip of the media (animations, posters and
+    spectrograms) read from their own inputs, which ffmpeg seeks to the clip
+    before decoding, and each extracted slice is a separate seeked input.
 
-    stem, ext = os.path.splitext(output)
-    ext = ext.strip('.').lower()
-    dur = asset.duration or 0
+    Parameters
+    ----------
+    asset : :class:`Asset`
+        Asset to use for media data.
+    outputs : list of (str, dict)
+        Path and formatting arguments for each output.
+    source : str, optional
+        Path of media to read in place of the asset's own, such as a
+        low-resolution proxy. Filters are scaled to its frame size.
+    '''
+    source = source or asset.path
+    streams, size = _probe(source)
+    slices, filters = _apply_filters(asset, size if source != asset.path else None)
+    # If the streams can't be listed, assume the usual ones for the medium.
+    streams = streams or {'video', 'audio'}
+    use_video = (asset.is_video or asset.is_photo) and 'video' in streams
+    use_audio = (asset.is_video or asset.is_audio) and 'audio' in streams
+
+    # The exported timeline is made of the extracted slices, if any.
+    dur = sum(d for _, d in slices) if slices else (asset.duration or 0)
     mid = dur / 2
 
-    # Audio --> png: make a spectrogram image of the middle 60 seconds.
-    if asset.is_audio and ext == 'png':
-        w, h = kwargs['bbox']
-        trim = f'atrim={max(0, mid - 30)}:{min(dur, mid + 30)}'
-        spec = f'showspectrumpic=s={w}x{h}:color=viridis:scale=log:fscale=log'
-        run('-af', f'{trim},{spec}', output)
-        return
-
-    # Video --> gif: make an animated gif from the middle 10 seconds of a video,
-    # and a poster image from the start of that clip.
-    if asset.is_video and ext == 'gif':
-        args = f'-ss {max(0, mid - 5)} -t 10 -an -vf'.split()
-        palette = 'split[u][q];[u]fifo[v];[q]palettegen[p];[v][p]paletteuse'
-        run(*args + [','.join(filters), '-frames:v', '1', f'{stem}.png'])
-        run(*args + [','.join(filters + [palette]), '-loop', '-1', output])
-        return
-
-    # Video --> webp: make an animation from the middle 10 seconds of a video,
-    # and a poster image from the start of that clip.
-    if asset.is_video and ext == 'webp':
-        args = f'-ss {max(0, mid - 5)} -t 10 -an -vf'.split()
-        run(*args + [','.join(filters), '-frames:v', '1', f'{stem}.png'])
-        run(*args + [','.join(filters), '-codec:v', 'libwebp', output])
-        return
-
-    chains = _generate_chains(
-        use_video=asset.is_video or asset.is_photo,
-        use_audio=asset.is_video or asset.is_audio,
-        slices=slices,
-        filters=filters)
+    # Filters for each branch off of the base video and audio streams, grouped
+    # by the slices of the source that they read, and ffmpeg arguments for
+    # each output file.
+    windows = {}
+    args = []
+
+    def branch(kind, chain, start=None, duration=None):
+        pieces = slices if start is None else _window(slices, start, duration)
+        pending = windows.setdefault(tuple(pieces), dict(v=[], a=[]))
+        label = f'{kind}{sum(len(w[kind]) for w in windows.values())}'
+        pending[kind].append((chain, label))
+        return f'[{label}]'
+
+    for output, kwargs in outputs:
+        stem, ext = os.path.splitext(output)
+        ext = ext.strip('.').lower()
+        scale = [_scale(*kwargs['bbox'])] if 'bbox' in kwargs else []
+        fps = [f'fps={kwargs["fps"]}'] if 'fps' in kwargs else []
+        tier = kwargs.get('tier', 'balanced')
+        opts = []
+        for attr in 'ar ac crf quality speed'.split():
+            if attr in kwargs:
+                opts.extend((f'-{attr}', f'{kwargs[attr]}'))
+
+        # Audio --> png: make a spectrogram image of the middle 60 seconds.
+        if asset.is_audio and ext == 'png':
+            w, h = kwargs['bbox']
+            start = max(0, mid - 30)
+            spec = f'showspectrumpic=s={w}x{h}:color=viridis:scale=log:fscale=log'
+            label = branch('a', [spec], start, min(dur, mid + 30) - start)
+            args.extend(['-map', label] + opts + [output])
+            continue
+
+        # Video --> gif/webp: make an animation from the middle 10 seconds of a
+        # video, and a poster image from the start of that clip.
+        if asset.is_video and ext in ('gif', 'webp'):
+            clip = scale + fps
+            poster = branch('v', clip, max(0, mid - 5), 10)
+            args.extend(['-map', poster, '-frames:v', '1'] + opts + [f'{stem}.png'])
+            if ext == 'gif':
+                n = len(args)
+                clip = clip + [f'split[u{n}][q{n}];[q{n}]palettegen[p{n}];'
+                               f'[u{n}][p{n}]paletteuse']
+                anim = ['-loop', '-1']
+            else:
+                anim = encoder_args('webp', tier)
+            args.extend(['-map', branch('v', clip, max(0, mid - 5), 10)] +
+                        anim + opts + [output])
+            continue
+
+        maps = []
+        if use_video and ext not in _AUDIO_EXTS:
+            maps.extend(('-map', branch('v', scale + fps)))
+        if use_audio and ext not in _IMAGE_EXTS:
+            maps.extend(('-map', branch('a', [])))
+        if 'abr' in kwargs:
+            opts.extend(('-b:a', f'{kwargs["abr"]}k'))
+        if 'vbr' in kwargs:
+            opts.extend(('-b:v', f'{kwargs["vbr"]}k'))
+        # Formatting arguments come after the tier's, so they take precedence.
+        args.extend(maps + encoder_args(ext, tier) + opts +
+                    ['-avoid_negative_ts', '1', '-g', '240', output])
+
+    threads = str(budget.threads())
+    inputs, count, chains = [], 0, []
+    for n, (pieces, pending) in enumerate(windows.items()):
+        # Seeking before an input skips decoding up to the slice; ffmpeg then
+        # decodes from the preceding keyframe and drops frames up to the start.
+        first = count
+        for start, duration in pieces or [(None, None)]:
+            if start is not None:
+                inputs.extend(('-ss', f'{start}', '-t', f'{duration}'))
+            inputs.extend(('-threads', threads, '-i', source))
+            count += 1
+        base, video, audio = _base_graph(
+            range(first, count), use_video and bool(pending['v']),
+            use_audio and bool(pending['a']), filters, f's{n}')
+        chains.extend(base)
+
+        for kind, stream, null in (('v', video, 'null'), ('a', audio, 'anull')):
+            sources = [stream] * len(pending[kind])
+            if len(pending[kind]) > 1:
+                sources = [f'{label}in' for _, label in pending[kind]]
+                split = 'split' if kind == 'v' else 'asplit'
+                chains.append(f'[{stream}]{split}={len(sources)}' +
+                              ''.join(f'[{s}]' for s in sources))
+            for src, (chain, label) in zip(sources, pending[kind]):
+                chains.append(f'[{src}]{",".join(chain) or null}[{label}]')
 
     with tempfile.NamedTemporaryFile(mode='w+') as script:
-        pads, video_pad, audio_pad = (), '0:v?', '0:a?'
-
-        for inputs, chain, outputs in chains:
-            if pads:
-                script.write(';\n')
-            script.write(''.join(f'[{i}]' for i in inputs))
-            script.write(','.join(chain))
-            script.write(''.join(f'[{o}]' for o in outputs))
-            pads = outputs
-            for p in pads:
-                if p.endswith('v'):
-                    video_pad = f'[{p}]'
-                if p.endswith('a'):
-                    audio_pad = f'[{p}]'
-
+        script.write(';\n'.join(chains))
         script.flush()
         if _DEBUG:
             print('-------->8-------')
-            subprocess.run(['cat', script.name], capture_output=False)
+            print(';\n'.join(chains))
             print('-------8<--------')
-
-        args = []
-        if pads:
-            args.extend(('-filter_complex_script', script.name,
-                         '-map', video_pad,
-                         '-map', audio_pad))
-        if 'abr' in kwargs:
-            args.extend(('-b:a', f'{kwargs["abr"]}k'))
-        if 'vbr' in kwargs:
-            args.extend(('-b:v', f'{kwargs["vbr"]}k'))
-
-        run(*args + _ENCODER_ARGS.get(ext, '').split() +
-            ['-avoid_negative_ts', '1', '-g', '240', output])
+        cmd = ['ffmpeg', '-y',
+               '-threads', threads,
+               '-filter_threads', threads,
+               '-filter_complex_threads', threads] + inputs + [
+               '-threads', threads,
+               '-filter_complex_script', script.name] + args
+        if _DEBUG > 0:
+            click.echo('FFMPEG {}'.format(
+                click.style(' '.join(cmd), bold=True, fg='cyan')))
+        return subprocess.run(cmd, capture_output=_DEBUG == 0)
 
 
 def convert_to_wav(path, sample_rate, output):
-    cmd = ['ffmpeg', '-y', '-i', path, '-ac', '1', '-ar', str(sample_rate), output]
+    cmd = ['ffmpeg', '-y', '-threads', str(budget.threads()), '-i', path,
+           '-ac', '1', '-ar', str(sample_rate), output]
     if _DEBUG > 0:
         click.echo('FFMPEG {}'.format(
             click.style(' '.join(cmd), bold=True, fg='cyan')))
@@ -321,7 +577,33 @@ def convert_to_wav(path, sample_rate, output):
 
 
 def extract_frame(path, time, output):
-    cmd = ['ffmpeg', '-y', '-ss', str(time), '-i', path, '-frames:v', '1', output]
+    cmd = ['ffmpeg', '-y', '-threads', str(budget.threads()), '-ss', str(time),
+           '-i', path, '-frames:v', '1', output]
+    if _DEBUG > 0:
+        click.echo('FFMPEG {}'.format(
+            click.style(' '.join(cmd), bold=True, fg='cyan')))
+    return subprocess.run(cmd, capture_output=_DEBUG == 0)
+
+
+def make_proxy(path, output, bbox):
+    '''Write a low-resolution copy of a video that is quick to decode and seek.
+
+    Parameters
+    ----------
+    path : str
+        Path of the source video.
+    output : str
+        Path for the proxy, an mp4 file.
+    bbox : (int, int)
+        Bounding box for the proxy's frames.
+    '''
+    # Short keyframe intervals make seeking to any clip cheap.
+    args = encoder_args('mp4', 'fast')
+    if 'libx264' in args:
+        args += ['-tune', 'fastdecode']
+    cmd = ['ffmpeg', '-y', '-threads', str(budget.threads()), '-i', path,
+           '-vf', f'{_scale(*bbox)}:force_divisible_by=2'] + args + [
+           '-g', '12', '-b:a', '96k', output]
     if _DEBUG > 0:
         click.echo('FFMPEG {}'.format(
             click.style(' '.join(cmd), bold=True, fg='cyan')))
@@ -1,4 +1,5 @@
 import click
+import collections
 import numpy as np
 import PIL.Image
 import sqlalchemy
@@ -39,7 +40,8 @@ class Hash(db.Model):
     asset = sqlalchemy.orm.relationship(
         'Asset',
         backref=sqlalchemy.orm.backref(
-            'hashes', lazy=False, cascade='delete', collection_class=set),
+            'hashes', lazy='select', cascade='delete', passive_deletes=True,
+            collection_class=set),
         lazy='selectin', collection_class=set)
 
     def __repr__(self):
@@ -139,6 +141,18 @@ class Hash(db.Model):
         return dict(nibbles=self.nibbles, method=self.method, time=self.time)
 
 
+db.track_writes(Hash.__table__)
+
+
+class HashRecord(collections.namedtuple('HashRecord', 'nibbles method time')):
+    '''A read-only hash value, for use with :class:`AssetRecord`.'''
+
+    __slots__ = ()
+
+    __repr__ = Hash.__repr__
+    to_dict = Hash.to_dict
+
+
 # a map from each hex digit to the hex digits that differ in 1 bit.
 _HEX_NEIGHBORS = {'0': '1248', '1': '0359', '2': '306a', '3': '217b',
                   '4': '560c', '5': '471d', '6': '742e', '7': '653f',
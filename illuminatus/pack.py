@@ -0,0 +1,310 @@
+import contextlib
+import fcntl
+import functools
+import os
+import sqlite3
+import threading
+import time
+
+# Directory under the thumbnails root for packed renders. The store is
+# optional: it's used once this directory exists, e.g. after running
+# "illuminatus pack".
+PACK_DIR = '.pack'
+
+# Segments are sealed, and a new one started, once they reach this size.
+SEGMENT_SIZE = 1 << 30
+
+
+def _copy(src, dst, offset, size):
+    '''Copy a byte range from one file descriptor to the end of another.'''
+    while size > 0:
+        try:
+            # Copy in the kernel where we can (Linux); elsewhere read it.
+            n = os.sendfile(dst, src, offset, size)
+        except OSError:
+            n = os.write(dst, os.pread(src, min(size, 1 << 20), offset))
+        if n == 0:
+            raise EOFError(f'{size} bytes missing at offset {offset}')
+        offset += n
+        size -= n
+
+
+def _keyed(keys):
+    '''Get index name ranges for all renders (exports and posters) of keys.'''
+    return [(f'{key}.', f'{key}/') for key in keys]
+
+
+class Store:
+    '''Many renders packed into a few append-only segment files.
+
+    An SQLite index maps the name of each render to its segment, offset, size
+    and modification time. Entries that are replaced or removed leave garbage
+    in their segments until :meth:`compact` rewrites them.
+
+    Parameters
+    ----------
+    root : str
+        Root directory for thumbnails.
+    segment_size : int, optional
+        Size in bytes at which segments are sealed.
+    '''
+
+    def __init__(self, root, segment_size=SEGMENT_SIZE):
+        self.dir = os.path.join(root, PACK_DIR)
+        self.segment_size = segment_size
+        self._local = threading.local()
+        os.makedirs(self.dir, exist_ok=True)
+        with self._db() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS entries (
+                              name TEXT PRIMARY KEY,
+                              segment INTEGER NOT NULL,
+                              offset INTEGER NOT NULL,
+                              size INTEGER NOT NULL,
+                              mtime INTEGER NOT NULL)''')
+            db.execute('CREATE INDEX IF NOT EXISTS entries_segment ON entries (segment)')
+
+    def _db(self):
+        # SQLite connections can't be shared between threads.
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(
+                os.path.join(self.dir, 'index.db'), timeout=60)
+            db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    def _segment_path(self, segment):
+        return os.path.join(self.dir, f'{segment:06d}.seg')
+
+    def segments(self):
+        '''Get the numbers of all segment files, in order.'''
+        return sorted(int(n.split('.')[0]) for n in os.listdir(self.dir)
+                      if n.endswith('.seg'))
+
+    def find(self, name):
+        '''Get the segment path, offset, size and mtime (in ns) of a render.
+
+        Returns None if the render isn't in the store.
+        '''
+        row = self._db().execute(
+            'SELECT segment, offset, size, mtime FROM entries WHERE name = ?',
+            (name, )).fetchone()
+        return row and (self._segment_path(row[0]), ) + row[1:]
+
+    def open(self, name):
+        '''Open the segment holding a render, positioned at its start.
+
+        Returns
+        -------
+        A tuple of the open file, the render's size and its mtime (in ns), or
+        None if the render isn't in the store.
+        '''
+        for _ in range(2):
+            entry = self.find(name)
+            if entry is None:
+                return None
+            path, offset, size, mtime = entry
+            try:
+                handle = open(path, 'rb')
+            except FileNotFoundError:
+                # Compacted since we looked it up; it has moved.
+                continue
+            handle.seek(offset)
+            return handle, size, mtime
+        return None
+
+    def extract(self, key, stem):
+        '''Copy all renders for a key out of the store, to paths with a stem.
+
+        Returns
+        -------
+        The number of files copied.
+        '''
+        rows = []
+        for name in self.names(key):
+            entry = self.find(name)
+            # Skip renders removed since we listed them.
+            if entry is not None:
+                rows.append(entry + (name, ))
+        for path, offset, size, _, name in rows:
+            os.makedirs(os.path.dirname(stem), exist_ok=True)
+            target = stem + os.path.splitext(name)[1]
+            src = os.open(path, os.O_RDONLY)
+            dst = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                _copy(src, dst, offset, size)
+            finally:
+                os.close(src)
+                os.close(dst)
+        return len(rows)
+
+    def names(self, key):
+        '''Get the names of all renders for a key.'''
+        (lo, hi), = _keyed([key])
+        return [name for name, in self._db().execute(
+            'SELECT name FROM entries WHERE name >= ? AND name < ?', (lo, hi))]
+
+    def touch(self, keys):
+        '''Set the modification time of all renders for some keys to now.'''
+        now = time.time_ns()
+        with self._db() as db:
+            db.executemany(
+                'UPDATE entries SET mtime = ? WHERE name >= ? AND name < ?',
+                [(now, lo, hi) for lo, hi in _keyed(keys)])
+
+    def remove(self, keys):
+        '''Remove all renders for some keys from the index.'''
+        with self._db() as db:
+            db.executemany('DELETE FROM entries WHERE name >= ? AND name < ?',
+                           _keyed(keys))
+
+    def collect(self, keep, min_age):
+        '''Remove renders that are no longer used from the index.
+
+        Parameters
+        ----------
+        keep : set of str
+            Keys of renders that are in use.
+        min_age : float
+            Keep unused renders modified less than this many seconds ago.
+
+        Returns
+        -------
+        The number of renders removed.
+        '''
+        cutoff = time.time_ns() - int(min_age * 1e9)
+        db = self._db()
+        stale = [name for name, mtime in db.execute('SELECT name, mtime FROM entries')
+                 if name.split('.')[0] not in keep and mtime < cutoff]
+        with db:
+            db.executemany('DELETE FROM entries WHERE name = ?', [(n, ) for n in stale])
+        return len(stale)
+
+    @contextlib.contextmanager
+    def _writing(self):
+        '''Hold the lock that allows one process at a time to write segments.'''
+        with open(os.path.join(self.dir, 'lock'), 'w') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _append(self, entries):
+        '''Append byte ranges of files to the store's last segment(s).
+
+        Parameters
+        ----------
+        entries : iterable of (str, str, int, int, int)
+            The name, source path, offset, size and mtime of each render.
+
+        Returns
+        -------
+        Index rows for the appended renders. Their bytes are on disk, so it's
+        safe to commit the rows.
+        '''
+        rows, out = [], None
+        segment = (self.segments() or [1])[-1]
+        try:
+            for name, path, offset, size, mtime in entries:
+                if out is None:
+                    out = os.open(self._segment_path(segment),
+                                  os.O_WRONLY | os.O_CREAT, 0o644)
+                start = os.lseek(out, 0, os.SEEK_END)
+                if start >= self.segment_size:
+                    # Seal this segment and start another.
+                    os.fsync(out)
+                    os.close(out)
+                    segment += 1
+                    out = os.open(self._segment_path(segment),
+                                  os.O_WRONLY | os.O_CREAT, 0o644)
+                    start = 0
+                src = os.open(path, os.O_RDONLY)
+                try:
+                    _copy(src, out, offset, size)
+                finally:
+                    os.close(src)
+                rows.append((name, segment, start, size, mtime))
+        finally:
+            if out is not None:
+                os.fsync(out)
+                os.close(out)
+        return rows
+
+    def add(self, paths):
+        '''Move render files into the store.
+
+        Parameters
+        ----------
+        paths : iterable of str
+            Paths of render files. Each is indexed under its base name, and
+            removed once it's safely in the store.
+
+        Returns
+        -------
+        The number of files added.
+        '''
+        paths = list(paths)
+        with self._writing():
+            entries = []
+            for path in paths:
+                stat = os.stat(path)
+                entries.append((os.path.basename(path), path, 0,
+                                stat.st_size, stat.st_mtime_ns))
+            rows = self._append(entries)
+            with self._db() as db:
+                db.executemany(
+                    'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', rows)
+        for path in paths:
+            os.unlink(path)
+        return len(rows)
+
+    def compact(self, min_garbage=0.5):
+        '''Rewrite segments whose space is mostly taken by removed renders.
+
+        Parameters
+        ----------
+        min_garbage : float, optional
+            Rewrite sealed segments with at least this fraction of garbage.
+
+        Returns
+        -------
+        The number of bytes reclaimed.
+        '''
+        reclaimed = 0
+        with self._writing():
+            db = self._db()
+            live = dict(db.execute(
+                'SELECT segment, SUM(size) FROM entries GROUP BY segment'))
+            for segment in self.segments()[:-1]:
+                path = self._segment_path(segment)
+                total = os.path.getsize(path)
+                if total - live.get(segment, 0) < min_garbage * total:
+                    continue
+                rows = db.execute(
+                    'SELECT name, offset, size, mtime FROM entries WHERE segment = ?',
+                    (segment, )).fetchall()
+                moved = self._append((name, path, offset, size, mtime)
+                                     for name, offset, size, mtime in rows)
+                updates = []
+                for (name, new, start, _, _), (_, old, _, _) in zip(moved, rows):
+                    updates.append((new, start, name, segment, old))
+                with db:
+                    # Entries that were removed or replaced meanwhile stay so.
+                    db.executemany(
+                        'UPDATE entries SET segment = ?, offset = ? '
+                        'WHERE name = ? AND segment = ? AND offset = ?', updates)
+                os.unlink(path)
+                reclaimed += total - live.get(segment, 0)
+        return reclaimed
+
+
+def store(root):
+    '''Get the packed store under a thumbnails root, or None if there isn't one.'''
+    if os.path.isdir(os.path.join(root, PACK_DIR)):
+        return _store(root)
+    return None
+
+
+@functools.lru_cache()
+def _store(root):
+    return Store(root)
@@ -0,0 +1,283 @@
+import concurrent.futures
+import functools
+import io
+import json
+import math
+import numpy as np
+import os
+import PIL.Image
+import PIL.ImageEnhance
+import PIL.ImageOps
+import tempfile
+
+from . import budget
+from . import ffmpeg
+from .ffmpeg import _sigmoid
+
+# Pillow formats for output extensions that we can write in-process.
+FORMATS = dict(gif='GIF', jpeg='JPEG', jpg='JPEG', png='PNG', tif='TIFF',
+               tiff='TIFF', webp='WEBP')
+
+# Pillow formats that can't store an alpha channel.
+OPAQUE_FORMATS = ('JPEG',)
+
+
+def _crop(w, h, x, y):
+    return lambda img: img.crop((x, y, x + w, y + h))
+
+
+def _rotate(degrees):
+    def op(img):
+        return img.rotate(-degrees, resample=PIL.Image.BICUBIC, expand=True)
+    return op
+
+
+def _transpose(method):
+    def op(img):
+        return img.transpose(method)
+    return op
+
+
+def _resize(w, h):
+    return lambda img: img.resize((w, h), PIL.Image.LANCZOS)
+
+
+def _keep_alpha(op):
+    '''Wrap a color operation so that it leaves an image's alpha channel alone.'''
+    @functools.wraps(op)
+    def wrapped(img):
+        if img.mode != 'RGBA':
+            return op(img)
+        out = op(img.convert('RGB')).convert('RGBA')
+        out.putalpha(img.getchannel('A'))
+        return out
+    return wrapped
+
+
+def _luma(fn):
+    '''Apply a function to the luma plane of an image, as ffmpeg's hue does.'''
+    @_keep_alpha
+    def op(img):
+        y, cb, cr = img.convert('YCbCr').split()
+        return PIL.Image.merge('YCbCr', (fn(y), cb, cr)).convert('RGB')
+    return op
+
+
+def _brightness(percent):
+    offset = (percent / 100 - 1) * 25.5
+    return _luma(lambda y: y.point(lambda v: v + offset))
+
+
+def _hue(degrees):
+    '''Rotate chroma by an angle, like ffmpeg's hue=h filter.'''
+    @_keep_alpha
+    def op(img):
+        ycc = np.asarray(img.convert('YCbCr'), float)
+        u, v = ycc[..., 1] - 128, ycc[..., 2] - 128
+        c, s = math.cos(math.radians(degrees)), math.sin(math.radians(degrees))
+        ycc[..., 1], ycc[..., 2] = u * c - v * s + 128, u * s + v * c + 128
+        ycc = np.clip(ycc, 0, 255).astype(np.uint8)
+        return PIL.Image.fromarray(ycc, 'YCbCr').convert('RGB')
+    return op
+
+
+def _curve(points):
+    '''Map all channels through a curve given as "x/y ..." control points.'''
+    xs, ys = zip(*(map(float, p.split('/')) for p in points.split()))
+    lut = np.interp(np.arange(256) / 255, xs, ys) * 255
+    lut = list(np.clip(lut, 0, 255).round().astype(int)) * 3
+    return _keep_alpha(lambda img: img.point(lut))
+
+
+def _equalize(strength):
+    @_keep_alpha
+    def op(img):
+        return PIL.Image.blend(img, PIL.ImageOps.equalize(img), min(1, strength))
+    return op
+
+
+# Image operations for each step of a compiled filter graph, matching the
+# ffmpeg filters in :data:`ffmpeg._FILTERS`. Time-based steps (fps, ...)
+# don't apply to still images, so they're missing here.
+_OPERATIONS = dict(
+    autocontrast=lambda percent: _equalize(percent / 100),
+    brightness=_brightness,
+    contrast=lambda percent: _curve(_sigmoid(percent / 100)),
+    crop=_crop,
+    hflip=lambda: _transpose(PIL.Image.FLIP_LEFT_RIGHT),
+    hue=_hue,
+    rotate=_rotate,
+    saturation=lambda percent: _keep_alpha(
+        lambda img: PIL.ImageEnhance.Color(img).enhance(percent / 100)),
+    scale=_resize,
+    transpose=lambda: _transpose(PIL.Image.TRANSPOSE),
+    vflip=lambda: _transpose(PIL.Image.FLIP_TOP_BOTTOM),
+)
+
+
+@functools.lru_cache(maxsize=1024)
+def _steps_to_operations(steps):
+    return tuple(_OPERATIONS[name](**dict(args)) for name, args in steps
+                 if name in _OPERATIONS)
+
+
+def _operations(asset, width, height, filters=None):
+    '''Convert an asset's filters to a list of image operations.
+
+    Parameters
+    ----------
+    asset : :class:`Asset`
+        Asset to use for filters and orientation.
+    width : int
+        Width in pixels of the image being filtered.
+    height : int
+        Height in pixels of the image being filtered.
+    filters : str, optional
+        JSON-encoded filters to use in place of the asset's own.
+
+    Returns
+    -------
+    ops : tuple of callable
+        Operations that each take and return a :class:`PIL.Image.Image`.
+    size : (int, int)
+        Width and height of the result.
+    '''
+    compiled = ffmpeg.graph(asset, (width, height), filters)
+    return _steps_to_operations(compiled.steps), compiled.size
+
+
+def _fit(w, h, bbox):
+    '''Get the scale that fits a w x h image into a bounding box, if any.'''
+    return min(bbox[0] / w, bbox[1] / h) if bbox else 1
+
+
+def _extension(path):
+    return os.path.splitext(path)[1].strip('.').lower()
+
+
+def render(asset, outputs):
+    '''Render several exports of a photo from a single decode of the source.
+
+    Parameters
+    ----------
+    asset : :class:`Asset`
+        A photo asset.
+    outputs : list of (str, dict)
+        Output paths and formatting arguments for each export, as would be
+        passed to :func:`ffmpeg.run_all`.
+
+    Returns
+    -------
+    A list of the (output, kwargs) pairs that could not be rendered here,
+    either because Pillow can't write the output format or can't read the
+    source. These should be rendered with :func:`ffmpeg.run_all`.
+    '''
+    ours = [(o, kw) for o, kw in outputs if _extension(o) in FORMATS]
+    if not ours:
+        return outputs
+    try:
+        img = PIL.Image.open(asset.path)
+    except (OSError, PIL.UnidentifiedImageError):
+        return outputs
+
+    with img:
+        _, (w, h) = _operations(asset, *img.size)
+
+        # Only decode as many pixels as the largest output needs. For JPEGs,
+        # this lets the decoder skip most of the work for small thumbnails.
+        scale = max(_fit(w, h, kw.get('bbox')) for _, kw in ours)
+        if scale < 1:
+            img.draft('RGB', (math.ceil(img.width * scale),
+                              math.ceil(img.height * scale)))
+        # Keep transparency for outputs that can store it.
+        alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+        if alpha and any(FORMATS[_extension(o)] not in OPAQUE_FORMATS for o, _ in ours):
+            img = img.convert('RGBA')
+        else:
+            img = img.convert('RGB')
+
+    # Filter geometry is in pixels, so compile again for the decoded size.
+    ops, _ = _operations(asset, *img.size)
+    for op in ops:
+        img = op(img)
+
+    def save(output, kwargs):
+        out = img
+        if kwargs.get('bbox'):
+            s = _fit(*img.size, kwargs['bbox'])
+            out = img.resize((max(1, round(img.width * s)),
+                              max(1, round(img.height * s))), PIL.Image.LANCZOS)
+        fmt = FORMATS[_extension(output)]
+        if fmt in OPAQUE_FORMATS and out.mode != 'RGB':
+            out = out.convert('RGB')
+        options = {}
+        if fmt in ('JPEG', 'WEBP'):
+            options['quality'] = int(kwargs.get('quality', 90))
+        out.save(output, fmt, **options)
+
+    # Pillow releases the GIL while resizing and encoding, so outputs can be
+    # written in parallel, up to the job's share of the CPU budget.
+    with concurrent.futures.ThreadPoolExecutor(budget.threads()) as pool:
+        for future in [pool.submit(save, o, kw) for o, kw in ours]:
+            future.result()
+
+    return [(o, kw) for o, kw in outputs if (o, kw) not in ours]
+
+
+@functools.lru_cache(maxsize=16)
+def _decode(path, mtime, size, time=None):
+    '''Decode a photo, or a frame of a video, to fit in a square of some size.
+
+    The mtime argument is only used as part of the cache key, so that the
+    source is decoded again if the file changes.
+    '''
+    if time is None:
+        img = PIL.Image.open(path)
+        img.draft('RGB', (size, size))
+    else:
+        with tempfile.NamedTemporaryFile(suffix='.png') as ntf:
+            ffmpeg.extract_frame(path, time, ntf.name)
+            img = PIL.Image.open(ntf.name)
+            img.load()
+    img = img.convert('RGB')
+    img.thumbnail((size, size), PIL.Image.LANCZOS)
+    return img
+
+
+def preview(asset, filters, size=480, source=None):
+    '''Render a quick preview of a photo or video with a stack of filters.
+
+    Sources are decoded at a reduced size and cached in memory, so that
+    previews of successive edits only need to apply the filters.
+
+    Parameters
+    ----------
+    asset : :class:`Asset`
+        A photo or video asset.
+    filters : list of dict
+        Filters to apply, in place of the asset's own.
+    size : int, optional
+        Maximum width and height of the preview, in pixels.
+    source : str, optional
+        Path of media to read in place of the asset's own, such as a video's
+        low-resolution proxy.
+
+    Returns
+    -------
+    The preview, as JPEG data.
+    '''
+    source = source or asset.path
+    # Keep some extra resolution around, so that crops still look sharp.
+    img = _decode(source, os.stat(source).st_mtime_ns, 2 * size,
+                  (asset.duration or 0) / 2 if asset.is_video else None)
+    ops, _ = _operations(asset, *img.size, filters=json.dumps(filters))
+    for op in ops:
+        img = op(img)
+    # Resize to a new image, rather than in place, to leave the cache intact.
+    scale = _fit(*img.size, (size, size))
+    if scale < 1:
+        img = img.resize((max(1, round(img.width * scale)),
+                          max(1, round(img.height * scale))), PIL.Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=80)
+    return buf.getvalue()
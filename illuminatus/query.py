@@ -1,12 +1,86 @@
+import array
 import arrow
+import collections
+import contextlib
+import functools
+import math
 import parsimonious.grammar
 import sqlalchemy
+import time
 
-from .assets import Asset, asset_tags
-from .hashes import Hash
+from .assets import Asset, AssetRecord
+from .assets import asset_locations, asset_tags, asset_text, tag_counts
+from .hashes import Hash, HashRecord
 from .tags import Tag
 
 
+# Cumulative seconds and call counts for query parsing and execution.
+TIMINGS = collections.Counter()
+
+
+@contextlib.contextmanager
+def timed(name):
+    '''Time a block of code, accumulating the result in :data:`TIMINGS`.
+
+    Parameters
+    ----------
+    name : str
+        Name of the timing counter, e.g. "parse" or "execute".
+
+    Yields
+    ------
+    A dictionary; its "seconds" key holds the elapsed time after the block.
+    '''
+    span = dict(seconds=0.0)
+    start = time.perf_counter()
+    try:
+        yield span
+    finally:
+        span['seconds'] = time.perf_counter() - start
+        TIMINGS[f'{name}_seconds'] += span['seconds']
+        TIMINGS[f'{name}_calls'] += 1
+
+
+def stats():
+    '''Get query timing counters and parse cache statistics.'''
+    return dict(TIMINGS, parse_cache=_parse.cache_info()._asdict())
+
+
+# Named strategies for loading asset relationships and columns, so that each
+# caller of :func:`assets` loads only the data it actually uses. Mappers need
+# to be configured first so that backref attributes like Asset.hashes exist.
+_orm = sqlalchemy.orm
+_orm.configure_mappers()
+LOAD_PROFILES = {
+    # Everything about each asset, e.g. for display or serialization.
+    'detail': (
+        _orm.selectinload(Asset._tags),
+        _orm.selectinload(Asset.hashes),
+    ),
+    # Browsing assets: tags and basic columns, other data only on access.
+    'listing': (
+        _orm.selectinload(Asset._tags),
+        _orm.lazyload(Asset.hashes),
+        _orm.defer(Asset.caption),
+        _orm.defer(Asset.filters),
+    ),
+    # Modifying or deleting assets: hashes and labels are never touched (and
+    # deletes cascade in the database), so don't load them at all.
+    'bulk-write': (
+        _orm.selectinload(Asset._tags),
+        _orm.noload(Asset.hashes),
+        _orm.noload(Asset.labels),
+        _orm.defer(Asset.caption),
+        _orm.defer(Asset.filters),
+    ),
+    # Just enough to identify assets and dispatch tasks for them.
+    'ids-only': (
+        _orm.load_only(Asset.id, Asset.slug, Asset.medium),
+        _orm.lazyload('*'),
+    ),
+}
+
+
 def parse_order(order):
     '''Parse an ordering string into a SQL alchemy ordering spec.'''
     if order.lower().startswith('rand'):
@@ -19,6 +93,44 @@ def parse_order(order):
     return how.desc() if descending else how
 
 
+def _text_search(value, *columns):
+    '''Select ids of assets containing a substring in any of the given columns.'''
+    if len(value) < 3:
+        # Trigrams can't match shorter strings, so scan with LIKE instead.
+        condition = sqlalchemy.or_(*(
+            asset_text.c[c].contains(value, autoescape=True) for c in columns))
+    else:
+        phrase = '"{}"'.format(value.replace('"', '""'))
+        condition = sqlalchemy.literal_column('asset_text').op('MATCH')(
+            '{{{}}} : {}'.format(' '.join(columns), phrase))
+    return sqlalchemy.sql.select([asset_text.c.rowid]).where(condition)
+
+
+def _lng_ranges(lng1, lng2):
+    '''Split a range of longitudes into ranges inside [-180, 180].
+
+    A range reaching past the antimeridian, e.g. from 170 to 190, wraps
+    around to the other side: here, 170 to 180 and -180 to -170.
+    '''
+    lo, hi = min(lng1, lng2), max(lng1, lng2)
+    if hi - lo >= 360:
+        return [(-180, 180)]
+    shift = 360 * math.floor((lo + 180) / 360)
+    lo, hi = lo - shift, hi - shift
+    if hi <= 180:
+        return [(lo, hi)]
+    return [(lo, 180), (-180, hi - 360)]
+
+
+def _within(lat1, lng1, lat2, lng2):
+    '''Select ids of assets located inside a latitude/longitude box.'''
+    loc = asset_locations.c
+    return sqlalchemy.sql.select([loc.id]).where(
+        (loc.max_lat >= min(lat1, lat2)) & (loc.min_lat <= max(lat1, lat2)) &
+        sqlalchemy.or_(*((loc.max_lng >= lo) & (loc.min_lng <= hi)
+                         for lo, hi in _lng_ranges(lng1, lng2))))
+
+
 class QueryParser(parsimonious.NodeVisitor):
     '''Media can be queried using a special query syntax; we parse it here.
 
@@ -28,10 +140,14 @@ class QueryParser(parsimonious.NodeVisitor):
     grammar = parsimonious.Grammar(r'''
     query    = union ( __ ( not __ )? union )*
     union    = set ( __ or __ set )*
-    set      = !not !or ( group / stamp / path / slug / hash / medium / tag )
+    set      = !not !or ( group / stamp / path / text / near / bbox / slug / hash /
+                          medium / tag )
     group    = '(' _ query _ ')'
     stamp    = ~r'(before|during|after):[-\d]+'
     path     = ~r'path:\S+'
+    text     = ~r'text:\S+'
+    near     = ~r'near:(-?\d*\.?\d+),(-?\d*\.?\d+),(\d*\.?\d+)'
+    bbox     = ~r'bbox:(-?\d*\.?\d+),(-?\d*\.?\d+),(-?\d*\.?\d+),(-?\d*\.?\d+)'
     slug     = ~r'slug:[-\w]+'
     hash     = ~r'hash:[-=\w]+'
     medium   = ~r'(photo|video|audio)'
@@ -46,6 +162,12 @@ class QueryParser(parsimonious.NodeVisitor):
         super().__init__()
         self.sess = sess
 
+    def parse(self, text):
+        '''Parse query text and build a selection of matching asset ids.'''
+        with timed('parse'):
+            tree = _parse(text)
+        return self.visit(tree)
+
     def generic_visit(self, node, children):
         return children or node.text
 
@@ -83,7 +205,28 @@ class QueryParser(parsimonious.NodeVisitor):
             Asset.stamp.startswith(value))
 
     def visit_path(self, node, children):
-        return self.sess.query(Asset.id).filter(Asset.path.contains(node.text[5:]))
+        return _text_search(node.text[5:], 'path')
+
+    def visit_text(self, node, children):
+        return _text_search(node.text[5:], 'path', 'caption')
+
+    def visit_near(self, node, children):
+        lat, lng, km = (float(x) for x in node.match.groups())
+        # Bound the search circle with a box, then refine by exact distance.
+        dlat = km / 111.2
+        dlng = min(180, km / (111.2 * max(1e-6, math.cos(math.radians(lat)))))
+        within = _within(lat - dlat, lng - dlng, lat + dlat, lng + dlng)
+        return self.sess.query(Asset.id).filter(
+            Asset.id.in_(within),
+            sqlalchemy.func.distance(lat, lng, Asset.lat, Asset.lng) <= km)
+
+    def visit_bbox(self, node, children):
+        lat1, lng1, lat2, lng2 = (float(x) for x in node.match.groups())
+        return self.sess.query(Asset.id).filter(
+            Asset.id.in_(_within(lat1, lng1, lat2, lng2)),
+            Asset.lat.between(min(lat1, lat2), max(lat1, lat2)),
+            sqlalchemy.or_(*(Asset.lng.between(lo, hi)
+                             for lo, hi in _lng_ranges(lng1, lng2))))
 
     def visit_slug(self, node, children):
         return self.sess.query(Asset.id).filter(Asset.slug.startswith(node.text[5:]))
@@ -105,7 +248,17 @@ class QueryParser(parsimonious.NodeVisitor):
         return self.sess.query(Hash.asset_id).filter(condition)
 
 
-def assets(sess, query, order=None, limit=None, offset=None):
+@functools.lru_cache(maxsize=512)
+def _parse(text):
+    '''Parse query text into a syntax tree, memoizing recent queries.
+
+    Syntax trees don't depend on a database session, so they can be shared
+    and reused freely; only visiting a tree binds it to a session.
+    '''
+    return QueryParser.grammar.parse(text)
+
+
+def assets(sess, query, order=None, limit=None, offset=None, load=None):
     '''Find media assets matching a text query.
 
     Parameters
@@ -120,6 +273,10 @@ def assets(sess, query, order=None, limit=None, offset=None):
         Limit the number of returned assets.
     offset : int
         Start at this position in the asset list.
+    load : str
+        Name of a loading profile from :data:`LOAD_PROFILES`: "detail",
+        "listing", "bulk-write", or "ids-only". Defaults to the loading
+        strategies configured on the model.
 
     Returns
     -------
@@ -127,6 +284,8 @@ def assets(sess, query, order=None, limit=None, offset=None):
     '''
     query = ' '.join(query).strip()
     q = sess.query(Asset)
+    if load:
+        q = q.options(*LOAD_PROFILES[load])
     if query:
         q = q.filter(Asset.id.in_(QueryParser(sess).parse(query)))
     if order:
@@ -136,3 +295,201 @@ def assets(sess, query, order=None, limit=None, offset=None):
     if offset:
         q = q.offset(offset)
     return q
+
+
+# Asset columns selected for lightweight (non-ORM) result rows.
+ROW_COLUMNS = AssetRecord.FIELDS
+
+# Separator for tag names aggregated into a single row column.
+TAG_SEPARATOR = '\x1f'
+
+
+def _select_rows(sess, query, tags, order, limit, offset):
+    '''Select asset columns plus an aggregated tags column for a query.'''
+    tags = sqlalchemy.sql.select([
+        sqlalchemy.func.group_concat(tags, TAG_SEPARATOR)
+    ]).select_from(
+        asset_tags.join(Tag, asset_tags.c.tag_id == Tag.id)
+    ).where(asset_tags.c.asset_id == Asset.id).scalar_subquery()
+    q = sqlalchemy.sql.select(
+        [getattr(Asset, c) for c in ROW_COLUMNS] + [tags.label('tags')])
+    query = ' '.join(query).strip()
+    if query:
+        q = q.where(Asset.id.in_(QueryParser(sess).parse(query)))
+    if order:
+        q = q.order_by(parse_order(order))
+    if limit:
+        q = q.limit(limit)
+    if offset:
+        q = q.offset(offset)
+    return q
+
+
+def rows(sess, query, order=None, limit=None, offset=None):
+    '''Select columns of media assets matching a text query, without the ORM.
+
+    Parameters
+    ----------
+    sess : SQLAlchemy
+        Database session.
+    query : list of str
+        Get assets from the database matching these query clauses.
+    order : str
+        Order assets by this field.
+    limit : int
+        Limit the number of returned assets.
+    offset : int
+        Start at this position in the asset list.
+
+    Returns
+    -------
+      A Core select yielding rows with the :data:`ROW_COLUMNS` of each
+      matching asset, plus a "tags" column holding the asset's tag names
+      joined by :data:`TAG_SEPARATOR`.
+    '''
+    return _select_rows(sess, query, Tag.name, order, limit, offset)
+
+
+def records(sess, query, order=None, limit=None, offset=None, hashes=False):
+    '''Find media assets matching a text query, as compact read-only records.
+
+    Parameters
+    ----------
+    sess : SQLAlchemy
+        Database session.
+    query : list of str
+        Get assets from the database matching these query clauses.
+    order : str
+        Order assets by this field.
+    limit : int
+        Limit the number of returned assets.
+    offset : int
+        Start at this position in the asset list.
+    hashes : bool
+        If True, also load the content hashes for each asset.
+
+    Returns
+    -------
+      A list of :class:`AssetRecord`s matching the query.
+    '''
+    names = dict(sess.query(Tag.id, Tag.name))
+    select = _select_rows(sess, query, Tag.id, order, limit, offset)
+    result = []
+    for row in sess.execute(select):
+        tags = row[-1]
+        tag_ids = array.array('l', map(int, tags.split(TAG_SEPARATOR)) if tags else ())
+        result.append(AssetRecord(row[:-1], tag_ids, names))
+    if hashes and result:
+        # Look hashes up by the ids we got; re-running the select could pick
+        # different rows (e.g. with a random order and a limit).
+        ids = [record.id for record in result]
+        by_asset = collections.defaultdict(list)
+        for i in range(0, len(ids), 500):
+            for aid, nibbles, method, time_ in sess.query(
+                    Hash.asset_id, Hash.nibbles, Hash.method, Hash.time
+            ).filter(Hash.asset_id.in_(ids[i:i + 500])):
+                by_asset[aid].append(HashRecord(nibbles, method, time_))
+        for record in result:
+            record.hashes = tuple(by_asset[record.id])
+    return result
+
+
+# Deepest zoom level for map tiles; tile coordinates beyond it would overflow
+# SQLite integers, and its tiles are already only a few centimeters wide.
+MAX_ZOOM = 30
+
+
+def tiles(sess, query, zoom):
+    '''Count geotagged assets matching a query in each map tile.
+
+    Parameters
+    ----------
+    sess : SQLAlchemy
+        Database session.
+    query : list of str
+        Count assets from the database matching these query clauses.
+    zoom : int
+        Zoom level for web mercator map tiles, from 0 to :data:`MAX_ZOOM`;
+        there are 2^zoom tiles along each axis.
+
+    Returns
+    -------
+      A list of dictionaries, one per non-empty tile, giving the tile "x" and
+      "y" coordinates, the "count" of assets in the tile, and the mean "lat"
+      and "lng" of those assets.
+    '''
+    if not 0 <= zoom <= MAX_ZOOM:
+        raise ValueError(f'Zoom {zoom} is outside 0-{MAX_ZOOM}')
+    n = 2 ** zoom
+    x = sqlalchemy.func.min(n - 1, sqlalchemy.cast(
+        (Asset.lng + 180) / 360 * n, sqlalchemy.Integer))
+    y = sqlalchemy.func.min(n - 1, sqlalchemy.cast(
+        sqlalchemy.func.mercator(Asset.lat) * n, sqlalchemy.Integer))
+    q = sess.query(x, y,
+                   sqlalchemy.func.count(Asset.id),
+                   sqlalchemy.func.avg(Asset.lat),
+                   sqlalchemy.func.avg(Asset.lng),
+                   ).filter(Asset.lat.isnot(None), Asset.lng.isnot(None))
+    query = ' '.join(query).strip()
+    if query:
+        q = q.filter(Asset.id.in_(QueryParser(sess).parse(query)))
+    return [dict(x=x, y=y, count=count, lat=lat, lng=lng)
+            for x, y, count, lat, lng in q.group_by(x, y)]
+
+
+# strftime formats for date histogram buckets.
+GRANULARITIES = dict(year='%Y', month='%Y-%m', day='%Y-%m-%d', hour='%Y-%m-%dT%H')
+
+
+def facets(sess, query, granularity='month'):
+    '''Count tags, media, and dates of assets matching a query.
+
+    Parameters
+    ----------
+    sess : SQLAlchemy
+        Database session.
+    query : list of str
+        Count assets from the database matching these query clauses.
+    granularity : str
+        Size of date histogram buckets: "year", "month", "day", or "hour".
+
+    Returns
+    -------
+      A dictionary with "tags", "media", and "dates" keys, each mapping to a
+      dictionary of counts keyed by tag name, medium, or date bucket.
+    '''
+    func = sqlalchemy.func
+    bucket = func.strftime(GRANULARITIES[granularity], Asset.stamp)
+    query = ' '.join(query).strip()
+    if query:
+        # Select the matching ids once, and group them every way in one pass.
+        ids = QueryParser(sess).parse(query).cte('ids')
+        aid = list(ids.c)[0]
+        select = sqlalchemy.sql.select
+        counts = sqlalchemy.union_all(
+            select([sqlalchemy.literal('tags'), asset_tags.c.tag_id, func.count()])
+            .select_from(asset_tags.join(ids, asset_tags.c.asset_id == aid))
+            .group_by(asset_tags.c.tag_id),
+            select([sqlalchemy.literal('media'), Asset.medium, func.count()])
+            .select_from(Asset.__table__.join(ids, Asset.id == aid))
+            .group_by(Asset.medium),
+            select([sqlalchemy.literal('dates'), bucket, func.count()])
+            .select_from(Asset.__table__.join(ids, Asset.id == aid))
+            .group_by(bucket))
+    else:
+        # Without a query, tag counts come straight from the tag_counts table.
+        counts = sqlalchemy.union_all(
+            sqlalchemy.sql.select([
+                sqlalchemy.literal('tags'), tag_counts.c.tag_id, tag_counts.c.count]),
+            sess.query(sqlalchemy.literal('media'), Asset.medium, func.count())
+            .group_by(Asset.medium).statement,
+            sess.query(sqlalchemy.literal('dates'), bucket, func.count())
+            .group_by(bucket).statement)
+
+    result = dict(tags={}, media={}, dates={})
+    for facet, key, count in sess.execute(counts):
+        if key is not None:
+            result[facet][key] = count
+    names = dict(sess.query(Tag.id, Tag.name).filter(Tag.id.in_(result['tags'])))
+    result['tags'] = {names[t]: count for t, count in result['tags'].items()}
+    return result
@@ -1,44 +1,168 @@
+import base64
 import collections
+import contextlib
+import fcntl
 import flask
+import functools
+import itertools
 import flask_sqlalchemy
 import glob
 import json
+import mimetypes
 import os
+import parsimonious
 import re
 import shutil
 import sqlalchemy
 import tempfile
-import urllib
+import time
+import urllib.parse
+import urllib.request
+import werkzeug.datastructures
 import yaml
+import zlib
 
 from . import assets
 from . import celery
+from . import db
 from . import importexport
+from . import pack
+from . import pillow
+from . import query as query_
+from . import similarity
+from . import snapshot
 from . import tags
+from . import usage
 
 from .query import assets as matching_assets
+from .query import tiles as matching_tiles
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = flask.Flask('illuminatus')
 sql = flask_sqlalchemy.SQLAlchemy()
 
 
+@app.errorhandler(parsimonious.exceptions.ParseError)
+def _bad_query(error):
+    return flask.jsonify(str(error)), 400
+
+
+def _snapshot():
+    path = app.config.get('snapshot')
+    return path and snapshot.load(path)
+
+
+@app.before_request
+def _use_snapshot():
+    snap = _snapshot()
+    if snap is not None and app.config.get('snapshot-installed') is not snap:
+        app.config['snapshot-installed'] = snap
+        similarity.install(snap.tag_index())
+
+
 def _get_asset(slug):
+    snap = _snapshot()
+    # A snapshot behind the database might miss assets sharing the prefix.
+    if (snap is not None and snap.generation is not None and
+            snap.generation == db.write_generation(sql.session)):
+        ids = snap.slug_ids(slug)
+        asset = len(ids) == 1 and sql.session.query(assets.Asset).get(ids[0])
+        if asset:
+            return asset
     return sql.session.query(assets.Asset).filter(
         assets.Asset.slug.startswith(slug)).one()
 
 
+def _asset_dict(asset):
+    '''Get an asset as a dict, with the version to use in its read URLs.'''
+    item = asset.to_dict()
+    item['version'] = asset.version(app.config['formats'])
+    return item
+
+
 def _json(items):
-    return flask.jsonify([item.to_dict() for item in items])
+    return flask.jsonify([_asset_dict(item) for item in items])
+
+
+def _dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def _encode_row(row):
+    '''Encode an asset row from :func:`query.rows` as a JSON object.'''
+    item = dict(row)
+    stamp = item['stamp']
+    item['stamp'] = stamp and stamp.isoformat() + '+00:00'
+    item['tags'] = item['tags'].split(query_.TAG_SEPARATOR) if item['tags'] else []
+    # Filters are stored as JSON already, so splice them in without parsing.
+    filters = item.pop('filters') or '[]'
+    item['version'] = assets.render_version(
+        [item[field] for field in assets.FINGERPRINT], filters,
+        app.config['formats'].get(item['medium']))
+    # File identity only keys renders; it isn't part of an asset's JSON.
+    del item['file_size'], item['file_mtime']
+    return f'{_dumps(item)[:-1]},"filters":{filters}}}'
+
+
+def _stream_json(rows, chunk_size=500):
+    '''Stream asset rows as a JSON list, encoding a chunk of rows at a time.'''
+    yield '['
+    sep = ''
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        yield sep + ','.join(_encode_row(row._mapping) for row in chunk)
+        sep = ','
+    yield ']'
 
 
 @app.route('/query/<path:query>')
 def query(query):
     get = flask.request.args.get
-    return _json(matching_assets(sql.session,
-                                 query.split('/'),
-                                 order=get('ord', 'stamp'),
-                                 limit=int(get('lim', 99999)),
-                                 offset=int(get('off', 0))).all())
+    with query_.timed('build') as build:
+        q = query_.rows(sql.session,
+                        query.split('/'),
+                        order=get('ord', 'stamp'),
+                        limit=int(get('lim', 99999)),
+                        offset=int(get('off', 0)))
+    with query_.timed('execute') as execute:
+        rows = sql.session.execute(q)
+    response = flask.Response(
+        flask.stream_with_context(_stream_json(rows)), mimetype='application/json')
+    response.headers['Server-Timing'] = ', '.join(
+        f'{name};dur={1000 * span["seconds"]:.1f}'
+        for name, span in (('build', build), ('execute', execute)))
+    return response
+
+
+@app.route('/stats/')
+def stats():
+    return flask.jsonify(query_.stats())
+
+
+@app.route('/tiles/<int:zoom>/')
+@app.route('/tiles/<int:zoom>/<path:query>')
+def tiles(zoom, query=''):
+    if zoom > query_.MAX_ZOOM:
+        flask.abort(400)
+    return flask.jsonify(matching_tiles(sql.session, query.split('/'), zoom))
+
+
+@app.route('/facets/')
+@app.route('/facets/<path:query>')
+def facets(query=''):
+    by = flask.request.args.get('by', 'month')
+    if by not in query_.GRANULARITIES:
+        flask.abort(400)
+    return flask.jsonify(query_.facets(sql.session, query.split('/'), by))
 
 
 @app.route('/export/<path:query>', methods=['POST'])
@@ -47,7 +171,7 @@ def export(query):
     dirname = tempfile.mkdtemp()
 
     importexport.Exporter(
-        matching_assets(sql.session, query.split('/')),
+        matching_assets(sql.session, query.split('/'), load='detail'),
         json.loads(get('formats')),
     ).run(
         output=os.path.join(dirname, f'{get("name").zip}'),
@@ -67,7 +191,7 @@ def export(query):
 
 @app.route('/asset/<string:slug>/', methods=['GET'])
 def get_asset(slug):
-    return flask.jsonify(_get_asset(slug).to_dict())
+    return flask.jsonify(_asset_dict(_get_asset(slug)))
 
 
 @app.route('/asset/<string:slug>/', methods=['PUT'])
@@ -78,7 +202,7 @@ def update_asset(slug):
         asset.update_stamp(stamp)
         asset.tags.discard('untouched')
         sql.session.commit()
-    return flask.jsonify(asset.to_dict())
+    return flask.jsonify(_asset_dict(asset))
 
 
 @app.route('/asset/<string:slug>/', methods=['DELETE'])
@@ -89,28 +213,214 @@ def delete_asset(slug):
     if trash and os.path.isdir(trash) and os.path.exists(asset.path):
         asset.move_to_trash(trash)
 
-    # Clean up any thumbnails for this asset.
-    thumbs = app.config['thumbnails']
-    for fn in glob.glob(asset.path_for_export(thumbs, '*', '*')):
-        os.unlink(fn)
+    _remove_exports(asset)
 
     sql.session.delete(asset)
     sql.session.commit()
     return flask.jsonify('ok')
 
 
+def _remove_exports(asset):
+    '''Remove the current thumbnails and the proxy for an asset.
+
+    Renders from earlier filters are left for :func:`assets.collect_renders`.
+    '''
+    thumbs = app.config['thumbnails']
+    paths = asset.renders(thumbs, app.config['formats']).values()
+    for path in paths:
+        for fn in glob.glob(os.path.splitext(path)[0] + '.*'):
+            os.unlink(fn)
+    store = pack.store(thumbs)
+    if store:
+        store.remove(_keys(paths))
+    if asset.is_video:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(asset.proxy_path(thumbs))
+
+
+def _keys(paths):
+    '''Get the render keys for some render paths.'''
+    return [os.path.basename(path).split('.')[0] for path in paths]
+
+
+# Exports requested with a "v" argument matching the asset's current version
+# never change, since the version is a hash of everything its renders depend
+# on -- source, filters and export formats; others have to be revalidated.
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+# Transparent 1x1 GIF, sent in place of thumbnails that are being rendered.
+PLACEHOLDER = base64.b64decode(
+    'R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
+
+# Seconds after which a queued export is assumed lost, and queued again.
+PENDING_TIMEOUT = 300
+
+
+def _placeholder():
+    response = flask.Response(PLACEHOLDER, mimetype='image/gif')
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['Retry-After'] = '2'
+    return response
+
+
+@contextlib.contextmanager
+def _render_lock(path, stripes=256):
+    '''Hold an exclusive lock, shared by all server processes, for a path.
+
+    Paths hash to one of a fixed number of lock files, so that concurrent
+    requests for one thumbnail wait for a single render to finish.
+    '''
+    locks = os.path.join(app.config['thumbnails'], '.locks')
+    os.makedirs(locks, exist_ok=True)
+    stripe = zlib.crc32(path.encode('utf-8')) % stripes
+    with open(os.path.join(locks, f'{stripe:03d}'), 'w') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def _renders_inline(asset, kwargs):
+    '''True if an export is quick enough to render while a client waits.'''
+    size = app.config.get('render-inline-max', 640)
+    return asset.is_photo and max(kwargs.get('bbox', [size + 1])) <= size
+
+
+def _render_missing(asset, fmt, path):
+    '''Render a missing export, or queue it to be rendered soon.
+
+    Returns
+    -------
+    The stat result for the rendered file, or None if it isn't ready yet.
+    '''
+    kwargs = dict(app.config['formats'][asset.medium][fmt])
+    # Video stills are written alongside the format's own export.
+    output = asset.path_for_render(app.config['thumbnails'], kwargs)
+    if _renders_inline(asset, kwargs):
+        with _render_lock(output):
+            if not os.path.exists(output):
+                asset.export(output, **kwargs)
+    else:
+        _queue_render(asset, output, kwargs)
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
+def _queue_render(asset, output, kwargs):
+    '''Queue a high-priority export, unless one is already pending.'''
+    marker = output + assets.PENDING_SUFFIX
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    with _render_lock(output):
+        try:
+            if time.time() - os.stat(marker).st_mtime < PENDING_TIMEOUT:
+                return
+        except FileNotFoundError:
+            pass
+        with open(marker, 'w'):
+            pass
+    celery.export.apply_async(
+        kwargs=dict(slug=asset.slug, output=output, **kwargs),
+        queue=asset.medium, priority=0)
+
+
+def _read_packed(asset, fmt, path):
+    '''Send a render from the packed store, if it's there.
+
+    Returns
+    -------
+    A response with the render's bytes, or a range of them, or None if the
+    store doesn't have the render.
+    '''
+    store = pack.store(app.config['thumbnails'])
+    opened = store and store.open(os.path.basename(path))
+    if not opened:
+        return None
+    handle, size, mtime = opened
+    start, length, status = handle.tell(), size, 200
+    span = flask.request.range and flask.request.range.range_for_length(size)
+    if flask.request.range and not span:
+        handle.close()
+        response = flask.Response(status=416)
+        response.headers['Content-Range'] = f'bytes */{size}'
+        return response
+    if span:
+        handle.seek(start + span[0])
+        length, status = span[1] - span[0], 206
+    wrapper = flask.request.environ.get('wsgi.file_wrapper')
+    if wrapper and app.config.get('pack-sendfile'):
+        # The server sends the file from its current position, stopping at
+        # the content length -- with sendfile(2) in the case of gunicorn.
+        body = wrapper(handle)
+    else:
+        def body():
+            remaining = length
+            while remaining > 0:
+                chunk = handle.read(min(remaining, 1 << 16))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        body = body()
+    response = flask.Response(body, status, mimetype=mimetypes.guess_type(path)[0],
+                              direct_passthrough=True)
+    response.call_on_close(handle.close)
+    response.content_length = length
+    response.accept_ranges = 'bytes'
+    if span:
+        response.content_range = werkzeug.datastructures.ContentRange(
+            'bytes', span[0], span[1], size)
+    version = asset.version(app.config['formats'])
+    response.set_etag(f'{version}-{fmt}-{size:x}-{mtime:x}')
+    response.make_conditional(flask.request)
+    response.headers['Cache-Control'] = (
+        IMMUTABLE if flask.request.args.get('v') == version else 'no-cache')
+    return response
+
+
 @app.route('/asset/<string:slug>/read/<string:fmt>/')
 def read(slug, fmt):
-    still = flask.request.args.get('s', '0')
+    get = flask.request.args.get
     asset = _get_asset(slug)
-    ext = app.config['formats'][asset.medium][fmt].get('ext')
-    if asset.medium == 'video' and fmt == 'thumb' and still == '1':
+    ext = None
+    if asset.medium == 'video' and fmt == 'thumb' and get('s', '0') == '1':
         ext = 'png'
+    thumbs = app.config['thumbnails']
+    path = asset.path_for_render(thumbs, app.config['formats'][asset.medium][fmt], ext)
+    if fmt in (app.config.get('budgets') or {}):
+        # Formats with a size budget are evicted by the time they were read.
+        usage.usage(thumbs).record(os.path.basename(path).split('.')[0])
     try:
-        return flask.send_file(
-            asset.path_for_export(app.config['thumbnails'], fmt, ext))
+        stat = os.stat(path)
     except FileNotFoundError:
-        flask.abort(404)
+        packed = _read_packed(asset, fmt, path)
+        if packed is not None:
+            return packed
+        if not app.config.get('read-through', True):
+            flask.abort(404)
+        stat = _render_missing(asset, fmt, path)
+        if stat is None:
+            return _placeholder()
+
+    version = asset.version(app.config['formats'])
+    etag = f'{version}-{fmt}-{stat.st_size:x}-{stat.st_mtime_ns:x}'
+    accel = app.config.get('accel-redirect')
+    if accel:
+        # Let a front-end server (e.g. nginx) send the file, ranges and all.
+        response = flask.Response(mimetype=mimetypes.guess_type(path)[0])
+        response.headers['X-Accel-Redirect'] = '/'.join((
+            accel.rstrip('/'), urllib.parse.quote(os.path.relpath(path, thumbs))))
+        response.set_etag(etag)
+        response.make_conditional(flask.request)
+    else:
+        # Werkzeug handles If-None-Match (304) and Range (206) requests here.
+        response = flask.send_file(path, etag=etag, conditional=True, max_age=None)
+    response.headers['Cache-Control'] = (
+        IMMUTABLE if get('v') == version else 'no-cache')
+    return response
 
 
 @app.route('/asset/<string:slug>/similar/tag/', methods=['GET'])
@@ -123,10 +433,18 @@ def get_similar_assets_by_tag(slug):
 
 @app.route('/asset/<string:slug>/similar/content/', methods=['GET'])
 def get_similar_assets_by_content(slug):
-    return _json(_get_asset(slug).similar_by_content(
-        sql.session,
-        method=flask.request.args.get('alg', 'diff-8'),
-        max_distance=int(flask.request.args.get('max', 1))))
+    asset = _get_asset(slug)
+    method = flask.request.args.get('alg', 'diff-8')
+    max_distance = int(flask.request.args.get('max', 1))
+    snap = _snapshot()
+    if snap is None:
+        return _json(asset.similar_by_content(sql.session, method, max_distance))
+    ids = set()
+    for h in asset.hashes:
+        if h.method == method:
+            ids |= snap.hash_asset_ids(method, h.nibbles, max_distance)
+    ids.discard(asset.id)
+    return _json(sql.session.query(assets.Asset).filter(assets.Asset.id.in_(ids)))
 
 
 @app.route('/asset/<string:slug>/tags/<string:tag>/', methods=['POST'])
@@ -142,7 +460,7 @@ def add_tag(slug, tag):
         asset.tags.discard('untouched')
         sql.session.add(asset)
         sql.session.commit()
-    return flask.jsonify(asset.to_dict())
+    return flask.jsonify(_asset_dict(asset))
 
 
 @app.route('/asset/<string:slug>/tags/<string:tag>/', methods=['DELETE'])
@@ -155,7 +473,7 @@ def remove_tag(slug, tag):
         asset.tags.discard('untouched')
         sql.session.add(asset)
         sql.session.commit()
-    return flask.jsonify(asset.to_dict())
+    return flask.jsonify(_asset_dict(asset))
 
 
 FILTER_ARGS = dict(
@@ -172,34 +490,107 @@ FILTER_ARGS = dict(
 )
 
 
-@app.route('/asset/<string:slug>/filters/<string:filter>/', methods=['POST'])
-def add_filter(slug, filter):
+def _filter_kwargs(filter, values):
+    '''Get a filter's arguments as numbers, from a mapping of values.'''
+    if filter not in FILTER_ARGS:
+        flask.abort(400)
     kwargs = dict(filter=filter)
     for arg in FILTER_ARGS[filter].split():
-        kwargs[arg] = float(flask.request.form[arg])
+        try:
+            kwargs[arg] = float(values[arg])
+        except (KeyError, TypeError, ValueError):
+            flask.abort(400)
+    return kwargs
+
+
+def _filters_changed(asset, previous):
+    '''Save new filters for an asset, and render its thumbnails.
+
+    Renders for the previous filters stay put, so that undoing the edit can
+    reuse them. Touching them keeps them from being collected for a while.
+    '''
+    sql.session.commit()
+    thumbs, formats = app.config['thumbnails'], app.config['formats']
+    paths = asset.renders(thumbs, formats, filters=previous).values()
+    for path in paths:
+        for fn in glob.glob(os.path.splitext(path)[0] + '.*'):
+            os.utime(fn)
+    store = pack.store(thumbs)
+    if store:
+        store.touch(_keys(paths))
+    list(asset.export_for_web(thumbs, formats, overwrite=False))
+
+
+def _filter_stack(text):
+    '''Parse a JSON list of filters, checking each filter's arguments.'''
+    try:
+        return [_filter_kwargs(f['filter'], f) for f in json.loads(text)]
+    except (KeyError, TypeError, ValueError):
+        flask.abort(400)
+
+
+@app.route('/asset/<string:slug>/filters/', methods=['POST'])
+def add_filters(slug):
+    '''Add a JSON list of filters to an asset, rendering it once for all.'''
+    pending = _filter_stack(flask.request.form.get('filters', '[]'))
+    asset = _get_asset(slug)
+    if pending:
+        previous = asset.filters
+        for kwargs in pending:
+            asset.add_filter(kwargs)
+        _filters_changed(asset, previous)
+    return flask.jsonify(_asset_dict(asset))
+
+
+@app.route('/asset/<string:slug>/filters/<string:filter>/', methods=['POST'])
+def add_filter(slug, filter):
+    kwargs = _filter_kwargs(filter, flask.request.form)
     asset = _get_asset(slug)
+    previous = asset.filters
     asset.add_filter(kwargs)
-    for path, kwargs in app.config['formats'][asset.medium].items():
-        kw = dict(slug=asset.slug,
-                  dirname=app.config['thumbnails'],
-                  overwrite=True)
-        kw.update(kwargs)
-        celery.export.apply_async(kwargs=kw, queue=asset.medium)
-    return flask.jsonify(asset.to_dict())
+    _filters_changed(asset, previous)
+    return flask.jsonify(_asset_dict(asset))
 
 
 @app.route('/asset/<string:slug>/filters/<string:filter>/<int:index>/',
            methods=['DELETE'])
 def remove_filter(slug, filter, index):
     asset = _get_asset(slug)
+    previous = asset.filters
     asset.remove_filter(filter, index)
-    for path, kwargs in app.config['formats'][asset.medium].items():
-        kw = dict(slug=asset.slug,
-                  dirname=app.config['thumbnails'],
-                  overwrite=True)
-        kw.update(kwargs)
-        celery.export.apply_async(kwargs=kw, queue=queue)
-    return flask.jsonify(asset.to_dict())
+    _filters_changed(asset, previous)
+    return flask.jsonify(_asset_dict(asset))
+
+
+# Longest side, in pixels, of previews rendered while editing filters.
+PREVIEW_SIZE = 480
+
+
+@app.route('/asset/<string:slug>/preview/')
+def preview(slug):
+    '''Render an asset with pending filters, without saving or exporting.
+
+    The "filters" argument is a JSON list of filters to apply after the
+    asset's saved ones. Videos are previewed by a frame from their proxy, if
+    they have one.
+    '''
+    asset = _get_asset(slug)
+    if asset.is_audio:
+        flask.abort(400)
+    pending = _filter_stack(flask.request.args.get('filters', '[]'))
+    size = flask.request.args.get('s', PREVIEW_SIZE, type=int)
+    if size < 1:
+        flask.abort(400)
+    size = min(PREVIEW_SIZE, size)
+    source = None
+    if asset.is_video:
+        proxy = asset.proxy_path(app.config['thumbnails'])
+        source = proxy if os.path.exists(proxy) else None
+    data = pillow.preview(
+        asset, json.loads(asset.filters or '[]') + pending, size, source)
+    response = flask.Response(data, mimetype='image/jpeg')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 
 @app.route('/manifest.json')
@@ -214,22 +605,54 @@ def manifest():
     ))
 
 
+@functools.lru_cache(maxsize=4)
+def _tag_groups(path, mtime):
+    '''Load tag groups from a config file, with compiled patterns for each.
+
+    The mtime argument is only used as part of the cache key, so that the
+    config gets reloaded when the file changes.
+    '''
+    with open(path) as handle:
+        parsed = yaml.load(handle, Loader=yaml.CLoader)
+    groups = parsed.get('tags', {}).get('groups', []) + [
+        dict(group='other', icon='🏷️', patterns=['.*'], editable=True)]
+    return [(group, [_compile_pattern(patt) for patt in group['patterns']])
+            for group in groups]
+
+
+def _compile_pattern(patt):
+    '''Compile a tag pattern; invalid ones only match themselves literally.'''
+    try:
+        return patt, re.compile(patt)
+    except re.error as error:
+        app.logger.warning('invalid tag pattern %r: %s', patt, error)
+        return patt, re.compile(re.escape(patt))
+
+
+def _match_pattern(patterns, name):
+    '''Get the index of the first pattern matching a tag name, or None.
+
+    Each pattern also matches itself literally, e.g. "[ab]" matches "[ab]".
+    '''
+    for p, (patt, regex) in enumerate(patterns):
+        if name == patt or regex.fullmatch(name):
+            return p
+    return None
+
+
 def _annotate_tags(counts, groups):
     '''For each tag in the db, annotate it with metadata from config.'''
-    for tag in sql.session.query(tags.Tag).all():
-        name = tag.name
-        tag = dict(name=name, count=counts.get(tag.id, 0))
-        for g, group in enumerate(groups):
-            for p, patt in enumerate(group['patterns']):
-                if name == patt or re.fullmatch(patt, name):
-                    tag['group'] = group['group']
-                    tag['icon'] = group['icon']
-                    tag['order'] = f'{g + 1:03d}{p + 1:03d}'
-                    tag['hue'] = group.get('hue', 0)
-                    if group.get('editable'):
-                        tag['editable'] = True
-                    break
-            if 'order' in tag:
+    for tag_id, name in sql.session.query(tags.Tag.id, tags.Tag.name):
+        tag = dict(name=name, count=counts.get(tag_id, 0))
+        for g, (group, patterns) in enumerate(groups):
+            p = _match_pattern(patterns, name)
+            if p is not None:
+                tag['group'] = group['group']
+                tag['icon'] = group['icon']
+                tag['order'] = f'{g + 1:03d}{p + 1:03d}'
+                tag['hue'] = group.get('hue', 0)
+                if group.get('editable'):
+                    tag['editable'] = True
                 break
         yield tag
 
@@ -247,20 +670,40 @@ def _load_emoji(url='https://unicode.org/Public/emoji/13.1/emoji-test.txt'):
                 yield m.groupdict()
 
 
-@app.route('/config/')
-def config():
-    with open(app.config['config']) as handle:
-        parsed = yaml.load(handle, Loader=yaml.CLoader)
+@functools.lru_cache(maxsize=1)
+def _emoji():
+    return list(_load_emoji())
 
-    groups = parsed.get('tags', {}).get('groups', []) + [
-        dict(group='other', icon='🏷️', patterns=['.*'], editable=True)]
 
-    # Get tag counts by grouping the asset-tag secondary table.
-    aid, tid = assets.asset_tags.c.asset_id, assets.asset_tags.c.tag_id
-    counts = dict(sql.session.query(tid, sqlalchemy.func.count(aid)).group_by(tid))
+def _tag_counts(sess):
+    '''Get a mapping from tag ids to the number of assets with each tag.'''
+    try:
+        # Get tag counts from the trigger-maintained counts table.
+        return dict(sess.query(assets.tag_counts.c.tag_id, assets.tag_counts.c.count))
+    except sqlalchemy.exc.OperationalError:
+        # Databases made before the counts table was added don't have it
+        # until they're upgraded; count the tags directly.
+        tag_id = assets.asset_tags.c.tag_id
+        return dict(sess.query(tag_id, sqlalchemy.func.count()).group_by(tag_id))
+
 
-    return flask.jsonify(dict(tags=list(_annotate_tags(counts, groups)),
-                              emoji=list(_load_emoji())))
+# Encoded /config response, along with the config file mtime and database
+# write generation it was built from.
+_CONFIG = dict(key=None, body=None)
+
+
+@app.route('/config/')
+def config():
+    path = app.config['config']
+    mtime = os.stat(path).st_mtime_ns
+    generation = db.write_generation(sql.session)
+    key = (path, mtime, generation)
+    if generation is None or _CONFIG['key'] != key:
+        counts = _tag_counts(sql.session)
+        groups = _tag_groups(path, mtime)
+        _CONFIG.update(key=key, body=_dumps(dict(
+            tags=list(_annotate_tags(counts, groups)), emoji=_emoji())))
+    return flask.Response(_CONFIG['body'], mimetype='application/json')
 
 
 @app.route('/')
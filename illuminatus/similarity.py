@@ -0,0 +1,427 @@
+import numpy as np
+import sqlalchemy
+
+
+class TagIndex:
+    '''A sparse asset-by-tag incidence matrix for computing tag similarity.
+
+    The matrix is held in compressed sparse row form (tags of each asset) and
+    compressed sparse column form (assets with each tag). Tags are weighted by
+    inverse document frequency, i.e. one over the number of assets with the
+    tag, and assets are compared by weighted Jaccard similarity: the weight of
+    shared tags divided by the weight of all tags on either asset.
+
+    Parameters
+    ----------
+    asset_ids : ndarray of int
+        Asset id for each (asset, tag) pair.
+    tag_ids : ndarray of int
+        Tag id for each (asset, tag) pair.
+    '''
+
+    # Names of the arrays that make up a built index.
+    ARRAYS = ('asset_ids', 'tag_ids', 'indptr', 'indices',
+              'tag_indptr', 'tag_indices', 'idf', 'weights')
+
+    def __init__(self, asset_ids, tag_ids):
+        self._pending = {}
+        self._build(np.asarray(asset_ids, np.int64), np.asarray(tag_ids, np.int64))
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        '''Create an index from already-built arrays, without copying them.
+
+        Parameters
+        ----------
+        arrays : dict
+            Maps each name in :attr:`ARRAYS` to an ndarray, e.g. as returned
+            by :meth:`to_arrays`. Arrays may be read-only.
+        '''
+        index = cls.__new__(cls)
+        index._pending = {}
+        for name in cls.ARRAYS:
+            setattr(index, name, arrays[name])
+        return index
+
+    def to_arrays(self):
+        '''Get the arrays that make up this index, as a dictionary.'''
+        self._apply_pending()
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    @classmethod
+    def from_db(cls, sess):
+        '''Build an index from the asset-tag association table.'''
+        pairs = sess.execute(sqlalchemy.text(
+            'SELECT asset_id, tag_id FROM asset_tags')).fetchall()
+        pairs = np.array(pairs, np.int64).reshape((-1, 2))
+        return cls(pairs[:, 0], pairs[:, 1])
+
+    def _build(self, asset_ids, tag_ids):
+        self.asset_ids, rows = np.unique(asset_ids, return_inverse=True)
+        self.tag_ids, cols = np.unique(tag_ids, return_inverse=True)
+        rows, cols = rows.ravel(), cols.ravel()
+        n_assets, n_tags = len(self.asset_ids), len(self.tag_ids)
+
+        order = np.lexsort((cols, rows))
+        self.indptr = np.zeros(n_assets + 1, np.int64)
+        np.cumsum(np.bincount(rows, minlength=n_assets), out=self.indptr[1:])
+        self.indices = cols[order]
+
+        order = np.lexsort((rows, cols))
+        self.tag_indptr = np.zeros(n_tags + 1, np.int64)
+        np.cumsum(np.bincount(cols, minlength=n_tags), out=self.tag_indptr[1:])
+        self.tag_indices = rows[order]
+
+        self.idf = 1 / np.maximum(1, np.diff(self.tag_indptr))
+        self.weights = np.bincount(rows, weights=self.idf[cols], minlength=n_assets)
+
+    def update(self, asset_id, tag_ids):
+        '''Record a new set of tags for an asset.
+
+        Updates are applied in bulk, from the in-memory pairs rather than the
+        database, the next time the index is queried.
+
+        Parameters
+        ----------
+        asset_id : int
+            Id of the asset whose tags changed.
+        tag_ids : iterable of int
+            All tag ids now on the asset; empty if the asset was deleted.
+        '''
+        self._pending[asset_id] = np.fromiter(tag_ids, np.int64)
+
+    def _apply_pending(self):
+        '''Splice pending updates into the index.
+
+        Entries of changed assets are dropped and their new tags merged in.
+        The rest keep their order, so no arrays are re-sorted; only tag
+        weights are recomputed for every asset.
+        '''
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        changed = np.array(sorted(pending), np.int64)
+        added = [np.unique(pending[a]) for a in changed]
+        counts = np.array([len(t) for t in added], np.int64)
+        add_assets, add_tags = np.repeat(changed, counts), np.concatenate(added)
+
+        n_assets, n_tags = len(self.asset_ids), len(self.tag_ids)
+        stale = _contains(changed, self.asset_ids)
+        rows = np.repeat(np.arange(n_assets), np.diff(self.indptr))
+        keep = ~stale[rows]
+        rows, cols = rows[keep], self.indices[keep]
+        tag_cols = np.repeat(np.arange(n_tags), np.diff(self.tag_indptr))
+        keep = ~stale[self.tag_indices]
+        tag_rows, tag_cols = self.tag_indices[keep], tag_cols[keep]
+
+        # Assets and tags left after the update, and where the old ones went.
+        asset_ids = _union(self.asset_ids[np.bincount(rows, minlength=n_assets) > 0],
+                           changed[counts > 0])
+        tag_ids = _union(self.tag_ids[np.bincount(cols, minlength=n_tags) > 0],
+                         np.unique(add_tags))
+        row_map = np.searchsorted(asset_ids, self.asset_ids)
+        col_map = np.searchsorted(tag_ids, self.tag_ids)
+        add_rows = np.searchsorted(asset_ids, add_assets)
+        add_cols = np.searchsorted(tag_ids, add_tags)
+        n_assets, n_tags = len(asset_ids), len(tag_ids)
+
+        # Merge entries as flat (row, col) keys, sorted by row then column...
+        keys = _union(row_map[rows] * n_tags + col_map[cols],
+                      add_rows * n_tags + add_cols)
+        rows, cols = np.divmod(keys, n_tags)
+        # ... and as (col, row) keys, sorted by column then row.
+        keys = _union(col_map[tag_cols] * n_assets + row_map[tag_rows],
+                      np.sort(add_cols * n_assets + add_rows))
+        tag_cols, tag_rows = np.divmod(keys, n_assets)
+
+        self.asset_ids, self.tag_ids = asset_ids, tag_ids
+        self.indptr = np.zeros(n_assets + 1, np.int64)
+        np.cumsum(np.bincount(rows, minlength=n_assets), out=self.indptr[1:])
+        self.indices = cols
+        self.tag_indptr = np.zeros(n_tags + 1, np.int64)
+        np.cumsum(np.bincount(tag_cols, minlength=n_tags), out=self.tag_indptr[1:])
+        self.tag_indices = tag_rows
+        self.idf = 1 / np.maximum(1, np.diff(self.tag_indptr))
+        self.weights = np.bincount(rows, weights=self.idf[cols], minlength=n_assets)
+
+    def similar(self, asset_id, min_sim=0.5, limit=20, candidates=None):
+        '''Find assets whose tags are similar to those of one asset.
+
+        Parameters
+        ----------
+        asset_id : int
+            Id of the asset to compare against.
+        min_sim : float, optional
+            Only return assets with at least this similarity.
+        limit : int, optional
+            Return at most this many of the most similar assets.
+        candidates : iterable of int, optional
+            If given, only score assets with these ids. Otherwise all assets
+            sharing at least one tag with the seed asset are scored.
+
+        Returns
+        -------
+        A list of (asset id, similarity) pairs, most similar first.
+        '''
+        self._apply_pending()
+        row = np.searchsorted(self.asset_ids, asset_id)
+        if row >= len(self.asset_ids) or self.asset_ids[row] != asset_id:
+            return []
+        seed = self.indices[self.indptr[row]:self.indptr[row + 1]]
+
+        if candidates is None:
+            # Score every asset that shares a tag with the seed asset.
+            found, lengths = _gather(self.tag_indptr, self.tag_indices, seed)
+            rows, inverse = np.unique(found, return_inverse=True)
+            weights = np.repeat(self.idf[seed], lengths)
+            shared = np.bincount(inverse.ravel(), weights=weights)
+        else:
+            ids = np.unique(np.fromiter(candidates, np.int64))
+            rows = np.searchsorted(self.asset_ids, ids)
+            valid = rows < len(self.asset_ids)
+            rows, ids = rows[valid], ids[valid]
+            rows = rows[self.asset_ids[rows] == ids]
+            cols, lengths = _gather(self.indptr, self.indices, rows)
+            weights = np.where(np.isin(cols, seed), self.idf[cols], 0)
+            owner = np.repeat(np.arange(len(rows)), lengths)
+            shared = np.bincount(owner, weights=weights, minlength=len(rows))
+
+        sims = shared / (self.weights[row] + self.weights[rows] - shared)
+        mask = (rows != row) & (shared > 0) & (sims >= min_sim)
+        rows, sims = rows[mask], sims[mask]
+        best = np.argsort(-sims, kind='stable')[:limit]
+        return [(int(a), float(s))
+                for a, s in zip(self.asset_ids[rows[best]], sims[best])]
+
+    def similar_many(self, asset_ids, min_sim=0.5, limit=20):
+        '''Find similar assets for each of several assets.
+
+        All assets sharing a tag with any of the seed assets are scored at
+        once, as the product of the seed rows with the whole matrix.
+
+        Parameters
+        ----------
+        asset_ids : iterable of int
+            Ids of the assets to compare against.
+        min_sim : float, optional
+            Only return assets with at least this similarity.
+        limit : int, optional
+            Return at most this many of the most similar assets for each.
+
+        Returns
+        -------
+        A dictionary mapping each asset id to a list of (asset id, similarity)
+        pairs, most similar first.
+        '''
+        self._apply_pending()
+        ids = np.unique(np.fromiter(asset_ids, np.int64))
+        result = {int(a): [] for a in ids}
+        seeds = np.searchsorted(self.asset_ids, ids)
+        seeds = seeds[_contains(self.asset_ids, ids)]
+
+        # Expand each seed's tags into the assets with those tags, and sum
+        # the weights of the tags shared by each (seed, asset) pair.
+        cols, lengths = _gather(self.indptr, self.indices, seeds)
+        owners = np.repeat(np.arange(len(seeds)), lengths)
+        found, lengths = _gather(self.tag_indptr, self.tag_indices, cols)
+        pairs, inverse = np.unique(
+            np.repeat(owners, lengths) * len(self.asset_ids) + found, return_inverse=True)
+        shared = np.bincount(inverse.ravel(), weights=np.repeat(self.idf[cols], lengths))
+        owners, rows = np.divmod(pairs, len(self.asset_ids))
+
+        seeds = seeds[owners]
+        sims = shared / (self.weights[seeds] + self.weights[rows] - shared)
+        mask = (rows != seeds) & (sims >= min_sim)
+        owners, seeds, rows, sims = owners[mask], seeds[mask], rows[mask], sims[mask]
+        order = np.lexsort((rows, -sims, owners))
+        owners, seeds, rows, sims = owners[order], seeds[order], rows[order], sims[order]
+        starts = np.searchsorted(owners, owners)
+        best = np.arange(len(owners)) - starts < limit
+        for seed, row, sim in zip(self.asset_ids[seeds[best]], self.asset_ids[rows[best]],
+                                  sims[best]):
+            result[int(seed)].append((int(row), float(sim)))
+        return result
+
+
+def _contains(sorted_ids, ids):
+    '''Check which of some ids are in a sorted array of unique ids.'''
+    if not len(sorted_ids):
+        return np.zeros(len(ids), bool)
+    pos = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    return sorted_ids[pos] == ids
+
+
+def _union(a, b):
+    '''Merge two sorted arrays of unique values, without sorting them again.'''
+    b = b[~_contains(a, b)]
+    return np.insert(a, np.searchsorted(a, b), b)
+
+
+def _gather(indptr, indices, which):
+    '''Concatenate the index segments of several compressed rows (or columns).
+
+    Returns
+    -------
+    values : ndarray
+        The concatenated segments of `indices`.
+    lengths : ndarray
+        The length of each segment.
+    '''
+    starts = indptr[which]
+    lengths = indptr[which + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return indices[offsets + np.arange(lengths.sum())], lengths
+
+
+# MinHash signatures have BANDS * ROWS values. Two assets become candidates for
+# scoring when all ROWS values in any one band match, which happens with
+# probability 1 - (1 - J ** ROWS) ** BANDS for assets with tag Jaccard index J.
+# That's above 0.95 from J = 0.45 up, so few assets at the default min_sim of
+# 0.5 are missed, even though candidates are then scored by IDF-weighted
+# similarity rather than the plain Jaccard index the bands approximate.
+BANDS, ROWS = 32, 3
+
+_PRIME = np.uint64((1 << 31) - 1)
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+_rng = np.random.RandomState(0x51A1)
+_A = _rng.randint(1, _PRIME, BANDS * ROWS).astype(np.uint64)
+_B = _rng.randint(0, _PRIME, BANDS * ROWS).astype(np.uint64)
+del _rng
+
+# Locality-sensitive hash buckets for each asset, maintained in the database.
+tag_lsh = sqlalchemy.table(
+    'tag_lsh',
+    sqlalchemy.column('asset_id'),
+    sqlalchemy.column('band'),
+    sqlalchemy.column('bucket'))
+
+
+def buckets(asset_ids, tag_ids):
+    '''Compute LSH buckets from the MinHash signatures of asset tag sets.
+
+    Parameters
+    ----------
+    asset_ids : ndarray of int
+        Asset id for each (asset, tag) pair.
+    tag_ids : ndarray of int
+        Tag id for each (asset, tag) pair.
+
+    Returns
+    -------
+    assets : ndarray of int
+        Sorted ids of assets with at least one tag.
+    buckets : ndarray of int
+        An array of shape (len(assets), BANDS) holding a signed 64-bit bucket
+        for each band of each asset's signature.
+    '''
+    asset_ids = np.asarray(asset_ids, np.int64)
+    tag_ids = np.asarray(tag_ids, np.int64)
+    order = np.argsort(asset_ids, kind='stable')
+    assets, starts = np.unique(asset_ids[order], return_index=True)
+    if not len(assets):
+        return assets, np.zeros((0, BANDS), np.int64)
+    x = tag_ids[order].astype(np.uint64) % _PRIME
+    signature = np.minimum.reduceat((np.outer(x, _A) + _B) % _PRIME, starts, axis=0)
+    bands = signature.reshape((len(assets), BANDS, ROWS))
+    mixed = np.zeros((len(assets), BANDS), np.uint64)
+    for r in range(ROWS):
+        mixed = mixed * _MIX + bands[:, :, r]
+    return assets, mixed.view(np.int64)
+
+
+def _insert_buckets(conn, asset_ids, tag_ids):
+    assets, values = buckets(asset_ids, tag_ids)
+    if len(assets):
+        conn.execute(tag_lsh.insert(), [
+            dict(asset_id=int(a), band=b, bucket=int(v))
+            for a, row in zip(assets, values) for b, v in enumerate(row)])
+
+
+def write_buckets(conn, changes):
+    '''Replace the LSH buckets of assets whose tags changed.
+
+    Parameters
+    ----------
+    conn : :class:`sqlalchemy.engine.Connection`
+        A connection to the database.
+    changes : dict
+        Maps asset ids to the set of tag ids now on each asset.
+    '''
+    if not changes:
+        return
+    conn.execute(tag_lsh.delete().where(tag_lsh.c.asset_id.in_(list(changes))))
+    pairs = [(a, t) for a, tags in changes.items() for t in tags]
+    if pairs:
+        _insert_buckets(conn, *np.array(pairs, np.int64).T)
+
+
+def rebuild_buckets(conn, chunk_size=50000):
+    '''Recompute the LSH buckets of all assets from the asset_tags table.'''
+    conn.execute(tag_lsh.delete())
+    result = conn.execute(sqlalchemy.text(
+        'SELECT asset_id, tag_id FROM asset_tags ORDER BY asset_id'))
+    carry = np.zeros((0, 2), np.int64)
+    while True:
+        rows = result.fetchmany(chunk_size)
+        pairs = np.concatenate([carry, np.array(rows, np.int64).reshape((-1, 2))])
+        if rows:
+            # Hold back the last asset's pairs, which may continue in the next chunk.
+            last = pairs[:, 0] == pairs[-1, 0]
+            carry, pairs = pairs[last], pairs[~last]
+        _insert_buckets(conn, pairs[:, 0], pairs[:, 1])
+        if not rows:
+            break
+
+
+def candidates(sess, asset_id):
+    '''Get ids of assets sharing at least one LSH bucket with an asset.
+
+    Returns None if the asset has no buckets, so every asset is a candidate.
+    '''
+    if sess.execute(sqlalchemy.select([tag_lsh.c.asset_id])
+                    .where(tag_lsh.c.asset_id == asset_id).limit(1)).first() is None:
+        return None
+    other = tag_lsh.alias()
+    return [a for a, in sess.execute(
+        sqlalchemy.select([other.c.asset_id]).distinct()
+        .select_from(tag_lsh.join(other, sqlalchemy.and_(
+            other.c.band == tag_lsh.c.band, other.c.bucket == tag_lsh.c.bucket)))
+        .where(tag_lsh.c.asset_id == asset_id)
+        .where(other.c.asset_id != asset_id))]
+
+
+# Index shared by all sessions in this process; built on first use.
+_INDEX = None
+
+
+def tag_index(sess):
+    '''Get the process-wide tag index, building it from the database if needed.'''
+    global _INDEX
+    if _INDEX is None:
+        _INDEX = TagIndex.from_db(sess)
+    return _INDEX
+
+
+def tags_changed(changes):
+    '''Apply committed tag changes to the process-wide index, if it exists.
+
+    Parameters
+    ----------
+    changes : dict
+        Maps asset ids to the set of tag ids now on each asset.
+    '''
+    if _INDEX is not None:
+        for asset_id, tag_ids in changes.items():
+            _INDEX.update(asset_id, tag_ids)
+
+
+def install(index):
+    '''Replace the process-wide index, e.g. with one from a shared snapshot.'''
+    global _INDEX
+    _INDEX = index
+
+
+def reset():
+    '''Discard the process-wide index, so it gets rebuilt on next use.'''
+    global _INDEX
+    _INDEX = None
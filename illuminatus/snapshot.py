@@ -0,0 +1,247 @@
+import json
+import mmap
+import numpy as np
+import os
+import sqlalchemy
+import struct
+import tempfile
+import time
+
+from . import db
+from . import similarity
+from .hashes import _neighbors
+
+# A snapshot file holds a magic string, the length of a JSON header, the
+# header, and then the raw bytes of each array, aligned for direct mapping.
+MAGIC = b'ILLUMSNP'
+ALIGN = 64
+
+
+def _aligned(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+def path_for(db_path):
+    '''Get the snapshot path for a database path.'''
+    return db_path + '.snapshot'
+
+
+def build(sess):
+    '''Build read-only index arrays from the database.
+
+    Parameters
+    ----------
+    sess : SQLAlchemy
+        Database session.
+
+    Returns
+    -------
+    generation : int
+        The database write generation that the arrays reflect.
+    arrays : dict
+        Maps array names to ndarrays.
+    '''
+    generation = db.write_generation(sess)
+    arrays = {f'tags.{name}': arr for name, arr in
+              similarity.TagIndex.from_db(sess).to_arrays().items()}
+
+    slugs, ids = _columns(sess, 'SELECT slug, id FROM assets')
+    order = np.argsort(slugs, kind='stable')
+    arrays['slugs'], arrays['slug_ids'] = slugs[order], ids[order]
+
+    keys, ids = _columns(
+        sess, "SELECT method || '#' || nibbles, asset_id FROM hashes")
+    order = np.argsort(keys, kind='stable')
+    arrays['hash_keys'], arrays['hash_asset_ids'] = keys[order], ids[order]
+
+    return generation, arrays
+
+
+def _columns(sess, sql):
+    rows = sess.execute(sqlalchemy.text(sql)).fetchall()
+    keys = np.array([k.encode('utf-8') for k, _ in rows], dtype=bytes)
+    return keys, np.array([v for _, v in rows], np.int64)
+
+
+def write(path, generation, arrays):
+    '''Write a snapshot file, atomically replacing any existing one.
+
+    Parameters
+    ----------
+    path : str
+        Path of the snapshot file.
+    generation : int
+        Database write generation that the arrays reflect.
+    arrays : dict
+        Maps array names to ndarrays.
+    '''
+    header, offset = dict(generation=generation, arrays={}), 0
+    for name, arr in arrays.items():
+        header['arrays'][name] = (arr.dtype.str, arr.shape, offset)
+        offset = _aligned(offset + arr.nbytes)
+    head = json.dumps(header).encode('utf-8')
+    base = _aligned(len(MAGIC) + 8 + len(head))
+
+    dirname, basename = os.path.split(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=f'.{basename}-', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as handle:
+            handle.write(MAGIC + struct.pack('<Q', len(head)) + head)
+            for name, arr in arrays.items():
+                handle.seek(base + header['arrays'][name][2])
+                handle.write(np.ascontiguousarray(arr).tobytes())
+            handle.truncate(base + offset)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def rebuild(sess, path):
+    '''Build and write a snapshot of the database, returning its generation.'''
+    generation, arrays = build(sess)
+    write(path, generation, arrays)
+    return generation
+
+
+class Snapshot:
+    '''Read-only indexes mapped from a snapshot file.
+
+    The file is mapped rather than read, so processes that load the same
+    snapshot share one copy of its arrays in the OS page cache.
+
+    Parameters
+    ----------
+    path : str
+        Path of a snapshot file.
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as handle:
+            self._stat = os.fstat(handle.fileno())
+            self._mmap = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a snapshot file')
+        size, = struct.unpack_from('<Q', self._mmap, len(MAGIC))
+        start = len(MAGIC) + 8
+        header = json.loads(self._mmap[start:start + size])
+        base = _aligned(start + size)
+        self.generation = header['generation']
+        self.arrays = {}
+        for name, (dtype, shape, offset) in header['arrays'].items():
+            self.arrays[name] = np.frombuffer(
+                self._mmap, dtype, int(np.prod(shape)), base + offset).reshape(shape)
+
+    def is_current(self, path):
+        '''True if the snapshot file at path is the one we have mapped.'''
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_ino, stat.st_mtime_ns) == (
+            self._stat.st_ino, self._stat.st_mtime_ns)
+
+    def tag_index(self):
+        '''Get a :class:`similarity.TagIndex` backed by the mapped arrays.'''
+        return similarity.TagIndex.from_arrays(
+            {name: self.arrays[f'tags.{name}'] for name in similarity.TagIndex.ARRAYS})
+
+    def slug_ids(self, prefix):
+        '''Get ids of assets whose slugs start with the given prefix.'''
+        slugs = self.arrays['slugs']
+        prefix = prefix.encode('utf-8')
+        lo = np.searchsorted(slugs, prefix, 'left')
+        hi = np.searchsorted(slugs, prefix + b'\xff', 'left')
+        return [int(i) for i in self.arrays['slug_ids'][lo:hi]]
+
+    def hash_asset_ids(self, method, nibbles, max_distance=1):
+        '''Get ids of assets with hashes near the given hash.
+
+        Parameters
+        ----------
+        method : str
+            Hashing method.
+        nibbles : str
+            Hash value to search around.
+        max_distance : int, optional
+            Neighborhood size, as for :meth:`hashes.Hash.neighbors`.
+        '''
+        keys = self.arrays['hash_keys']
+        ids = set()
+        for n in _neighbors(nibbles, max_distance):
+            key = f'{method}#{n}'.encode('utf-8')
+            lo = np.searchsorted(keys, key, 'left')
+            hi = np.searchsorted(keys, key, 'right')
+            ids.update(int(i) for i in self.arrays['hash_asset_ids'][lo:hi])
+        return ids
+
+
+_LOADED = None
+
+
+def load(path):
+    '''Get the snapshot at a path, remapping it if the file was replaced.
+
+    Returns
+    -------
+    A :class:`Snapshot`, or None if there is no snapshot file.
+    '''
+    global _LOADED
+    if _LOADED is None or not _LOADED.is_current(path):
+        try:
+            _LOADED = Snapshot(path)
+        except FileNotFoundError:
+            _LOADED = None
+    return _LOADED
+
+
+def _stale(generation, current, age, max_age):
+    '''Check whether a snapshot needs rebuilding.
+
+    Parameters
+    ----------
+    generation : int
+        The database's write generation, or None if it doesn't track one.
+    current : int
+        The write generation the snapshot was built from.
+    age : float
+        Seconds since the snapshot was built.
+    max_age : float
+        Without a write generation, writes can't be seen, so snapshots are
+        rebuilt when they're this many seconds old.
+    '''
+    if generation is None:
+        return age >= max_age
+    return generation != current
+
+
+def watch(db_path, path, interval=2, max_age=300):
+    '''Rebuild the snapshot whenever the database records a write.
+
+    This loops forever, so it's meant to run in a separate process.
+
+    Parameters
+    ----------
+    db_path : str
+        Path of the database.
+    path : str
+        Path of the snapshot file.
+    interval : float, optional
+        Seconds to wait between checks of the database write generation.
+    max_age : float, optional
+        Seconds between rebuilds for databases that don't track a write
+        generation.
+    '''
+    engine = db.engine(db_path)
+    current, built = -1, -max_age
+    if os.path.exists(path):
+        current, built = Snapshot(path).generation, os.path.getmtime(path)
+    while True:
+        with engine.connect() as conn:
+            if _stale(db.write_generation(conn), current, time.time() - built, max_age):
+                with db.Session(bind=conn) as sess:
+                    current = rebuild(sess, path)
+                built = time.time()
+        time.sleep(interval)
@@ -23412,6 +23412,34 @@ var _tags = require("./tags");
 var _utils = require("./utils");
 var _editStyl = require("./edit.styl");
 var _reactCropCss = require("react-image-crop/dist/ReactCrop.css");
+// Tools that set a filter's value with a slider: the slider's range and
+// starting value, and the filter argument that the value goes in.
+const RANGES = {
+    contrast: {
+        min: 0,
+        max: 200,
+        start: 100,
+        arg: 'percent'
+    },
+    brightness: {
+        min: 0,
+        max: 200,
+        start: 100,
+        arg: 'percent'
+    },
+    saturation: {
+        min: 0,
+        max: 200,
+        start: 100,
+        arg: 'percent'
+    },
+    hue: {
+        min: 0,
+        max: 360,
+        start: 0,
+        arg: 'degrees'
+    }
+};
 const Tool = ({ name , icon , iconWhenActive , activeTool , onClick  })=>/*#__PURE__*/ _reactDefault.default.createElement(_utils.Button, {
         name: name,
         icon: activeTool === name ? iconWhenActive || icon : icon,
@@ -23431,14 +23459,32 @@ const Edit = ({ refresh  })=>{
         medium: 'photo',
         tags: [],
         slug
-    }, [asset, setAsset] = _react.useState(defaultAsset), [activeTool, setActiveTool] = _react.useState(null), [crop1, setCrop] = _react.useState(null);
+    }, [asset, setAsset] = _react.useState(defaultAsset), [activeTool, setActiveTool] = _react.useState(null), [crop1, setCrop] = _react.useState(null), [level, setLevel] = _react.useState(null), [shownLevel, setShownLevel] = _react.useState(null), [pending, setPending] = _react.useState([]), ranged = RANGES[activeTool] && shownLevel !== null ? [
+        {
+            filter: activeTool,
+            [RANGES[activeTool].arg]: shownLevel
+        }
+    ] : [], previewed = [
+        ...pending,
+        ...ranged
+    ], preview = `/asset/${slug}/preview/?filters=${encodeURIComponent(JSON.stringify(previewed))}`;
     _react.useEffect(()=>{
         setAsset(defaultAsset);
+        setPending([]);
         fetch(`/asset/${slug}/`).then((res)=>res.json()
         ).then(setAsset);
     }, [
         slug
     ]);
+    // Preview a slider's value once it stops moving for a moment.
+    _react.useEffect(()=>{
+        const timer = setTimeout(()=>setShownLevel(level)
+        , 150);
+        return ()=>clearTimeout(timer)
+        ;
+    }, [
+        level
+    ]);
     _react.useEffect(()=>{
         const handler = (ev)=>{
             if (ev.code === 'Escape') stopEditing();
@@ -23455,6 +23501,76 @@ const Edit = ({ refresh  })=>{
     }, [
         slug
     ]);
+    // Filters are previewed by the server until they're saved, which is when
+    // the asset gets exported again.
+    const addPending = (filter)=>()=>setPending([
+            ...pending,
+            filter
+        ])
+    ;
+    // Crops are fractions of the previewed frame, which has the pending
+    // filters applied, so they stay right when added after them.
+    const toggleCrop = ()=>{
+        if (activeTool === 'crop') {
+            setPending([
+                ...pending,
+                {
+                    filter: 'crop',
+                    x1: crop1.x / 100,
+                    x2: (crop1.x + crop1.width) / 100,
+                    y1: crop1.y / 100,
+                    y2: (crop1.y + crop1.height) / 100
+                }
+            ]);
+            setActiveTool(null);
+            setCrop(null);
+        } else {
+            setActiveTool('crop');
+            setCrop({
+                unit: '%',
+                width: 80,
+                height: 80,
+                x: 10,
+                y: 10
+            });
+        }
+    };
+    const toggleRange = (name)=>()=>{
+            if (activeTool === name) {
+                setPending([
+                    ...pending,
+                    {
+                        filter: name,
+                        [RANGES[name].arg]: level
+                    }
+                ]);
+                setActiveTool(null);
+                setLevel(null);
+            } else {
+                setActiveTool(name);
+                setLevel(RANGES[name].start);
+            }
+            setShownLevel(null);
+        }
+    ;
+    const discardPending = ()=>{
+        setPending([]);
+        setActiveTool(null);
+        setCrop(null);
+        setLevel(null);
+    };
+    // The whole stack is saved at once, so the asset is exported once.
+    const savePending = ()=>fetch(`/asset/${slug}/filters/`, {
+            method: 'post',
+            body: new URLSearchParams({
+                filters: JSON.stringify(pending)
+            })
+        }).then((res)=>res.json()
+    ).then((asset1)=>{
+        setAsset(asset1);
+        setPending([]);
+    })
+    ;
     const deleteAsset = ()=>{
         if (window.confirm('Really delete?')) fetch(`/asset/${slug}/`, {
             method: 'delete'
@@ -23489,11 +23605,30 @@ const Edit = ({ refresh  })=>{
         className: "edit asset",
         __source: {
             fileName: "src/edit.jsx",
-            lineNumber: 60,
+            lineNumber: 73,
             columnNumber: 5
         },
         __self: undefined
-    }, asset.medium === 'video' ? /*#__PURE__*/ _reactDefault.default.createElement("video", {
+    }, crop1 ? /*#__PURE__*/ _reactDefault.default.createElement(_reactImageCropDefault.default, {
+        src: preview,
+        crop: crop1,
+        onChange: (_, crop)=>setCrop(crop)
+        ,
+        __source: {
+            fileName: "src/edit.jsx",
+            lineNumber: 129,
+            columnNumber: 14
+        },
+        __self: undefined
+    }) : previewed.length ? /*#__PURE__*/ _reactDefault.default.createElement("img", {
+        src: preview,
+        __source: {
+            fileName: "src/edit.jsx",
+            lineNumber: 74,
+            columnNumber: 24
+        },
+        __self: undefined
+    }) : asset.medium === 'video' ? /*#__PURE__*/ _reactDefault.default.createElement("video", {
         key: asset.id,
         controls: true,
         __source: {
@@ -23527,18 +23662,7 @@ const Edit = ({ refresh  })=>{
             columnNumber: 65
         },
         __self: undefined
-    })) : crop1 ? /*#__PURE__*/ _reactDefault.default.createElement(_reactImageCropDefault.default, {
-        src: src,
-        crop: crop1,
-        onChange: (_, crop)=>setCrop(crop)
-        ,
-        __source: {
-            fileName: "src/edit.jsx",
-            lineNumber: 63,
-            columnNumber: 14
-        },
-        __self: undefined
-    }) : /*#__PURE__*/ _reactDefault.default.createElement("img", {
+    })) : /*#__PURE__*/ _reactDefault.default.createElement("img", {
         src: src,
         __source: {
             fileName: "src/edit.jsx",
@@ -23618,18 +23742,9 @@ const Edit = ({ refresh  })=>{
     }), /*#__PURE__*/ _reactDefault.default.createElement(Tool, {
         name: "crop",
         icon: "✂",
-        iconWhenActive: '✕',
+        iconWhenActive: '✓',
         activeTool: activeTool,
-        onClick: ()=>{
-            setActiveTool('crop');
-            setCrop({
-                unit: '%',
-                width: 80,
-                height: 80,
-                x: 10,
-                y: 10
-            });
-        },
+        onClick: toggleCrop,
         __source: {
             fileName: "src/edit.jsx",
             lineNumber: 74,
@@ -23648,9 +23763,12 @@ const Edit = ({ refresh  })=>{
         name: "vflip",
         icon: "↕",
         activeTool: activeTool,
+        onClick: addPending({
+            filter: 'vflip'
+        }),
         __source: {
             fileName: "src/edit.jsx",
-            lineNumber: 83,
+            lineNumber: 97,
             columnNumber: 7
         },
         __self: undefined
@@ -23658,9 +23776,12 @@ const Edit = ({ refresh  })=>{
         name: "hflip",
         icon: "↔",
         activeTool: activeTool,
+        onClick: addPending({
+            filter: 'hflip'
+        }),
         __source: {
             fileName: "src/edit.jsx",
-            lineNumber: 84,
+            lineNumber: 99,
             columnNumber: 7
         },
         __self: undefined
@@ -23668,9 +23789,13 @@ const Edit = ({ refresh  })=>{
         name: "ccw",
         icon: "⤷",
         activeTool: activeTool,
+        onClick: addPending({
+            filter: 'rotate',
+            degrees: -90
+        }),
         __source: {
             fileName: "src/edit.jsx",
-            lineNumber: 85,
+            lineNumber: 101,
             columnNumber: 7
         },
         __self: undefined
@@ -23678,9 +23803,13 @@ const Edit = ({ refresh  })=>{
         name: "cw",
         icon: "⤶",
         activeTool: activeTool,
+        onClick: addPending({
+            filter: 'rotate',
+            degrees: 90
+        }),
         __source: {
             fileName: "src/edit.jsx",
-            lineNumber: 86,
+            lineNumber: 103,
             columnNumber: 7
         },
         __self: undefined
@@ -23705,7 +23834,9 @@ const Edit = ({ refresh  })=>{
     }), /*#__PURE__*/ _reactDefault.default.createElement(Tool, {
         name: "contrast",
         icon: "◑",
+        iconWhenActive: '✓',
         activeTool: activeTool,
+        onClick: toggleRange('contrast'),
         __source: {
             fileName: "src/edit.jsx",
             lineNumber: 89,
@@ -23715,7 +23846,9 @@ const Edit = ({ refresh  })=>{
     }), /*#__PURE__*/ _reactDefault.default.createElement(Tool, {
         name: "brightness",
         icon: "☀",
+        iconWhenActive: '✓',
         activeTool: activeTool,
+        onClick: toggleRange('brightness'),
         __source: {
             fileName: "src/edit.jsx",
             lineNumber: 90,
@@ -23725,7 +23858,9 @@ const Edit = ({ refresh  })=>{
     }), /*#__PURE__*/ _reactDefault.default.createElement(Tool, {
         name: "saturation",
         icon: "▧",
+        iconWhenActive: '✓',
         activeTool: activeTool,
+        onClick: toggleRange('saturation'),
         __source: {
             fileName: "src/edit.jsx",
             lineNumber: 91,
@@ -23735,7 +23870,9 @@ const Edit = ({ refresh  })=>{
     }), /*#__PURE__*/ _reactDefault.default.createElement(Tool, {
         name: "hue",
         icon: "🎨",
+        iconWhenActive: '✓',
         activeTool: activeTool,
+        onClick: toggleRange('hue'),
         __source: {
             fileName: "src/edit.jsx",
             lineNumber: 92,
@@ -23756,11 +23893,55 @@ const Edit = ({ refresh  })=>{
         activeTool: activeTool,
         __source: {
             fileName: "src/edit.jsx",
-            lineNumber: 94,
+            lineNumber: 112,
+            columnNumber: 7
+        },
+        __self: undefined
+    }), /*#__PURE__*/ _reactDefault.default.createElement("span", {
+        className: "spacer",
+        __source: {
+            fileName: "src/edit.jsx",
+            lineNumber: 113,
+            columnNumber: 7
+        },
+        __self: undefined
+    }), /*#__PURE__*/ _reactDefault.default.createElement(_utils.Button, {
+        name: "discard",
+        icon: "↶",
+        disabled: !pending.length && activeTool === null,
+        onClick: discardPending,
+        __source: {
+            fileName: "src/edit.jsx",
+            lineNumber: 114,
             columnNumber: 7
         },
         __self: undefined
-    })), /*#__PURE__*/ _reactDefault.default.createElement("ul", {
+    }), /*#__PURE__*/ _reactDefault.default.createElement(_utils.Button, {
+        name: "save",
+        icon: "✓",
+        disabled: !pending.length || activeTool !== null,
+        onClick: savePending,
+        __source: {
+            fileName: "src/edit.jsx",
+            lineNumber: 116,
+            columnNumber: 7
+        },
+        __self: undefined
+    })), RANGES[activeTool] && /*#__PURE__*/ _reactDefault.default.createElement("input", {
+        type: "range",
+        className: "edit range",
+        min: RANGES[activeTool].min,
+        max: RANGES[activeTool].max,
+        value: level,
+        onChange: (ev)=>setLevel(Number(ev.target.value))
+        ,
+        __source: {
+            fileName: "src/edit.jsx",
+            lineNumber: 175,
+            columnNumber: 26
+        },
+        __self: undefined
+    }), /*#__PURE__*/ _reactDefault.default.createElement("ul", {
         className: "edit filters",
         __source: {
             fileName: "src/edit.jsx",
@@ -35622,7 +35803,7 @@ const Thumb = ({ asset , handleClick , cursored , selected  })=>{
         asset.medium,
         cursored ? 'cursored' : '',
         selected ? 'selected' : '', 
-    ], src = (still)=>`/asset/${asset.slug}/read/thumb/?s=${still ? '1' : '0'}`
+    ], src = (still)=>`/asset/${asset.slug}/read/thumb/?s=${still ? '1' : '0'}&v=${asset.version}`
     ;
     return !asset.id ? /*#__PURE__*/ _reactDefault.default.createElement(Spinner, {
         __source: {
@@ -35713,7 +35894,7 @@ var _tags = require("./tags");
 var _utils = require("./utils");
 var _viewStyl = require("./view.styl");
 const Full = ({ asset  })=>{
-    const src = `/asset/${asset.slug}/read/full/`;
+    const src = `/asset/${asset.slug}/read/full/?v=${asset.version}`;
     return(/*#__PURE__*/ _reactDefault.default.createElement("div", {
         className: "view asset",
         __source: {
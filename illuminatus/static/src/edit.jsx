@@ -10,6 +10,16 @@ import './edit.styl'
 import 'react-image-crop/dist/ReactCrop.css'
 
 
+// Tools that set a filter's value with a slider: the slider's range and
+// starting value, and the filter argument that the value goes in.
+const RANGES = {
+  contrast: {min: 0, max: 200, start: 100, arg: 'percent'},
+  brightness: {min: 0, max: 200, start: 100, arg: 'percent'},
+  saturation: {min: 0, max: 200, start: 100, arg: 'percent'},
+  hue: {min: 0, max: 360, start: 0, arg: 'degrees'},
+};
+
+
 const Tool = ({name, icon, iconWhenActive, activeTool, onClick}) => (
   <Button name={name}
           icon={activeTool === name ? (iconWhenActive || icon) : icon}
@@ -26,13 +36,27 @@ const Edit = ({refresh}) => {
       , defaultAsset = {medium: 'photo', tags: [], slug}
       , [asset, setAsset] = useState(defaultAsset)
       , [activeTool, setActiveTool] = useState(null)
-      , [crop, setCrop] = useState(null);
+      , [crop, setCrop] = useState(null)
+      , [level, setLevel] = useState(null)
+      , [shownLevel, setShownLevel] = useState(null)
+      , [pending, setPending] = useState([])
+      , ranged = RANGES[activeTool] && shownLevel !== null
+          ? [{filter: activeTool, [RANGES[activeTool].arg]: shownLevel}] : []
+      , previewed = [...pending, ...ranged]
+      , preview = `/asset/${slug}/preview/?filters=${encodeURIComponent(JSON.stringify(previewed))}`;
 
   useEffect(() => {
     setAsset(defaultAsset);
+    setPending([]);
     fetch(`/asset/${slug}/`).then(res => res.json()).then(setAsset);
   }, [slug]);
 
+  // Preview a slider's value once it stops moving for a moment.
+  useEffect(() => {
+    const timer = setTimeout(() => setShownLevel(level), 150);
+    return () => clearTimeout(timer);
+  }, [level]);
+
   useEffect(() => {
     const handler = ev => {
       if (ev.code === 'Escape') stopEditing();
@@ -44,6 +68,49 @@ const Edit = ({refresh}) => {
     return () => window.removeEventListener('keydown', handler);
   }, [slug]);
 
+  // Filters are previewed by the server until they're saved, which is when
+  // the asset gets exported again.
+  const addPending = filter => () => setPending([...pending, filter]);
+
+  // Crops are fractions of the previewed frame, which has the pending
+  // filters applied, so they stay right when added after them.
+  const toggleCrop = () => {
+    if (activeTool === 'crop') {
+      setPending([...pending, {filter: 'crop',
+                               x1: crop.x / 100, x2: (crop.x + crop.width) / 100,
+                               y1: crop.y / 100, y2: (crop.y + crop.height) / 100}]);
+      setActiveTool(null);
+      setCrop(null);
+    } else {
+      setActiveTool('crop');
+      setCrop({unit: '%', width: 80, height: 80, x: 10, y: 10});
+    }
+  };
+
+  const toggleRange = name => () => {
+    if (activeTool === name) {
+      setPending([...pending, {filter: name, [RANGES[name].arg]: level}]);
+      setActiveTool(null);
+      setLevel(null);
+    } else {
+      setActiveTool(name);
+      setLevel(RANGES[name].start);
+    }
+    setShownLevel(null);
+  };
+
+  const discardPending = () => {
+    setPending([]);
+    setActiveTool(null);
+    setCrop(null);
+    setLevel(null);
+  };
+
+  // The whole stack is saved at once, so the asset is exported once.
+  const savePending = () => fetch(`/asset/${slug}/filters/`, {
+    method: 'post', body: new URLSearchParams({filters: JSON.stringify(pending)})
+  }).then(res => res.json()).then(asset => { setAsset(asset); setPending([]); });
+
   const deleteAsset = () => {
     if (window.confirm('Really delete?')) {
       fetch(`/asset/${slug}/`, {method: 'delete'}).then(() => hist.go(-1));
@@ -58,9 +125,10 @@ const Edit = ({refresh}) => {
     </Breadcrumbs>
 
     <div className='edit asset'>{
+      crop ? <ReactCrop src={preview} crop={crop} onChange={(_, crop) => setCrop(crop)} /> :
+      previewed.length ? <img src={preview} /> :
       asset.medium === 'video' ? <video key={asset.id} controls><source src={src} /></video> :
       asset.medium === 'audio' ? <audio key={asset.id} controls><source src={src} /></audio> :
-      crop ? <ReactCrop src={src} crop={crop} onChange={(_, crop) => setCrop(crop)} /> :
       <img src={src} />
     }</div>
     <TagGroups className='edit' assets={asset.id ? [asset] : []} hideEditable={true}
@@ -73,26 +141,39 @@ const Edit = ({refresh}) => {
       <span className='spacer' />
       <Tool name='crop'
             icon='✂'
-            iconWhenActive={'✕'}
+            iconWhenActive={'✓'}
             activeTool={activeTool}
-            onClick={() => {
-              setActiveTool('crop');
-              setCrop({unit: '%', width: 80, height: 80, x: 10, y: 10});
-            }}/>
+            onClick={toggleCrop}/>
       <span className='spacer' />
-      <Tool name='vflip' icon='↕' activeTool={activeTool} />
-      <Tool name='hflip' icon='↔' activeTool={activeTool} />
-      <Tool name='ccw' icon='⤷' activeTool={activeTool} />
-      <Tool name='cw' icon='⤶' activeTool={activeTool} />
+      <Tool name='vflip' icon='↕' activeTool={activeTool}
+            onClick={addPending({filter: 'vflip'})} />
+      <Tool name='hflip' icon='↔' activeTool={activeTool}
+            onClick={addPending({filter: 'hflip'})} />
+      <Tool name='ccw' icon='⤷' activeTool={activeTool}
+            onClick={addPending({filter: 'rotate', degrees: -90})} />
+      <Tool name='cw' icon='⤶' activeTool={activeTool}
+            onClick={addPending({filter: 'rotate', degrees: 90})} />
       <Tool name='rotate' icon='⟳' activeTool={activeTool} />
       <span className='spacer' />
-      <Tool name='contrast' icon='◑' activeTool={activeTool} />
-      <Tool name='brightness' icon='☀' activeTool={activeTool} />
-      <Tool name='saturation' icon='▧' activeTool={activeTool} />
-      <Tool name='hue' icon='🎨' activeTool={activeTool} />
+      <Tool name='contrast' icon='◑' iconWhenActive='✓' activeTool={activeTool}
+            onClick={toggleRange('contrast')} />
+      <Tool name='brightness' icon='☀' iconWhenActive='✓' activeTool={activeTool}
+            onClick={toggleRange('brightness')} />
+      <Tool name='saturation' icon='▧' iconWhenActive='✓' activeTool={activeTool}
+            onClick={toggleRange('saturation')} />
+      <Tool name='hue' icon='🎨' iconWhenActive='✓' activeTool={activeTool}
+            onClick={toggleRange('hue')} />
       <span className='spacer' />
       <Tool name='magic' icon='🪄'  activeTool={activeTool} />
+      <span className='spacer' />
+      <Button name='discard' icon='↶' disabled={!pending.length && activeTool === null}
+              onClick={discardPending} />
+      <Button name='save' icon='✓' disabled={!pending.length || activeTool !== null}
+              onClick={savePending} />
     </div>
+    {RANGES[activeTool] && <input type='range' className='edit range'
+                                  min={RANGES[activeTool].min} max={RANGES[activeTool].max}
+                                  value={level} onChange={ev => setLevel(Number(ev.target.value))} />}
     <ul className='edit filters'>
       {(asset.filters || []).map(
         (f, i) => <li key={i}><span>{f}</span><span className='remove'>🗑</span></li>)}
@@ -71,7 +71,7 @@ const Thumb = ({asset, handleClick, cursored, selected}) => {
     asset.medium,
     cursored ? 'cursored' : '',
     selected ? 'selected' : '',
-  ], src = still => `/asset/${asset.slug}/read/thumb/?s=${still ? '1' : '0'}`;
+  ], src = still => `/asset/${asset.slug}/read/thumb/?s=${still ? '1' : '0'}&v=${asset.version}`;
   return !asset.id ? <Spinner /> : <div className={classes.join(' ')}>
     <img src={src(true)}
          title={asset.tags.join(' ')}
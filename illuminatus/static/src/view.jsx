@@ -8,7 +8,7 @@ import './view.styl'
 
 
 const Full = ({asset}) => {
-  const src = `/asset/${asset.slug}/read/full/`;
+  const src = `/asset/${asset.slug}/read/full/?v=${asset.version}`;
   return <div className='view asset'>{
     asset.medium === 'video' ?
     <video key={asset.id} autoPlay controls><source src={src} /></video> :
@@ -1,4 +1,5 @@
 import click
+import functools
 import re
 import sqlalchemy
 
@@ -44,33 +45,48 @@ class Tag(db.Model):
         r'.*',
     )
 
+    # Indices of patterns in each group of tags.
+    DATE = range(0, 22)
+    TIME = range(22, 28)
+    METADATA = range(28, 36)
+    USER = len(PATTERNS) - 1
+
+    # Background colors for each pattern, used when printing tags.
+    COLORS = (['red'] * 1 + ['yellow'] * 12 + ['green'] * 2 + ['cyan'] * 7 +
+              ['blue'] * 6 + ['magenta'] * 8 + ['white'] * 4 + ['red'] * 1)
+
     def __repr__(self):
-        colors = (['red'] * 1 + ['yellow'] * 12 + ['green'] * 2 + ['cyan'] * 7 +
-                  ['blue'] * 6 + ['magenta'] * 8 + ['white'] * 4 + ['red'] * 1)
-        return click.style(f' {self.name} ', bg=colors[self.pattern], fg='black')
+        return Tag.style(self.name)
 
     @property
     def pattern(self):
-        for i, pattern in enumerate(Tag.PATTERNS):
-            if pattern == self.name or re.match(pattern, self.name):
-                return i
-        return None
+        return Tag.classify(self.name)
+
+    @staticmethod
+    def classify(name):
+        '''Get the index of the first pattern in PATTERNS matching a tag name.'''
+        return _classify(name)
+
+    @staticmethod
+    def style(name):
+        '''Format a tag name for terminal output, colored by its pattern.'''
+        return click.style(f' {name} ', bg=Tag.COLORS[Tag.classify(name)], fg='black')
 
     @property
     def is_date(self):
-        return self.pattern in set(range(22))
+        return self.pattern in Tag.DATE
 
     @property
     def is_time(self):
-        return self.pattern in set(range(22, 28))
+        return self.pattern in Tag.TIME
 
     @property
     def is_metadata(self):
-        return self.pattern in set(range(28, 36))
+        return self.pattern in Tag.METADATA
 
     @property
     def is_user(self):
-        return self.pattern == len(Tag.PATTERNS) - 1
+        return self.pattern == Tag.USER
 
     @staticmethod
     def canonical_form(tag):
@@ -80,6 +96,22 @@ class Tag(db.Model):
         return dict(id=self.id, name=self.name)
 
 
+# Tag renames and deletions make cached tag annotations stale.
+db.track_writes(Tag.__table__)
+
+
+# All of the tag patterns as one regular expression, with a named group for
+# each pattern. Alternatives are tried in order, so the group that matches is
+# the first pattern that matches.
+_PATTERN = re.compile('|'.join(f'(?P<p{i}>{p})' for i, p in enumerate(Tag.PATTERNS)))
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _classify(name):
+    match = _PATTERN.match(name)
+    return match and int(match.lastgroup[1:])
+
+
 class Label(db.Model):
     __tablename__ = 'labels'
 
@@ -0,0 +1,70 @@
+import functools
+import os
+import sqlite3
+import threading
+import time
+
+# Name of the database, in the thumbnails root, of times renders were read.
+FILENAME = '.usage.db'
+
+# Seconds between recorded reads of one render, so that popular thumbnails
+# don't cost a database write on every request.
+RESOLUTION = 3600
+
+
+class Usage:
+    '''Times that renders were last read, kept in an SQLite database.
+
+    Parameters
+    ----------
+    root : str
+        Root directory for thumbnails.
+    '''
+
+    def __init__(self, root):
+        self.path = os.path.join(root, FILENAME)
+        self._local = threading.local()
+        self._recorded = {}
+        with self._db() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS reads (
+                              key TEXT PRIMARY KEY,
+                              atime REAL NOT NULL)''')
+
+    def _db(self):
+        # SQLite connections can't be shared between threads.
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=60)
+            db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    def record(self, key, now=None):
+        '''Note that a render was read.
+
+        Parameters
+        ----------
+        key : str
+            Key of the render; see :func:`assets.render_key`.
+        now : float, optional
+            Time of the read, in seconds since the epoch. Defaults to now.
+        '''
+        now = time.time() if now is None else now
+        if now - self._recorded.get(key, -RESOLUTION) < RESOLUTION:
+            return
+        if len(self._recorded) > 100000:
+            self._recorded.clear()
+        self._recorded[key] = now
+        with self._db() as db:
+            db.execute('INSERT INTO reads (key, atime) VALUES (?, ?) '
+                       'ON CONFLICT (key) DO UPDATE SET atime = excluded.atime',
+                       (key, now))
+
+    def times(self):
+        '''Get a mapping from render keys to the times they were last read.'''
+        return dict(self._db().execute('SELECT key, atime FROM reads'))
+
+
+@functools.lru_cache()
+def usage(root):
+    '''Get the read times of renders under a thumbnails root.'''
+    return Usage(root)
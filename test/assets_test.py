@@ -1,4 +1,9 @@
 import arrow
+import glob
+import os
+import shutil
+import sqlalchemy
+import time
 
 from util import *
 
@@ -56,3 +61,130 @@ def test_video_content_hashes(sess):
     asset = sess.query(Asset).get(3)
     asset.compute_content_hashes()
     assert set(h.nibbles for h in asset.hashes) == {'video', 'e8e0fcd8b8f8f8f4'}
+
+
+def test_version_follows_filters_and_formats(sess):
+    asset = sess.query(Asset).get(PHOTO_ID)
+    formats = dict(photo=dict(thumb=dict(bbox=[100, 100])))
+    version = asset.version(formats)
+    asset.add_filter(dict(filter='rotate', degrees=90))
+    assert asset.version(formats) != version
+    asset.remove_filter('rotate')
+    assert asset.version(formats) == version
+    assert asset.version(dict(photo=dict(thumb=dict(bbox=[200, 200])))) != version
+    assert asset.version(dict(video=formats['photo'])) != version
+
+
+def test_render_key_follows_file_content(tmp_path):
+    path = str(tmp_path / 'photo.jpg')
+    shutil.copyfile(PHOTO_PATH, path)
+    asset = Asset(slug='photo', path=path, medium='photo', width=10, height=10)
+    asset.update_from_file()
+    thumb = dict(bbox=[100, 100])
+    key = asset.path_for_render('/t', thumb)
+    # Edit the file in place, keeping its dimensions.
+    with open(path, 'ab') as handle:
+        handle.write(b'\0')
+    os.utime(path, (0, 0))
+    asset.update_from_file()
+    assert asset.path_for_render('/t', thumb) != key
+
+
+def test_render_paths_follow_filters(sess):
+    asset = sess.query(Asset).get(PHOTO_ID)
+    thumb = dict(bbox=[100, 100])
+    path = asset.path_for_render('/t', thumb)
+    assert path.startswith('/t/.renders/') and path.endswith('.jpg')
+    assert asset.path_for_render('/t', dict(bbox=[200, 200])) != path
+    assert asset.path_for_render('/t', thumb, ext='png') == path[:-3] + 'png'
+    asset.add_filter(dict(filter='rotate', degrees=90))
+    assert asset.path_for_render('/t', thumb) != path
+    asset.remove_filter('rotate')
+    assert asset.path_for_render('/t', thumb) == path
+
+
+def test_collect_renders(tmpdir):
+    root = str(tmpdir)
+    old, new = time.time() - 86400, time.time()
+    for name, mtime in (('aaa.jpg', old), ('bbb.webp', old), ('bbb.png', old),
+                        ('ccc.jpg', new), ('ddd.jpg', old)):
+        path = tmpdir.join('.renders', name[:2], name)
+        path.write('x', ensure=True)
+        os.utime(str(path), (mtime, mtime))
+    # Scratch directories of exports in progress are left alone.
+    scratch = tmpdir.join('.renders', 'ee', '.export-1', 'eee.jpg')
+    scratch.write('x', ensure=True)
+    os.utime(str(scratch), (old, old))
+    assert illuminatus.assets.collect_renders(root, {'aaa'}, 3600) == 3
+    remaining = sorted(os.path.basename(p) for p in glob.glob(f'{root}/.renders/*/*'))
+    assert remaining == ['aaa.jpg', 'ccc.jpg']
+    assert scratch.check()
+
+
+def test_collect_proxies(tmpdir):
+    root = str(tmpdir)
+    old, new = time.time() - 86400, time.time()
+    for slug, mtime in (('video', old), ('gone', old), ('fresh', new)):
+        path = tmpdir.join('.proxy', slug[0], f'{slug}.mp4')
+        path.write('x', ensure=True)
+        os.utime(str(path), (mtime, mtime))
+    assert illuminatus.assets.collect_proxies(root, {'video'}, 3600) == 1
+    remaining = sorted(os.path.basename(p) for p in glob.glob(f'{root}/.proxy/*/*'))
+    assert remaining == ['fresh.mp4', 'video.mp4']
+
+
+def test_evict_renders(tmpdir):
+    root = str(tmpdir)
+    paths = []
+    for name, size in (('aa.webm', 400), ('bb.webm', 300), ('cc.webm', 200), ('dd.webm', 100)):
+        path = tmpdir.join('.renders', name[:2], name)
+        path.write('x' * size, ensure=True)
+        os.utime(str(path), (1000, 1000))
+        paths.append(str(path))
+    tmpdir.join('.renders', 'cc', 'cc.png').write('x' * 50)
+    paths.append(str(tmpdir.join('.renders', 'ee', 'ee.webm')))
+    # aa and cc were read recently; bb and dd count from their mtimes.
+    read_times = dict(aa=3000, cc=2000)
+    removed, freed = illuminatus.assets.evict_renders(root, paths, 700, read_times)
+    assert (removed, freed) == (2, 400)
+    remaining = sorted(os.path.basename(p) for p in glob.glob(f'{root}/.renders/*/*'))
+    assert remaining == ['aa.webm', 'cc.png', 'cc.webm']
+
+
+@MEDIA
+def test_video_proxy(sess, tmpdir, monkeypatch):
+    asset = sess.query(Asset).get(VIDEO_ID)
+    proxy = asset.proxy_path(str(tmpdir))
+    asset.export_proxy(proxy, (160, 160))
+    width, height = illuminatus.ffmpeg.frame_size(proxy)
+    assert max(width, height) <= 160 and width % 2 == height % 2 == 0
+
+    # Hashes of the proxy's frames are close to those of the original.
+    asset.compute_content_hashes(proxy=proxy)
+    nibbles, = set(h.nibbles for h in asset.hashes) - {'video'}
+    assert sum(a != b for a, b in zip(nibbles, 'e8e0fcd8b8f8f8f4')) <= 1
+
+    sources, run_all = [], illuminatus.ffmpeg.run_all
+
+    def spy(asset, outputs, source=None):
+        sources.append(source)
+        return run_all(asset, outputs, source)
+
+    monkeypatch.setattr(illuminatus.ffmpeg, 'run_all', spy)
+    small, big = str(tmpdir.join('small.webm')), str(tmpdir.join('big.webm'))
+    asset.export_all([(small, dict(bbox=(100, 100), tier='fast')),
+                      (big, dict(bbox=(1080, 1080), tier='fast'))], proxy=proxy)
+    assert sources == [proxy, None]
+    assert os.path.exists(small) and os.path.exists(big)
+
+
+def test_upgrade_adds_missing_columns(tmp_path):
+    engine = illuminatus.db.engine(str(tmp_path / 'old.db'))
+    with engine.begin() as conn:
+        conn.execute(sqlalchemy.text(
+            'CREATE TABLE assets (id INTEGER PRIMARY KEY, slug VARCHAR, '
+            'medium VARCHAR, path VARCHAR, caption VARCHAR)'))
+        illuminatus.db.upgrade(conn)
+        columns = {row[1] for row in conn.execute(sqlalchemy.text(
+            'PRAGMA table_info(assets)'))}
+    assert {'file_size', 'file_mtime', 'width', 'filters'} <= columns
@@ -0,0 +1,72 @@
+from util import *
+
+import json
+import subprocess
+import threading
+
+from illuminatus import budget
+
+
+@pytest.mark.parametrize('budget_, weight, others, claimed, slots, expected', [
+    (16, 4, [], 0, 1, 16),
+    (16, 4, [4], 0, 1, 8),
+    (16, 4, [4], 14, 1, 2),
+    (16, 4, [4], 16, 1, 0),
+    (16, 1, [4, 4, 4], 0, 1, 1),
+    (16, 4, [4, 1, 1, 2], 0, 1, 5),
+    (2, 1, [4] * 9, 0, 1, 1),
+    (16, 4, [], 0, 4, 4),
+    (16, 4, [4, 4], 8, 4, 4),
+])
+def test_allot(budget_, weight, others, claimed, slots, expected):
+    assert budget.allot(budget_, weight, others, claimed, slots) == expected
+
+
+def test_claim(tmpdir):
+    path = str(tmpdir.join('cpu.json'))
+    with budget.claim('video', 16, path) as video:
+        assert video == budget.threads() == 16
+        with budget.claim('photo', 16, path) as photo:
+            assert photo == 16
+            assert len(json.load(open(path))) == 1
+        assert budget.threads() == 16
+    assert json.load(open(path)) == {}
+    assert budget.threads() == max(1, os.cpu_count() // 4)
+
+
+@pytest.mark.parametrize('slots', [1, 4, 10])
+def test_claims_fit_budget(tmpdir, slots):
+    path = str(tmpdir.join('cpu.json'))
+    media = ['video'] * 10 + ['photo', 'audio'] * 5
+    claimed = [budget._register(path, f'job-{i}', budget.WEIGHTS[m], 16, slots)
+               for i, m in enumerate(media)]
+    assert claimed[0] > 0
+    assert sum(claimed) <= 16
+    assert sum(j['threads'] for j in json.load(open(path)).values()) == sum(claimed)
+
+
+def test_claim_waits_for_budget(tmpdir):
+    path = str(tmpdir.join('cpu.json'))
+    with open(path, 'w') as handle:
+        json.dump({'busy': dict(pid=os.getpid(), weight=4, threads=8)}, handle)
+
+    def finish():
+        with budget._jobs(path) as jobs:
+            jobs.pop('busy')
+
+    timer = threading.Timer(0.2, finish)
+    timer.start()
+    with budget.claim('video', 8, path, poll=0.05) as threads:
+        assert threads == 8
+    timer.join()
+
+
+def test_claim_drops_dead_jobs(tmpdir):
+    path = str(tmpdir.join('cpu.json'))
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+    with open(path, 'w') as handle:
+        json.dump({f'{proc.pid}-0': dict(pid=proc.pid, weight=4)}, handle)
+    with budget.claim('audio', 8, path) as threads:
+        assert threads == 8
+        assert list(json.load(open(path))) != [f'{proc.pid}-0']
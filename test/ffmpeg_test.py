@@ -1,5 +1,10 @@
 from util import *
 
+import json
+import math
+import subprocess
+import time
+
 
 @MEDIA
 @pytest.mark.parametrize('filters', [
@@ -50,3 +55,101 @@ def test_photo_filters(sess, tmpdir, filters):
     assert root.listdir() == []
     photo.export(target)
     assert sorted(root.listdir()) == [target]
+
+
+@MEDIA
+def test_video_export_all(sess, tmpdir):
+    video = sess.query(Asset).get(VIDEO_ID)
+    root = tmpdir.mkdir('export')
+    outputs = [(str(root.join(f'{video.slug}.{ext}')), dict(bbox=(100, 100), fps=5))
+               for ext in ('gif', 'webm')]
+    video.export_all(outputs)
+    assert sorted(root.listdir()) == sorted(
+        str(root.join(f'{video.slug}.{ext}')) for ext in ('gif', 'png', 'webm'))
+
+
+@pytest.fixture(scope='module')
+def long_video(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('long').joinpath('long.mp4'))
+    subprocess.run(['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi',
+                    '-i', 'testsrc2=size=64x48:rate=10:duration=3600',
+                    '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '50', path],
+                   check=True)
+    return path
+
+
+@pytest.mark.parametrize('ext, filters', [
+    ('gif', None),
+    ('webm', '[{"filter": "extract", "start": 1800, "duration": 2}, '
+             '{"filter": "extract", "start": 3500, "duration": 2}]'),
+])
+def test_clip_exports_seek_input(tmpdir, long_video, ext, filters):
+    video = Asset(path=long_video, medium='video', duration=3600,
+                  width=64, height=48, filters=filters)
+
+    start = time.time()
+    subprocess.run(['ffmpeg', '-v', 'error', '-i', long_video, '-f', 'null', '-'],
+                   check=True)
+    decode = time.time() - start
+
+    target = str(tmpdir.join(f'long.{ext}'))
+    start = time.time()
+    illuminatus.ffmpeg.run_all(video, [(target, dict(bbox=(64, 64), fps=5))])
+    clip = time.time() - start
+
+    assert os.path.exists(target)
+    assert clip < decode / 2
+
+
+@pytest.mark.parametrize('orientation, filters, size, chain', [
+    (None, [], (640, 480), ()),
+    (6, [], (480, 640), ('transpose', 'hflip')),
+    (None, [dict(filter='rotate', degrees=90),
+            dict(filter='crop', x1=0, y1=0, x2=0.5, y2=0.5)],
+     (240, 320), (illuminatus.ffmpeg._rotate(math.pi / 2), 'crop=240:320:0:0')),
+    (None, [dict(filter='scale', factor=0.33)], (210, 158),
+     (illuminatus.ffmpeg._scale(210, 158),)),
+    (None, [dict(filter='extract', start=1, duration=2), dict(filter='vflip')],
+     (640, 480), ('vflip',)),
+])
+def test_compile_filters(orientation, filters, size, chain):
+    graph = illuminatus.ffmpeg.compile_filters(orientation, 640, 480, json.dumps(filters))
+    assert graph.size == size
+    assert illuminatus.ffmpeg._filter_chain(graph.steps) == chain
+    assert illuminatus.ffmpeg.compile_filters(orientation, 640, 480, json.dumps(filters)) is graph
+
+
+def test_compile_filters_leaves_autoorient_alone():
+    before = json.dumps(illuminatus.ffmpeg._AUTOORIENT)
+    illuminatus.ffmpeg.compile_filters(8, 640, 480, '[]')
+    illuminatus.ffmpeg.compile_filters(8, 320, 240, '[{"filter": "hflip"}]')
+    assert json.dumps(illuminatus.ffmpeg._AUTOORIENT) == before
+
+
+@pytest.mark.parametrize('ext, tier, expected', [
+    ('mp4', 'fast', ['-c:v', 'libx264', '-c:a', 'aac', '-preset', 'veryfast']),
+    ('mp4', 'archive', ['-c:v', 'libx264', '-c:a', 'aac', '-preset', 'slow']),
+    ('webm', 'fast', ['-c:v', 'libvpx-vp9', '-c:a', 'libopus', '-deadline', 'realtime']),
+    ('webm', 'balanced', ['-c:v', 'libvpx-vp9', '-c:a', 'libopus', '-deadline', 'good']),
+    ('mp3', 'fast', []),
+])
+def test_encoder_args(monkeypatch, ext, tier, expected):
+    monkeypatch.setattr(illuminatus.ffmpeg, 'encoders', lambda: frozenset(
+        ('aac', 'libopus', 'libvpx-vp9', 'libx264', 'mpeg4')))
+    assert illuminatus.ffmpeg.encoder_args(ext, tier)[:len(expected)] == expected
+
+
+def test_encoder_args_fallback(monkeypatch):
+    monkeypatch.setattr(illuminatus.ffmpeg, 'encoders', lambda: frozenset(('aac', 'mpeg4')))
+    assert illuminatus.ffmpeg.encoder_args('mp4')[:4] == ['-c:v', 'mpeg4', '-c:a', 'aac']
+    with pytest.raises(ValueError):
+        illuminatus.ffmpeg.encoder_args('mp4', 'fastest')
+
+
+@MEDIA
+@pytest.mark.parametrize('tier', illuminatus.ffmpeg.TIERS)
+def test_video_export_tiers(sess, tmpdir, tier):
+    video = sess.query(Asset).get(VIDEO_ID)
+    target = str(tmpdir.join(f'{video.slug}.mp4'))
+    video.export(target, bbox=(100, 100), tier=tier)
+    assert os.path.exists(target)
@@ -0,0 +1,82 @@
+from util import *
+
+import time
+
+from illuminatus import pack
+
+
+def _files(tmpdir, contents):
+    paths = []
+    for name, data in contents.items():
+        path = tmpdir.join('loose', name)
+        path.write_binary(data, ensure=True)
+        paths.append(str(path))
+    return paths
+
+
+def _read(store, name):
+    handle, size, _ = store.open(name)
+    with handle:
+        return handle.read(size)
+
+
+def test_add_and_open(tmpdir):
+    store = pack.Store(str(tmpdir))
+    contents = {'aa.jpg': b'photo', 'bb.webp': b'animation', 'bb.png': b'poster'}
+    assert store.add(_files(tmpdir, contents)) == 3
+    assert tmpdir.join('loose').listdir() == []
+    for name, data in contents.items():
+        assert _read(store, name) == data
+    assert store.open('cc.jpg') is None
+    assert sorted(store.names('bb')) == ['bb.png', 'bb.webp']
+
+
+def test_segments_roll_over(tmpdir):
+    store = pack.Store(str(tmpdir), segment_size=10)
+    contents = {f'{i:02d}.jpg': bytes([i]) * 8 for i in range(5)}
+    store.add(_files(tmpdir, contents))
+    assert len(store.segments()) == 3
+    for name, data in contents.items():
+        assert _read(store, name) == data
+
+
+def test_remove_and_compact(tmpdir):
+    store = pack.Store(str(tmpdir), segment_size=16)
+    contents = {f'{i:02d}.jpg': bytes([i]) * 8 for i in range(6)}
+    store.add(_files(tmpdir, contents))
+    store.remove(['00', '01', '02'])
+    assert store.open('01.jpg') is None
+    assert store.compact() == 16 + 8
+    for name, data in contents.items():
+        if name >= '03':
+            assert _read(store, name) == data
+    assert sum(os.path.getsize(store._segment_path(s)) for s in store.segments()) == 24
+
+
+def test_collect(tmpdir):
+    store = pack.Store(str(tmpdir))
+    store.add(_files(tmpdir, {'aa.jpg': b'a', 'bb.jpg': b'b', 'cc.jpg': b'c'}))
+    assert store.collect({'aa'}, 3600) == 0
+    store._db().execute('UPDATE entries SET mtime = ?', (time.time_ns() - 86400 * 10**9, ))
+    store.touch(['cc'])
+    assert store.collect({'aa'}, 3600) == 1
+    assert store.open('bb.jpg') is None and store.open('cc.jpg') is not None
+
+
+def test_extract(tmpdir):
+    store = pack.Store(str(tmpdir))
+    store.add(_files(tmpdir, {'bb.webp': b'animation', 'bb.png': b'poster'}))
+    stem = str(tmpdir.join('zip', 'thumb', '2020-01-01-bb'))
+    assert store.extract('bb', stem) == 2
+    assert open(stem + '.webp', 'rb').read() == b'animation'
+    assert open(stem + '.png', 'rb').read() == b'poster'
+
+
+def test_extract_skips_removed(tmpdir, monkeypatch):
+    store = pack.Store(str(tmpdir))
+    store.add(_files(tmpdir, {'bb.webp': b'animation'}))
+    names = store.names
+    monkeypatch.setattr(store, 'names', lambda key: names(key) + ['bb.png'])
+    stem = str(tmpdir.join('zip', 'thumb', '2020-01-01-bb'))
+    assert store.extract('bb', stem) == 1
+    assert not os.path.exists(stem + '.png')
@@ -0,0 +1,109 @@
+import io
+import PIL.Image
+
+from util import *
+
+from illuminatus import ffmpeg, pillow
+
+
+@pytest.fixture
+def photo(sess):
+    photo = sess.query(Asset).get(PHOTO_ID)
+    photo.width, photo.height = PIL.Image.open(photo.path).size
+    return photo
+
+
+@pytest.mark.parametrize('filters', [
+    [],
+    [dict(filter='rotate', degrees=10)],
+    [dict(filter='rotate', degrees=90)],
+    [dict(filter='crop', x1=0.1, y1=0.1, x2=0.8, y2=0.8)],
+    [dict(filter='saturation', percent=110)],
+    [dict(filter='brightness', percent=90)],
+    [dict(filter='contrast', percent=90)],
+    [dict(filter='autocontrast', percent=1)],
+    [dict(filter='hue', degrees=90)],
+    [dict(filter='vflip')],
+    [dict(filter='hflip')],
+])
+def test_matches_ffmpeg(photo, tmpdir, filters):
+    for filter in filters:
+        photo.add_filter(filter)
+    ours, theirs = str(tmpdir.join('ours.png')), str(tmpdir.join('theirs.png'))
+    assert pillow.render(photo, [(ours, dict(bbox=[200, 200]))]) == []
+    ffmpeg.run(photo, theirs, bbox=[200, 200])
+    ours, theirs = PIL.Image.open(ours), PIL.Image.open(theirs)
+    assert abs(ours.width - theirs.width) <= 2
+    assert abs(ours.height - theirs.height) <= 2
+
+
+def test_all_outputs_from_one_decode(photo, tmpdir):
+    outputs = [(str(tmpdir.join('thumb.jpg')), dict(bbox=[100, 100])),
+               (str(tmpdir.join('full.webp')), dict(bbox=[300, 300], quality=50)),
+               (str(tmpdir.join('full.mp4')), dict(bbox=[300, 300]))]
+    assert pillow.render(photo, outputs) == outputs[2:]
+    assert PIL.Image.open(outputs[0][0]).size == (100, 67)
+    assert PIL.Image.open(outputs[1][0]).size == (300, 201)
+
+
+@pytest.fixture
+def transparent(tmpdir):
+    path = str(tmpdir.join('transparent.png'))
+    img = PIL.Image.new('RGBA', (40, 20), (200, 100, 50, 255))
+    img.paste((0, 0, 0, 0), (0, 0, 20, 20))
+    img.save(path)
+    return Asset(slug='transparent', path=path, medium='photo', width=40, height=20)
+
+
+@pytest.mark.parametrize('filters', [
+    [],
+    [dict(filter='brightness', percent=90)],
+    [dict(filter='contrast', percent=90), dict(filter='hue', degrees=90)],
+    [dict(filter='saturation', percent=110), dict(filter='autocontrast', percent=1)],
+    [dict(filter='crop', x1=0.25, y1=0, x2=1, y2=1), dict(filter='hflip')],
+])
+def test_keeps_alpha(transparent, tmpdir, filters):
+    for filter in filters:
+        transparent.add_filter(filter)
+    png, jpg = str(tmpdir.join('out.png')), str(tmpdir.join('out.jpg'))
+    assert pillow.render(transparent, [(png, {}), (jpg, {})]) == []
+    png, jpg = PIL.Image.open(png), PIL.Image.open(jpg)
+    assert (png.mode, jpg.mode) == ('RGBA', 'RGB')
+    assert png.getchannel('A').getextrema() == (0, 255)
+
+
+def test_export_all(photo, tmpdir):
+    photo.add_filter(dict(filter='crop', x1=0, y1=0, x2=0.5, y2=1))
+    root = tmpdir.mkdir('export')
+    outputs = [(str(root.join('a', 'thumb.png')), dict(bbox=[50, 50])),
+               (str(root.join('b', 'full.jpg')), {})]
+    photo.export_all(outputs)
+    assert sorted(os.listdir(root.join('a'))) == ['thumb.png']
+    assert PIL.Image.open(outputs[0][0]).size == (37, 50)
+    assert PIL.Image.open(outputs[1][0]).size == (200, 268)
+
+
+@pytest.mark.parametrize('filters, aspect', [
+    ([], lambda r: r),
+    ([dict(filter='rotate', degrees=90)], lambda r: 1 / r),
+    ([dict(filter='crop', x1=0, y1=0, x2=0.5, y2=1)], lambda r: r / 2),
+    ([dict(filter='hflip'), dict(filter='contrast', percent=120)], lambda r: r),
+])
+def test_preview(photo, filters, aspect):
+    img = PIL.Image.open(io.BytesIO(pillow.preview(photo, filters, size=120)))
+    assert img.format == 'JPEG'
+    assert max(img.size) == 120
+    assert abs(img.width / img.height - aspect(photo.width / photo.height)) < 0.05
+
+
+def test_preview_leaves_cache_alone(photo):
+    first = pillow.preview(photo, [], size=120)
+    pillow.preview(photo, [dict(filter='vflip')], size=60)
+    assert pillow.preview(photo, [], size=120) == first
+
+
+@MEDIA
+def test_preview_video(sess):
+    video = sess.query(Asset).get(VIDEO_ID)
+    img = PIL.Image.open(io.BytesIO(pillow.preview(video, [dict(filter='hflip')], size=100)))
+    assert max(img.size) == 100
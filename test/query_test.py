@@ -1,4 +1,6 @@
 import arrow
+import sqlalchemy
+import parsimonious
 
 from util import *
 
@@ -51,11 +53,191 @@ from illuminatus import query
 
     ('path:photo', 'photo'),
     ('path:video', 'video'),
+    ('path:PHOTO', 'photo'),
+    ('path:.j', 'photo'),
+    ('path:cake', ''),
+
+    ('text:cake', 'video'),
+    ('text:audio', 'audio'),
+    ('text:mp', 'audio video'),
+    ('text:"', ''),
+    ('text:cake not b', ''),
+
+    ('near:40.7128,-74.006,1', 'photo'),
+    ('near:40.7306,-73.9866,1', 'video'),
+    ('near:40.72,-74.0,5', 'photo video'),
+    ('near:0,0,100', ''),
+    ('bbox:40,-75,41,-73', 'photo video'),
+    ('bbox:41,-73,40,-74', 'video'),
+    ('bbox:0,0,1,1', ''),
+    ('a bbox:40,-75,41,-73', 'photo'),
 ])
 def test_assets(sess, qs, ids):
     matching = query.assets(sess, [qs])
     assert set(a.slug for a in matching) == set(ids.split())
 
 
+@pytest.mark.parametrize('lng1, lng2, expected', [
+    (-75, -73, [(-75, -73)]),
+    (-73, -75, [(-75, -73)]),
+    (170, 190, [(170, 180), (-180, -170)]),
+    (-190, -170, [(170, 180), (-180, -170)]),
+    (190, 200, [(-170, -160)]),
+    (-180, 180, [(-180, 180)]),
+    (-200, 200, [(-180, 180)]),
+])
+def test_lng_ranges(lng1, lng2, expected):
+    assert query._lng_ranges(lng1, lng2) == expected
+
+
+@pytest.mark.parametrize('qs, ids', [
+    ('near:0,180,50', 'photo video'),
+    ('near:0,-180,50', 'photo video'),
+    ('near:0,179.9,5', 'photo'),
+    ('bbox:-1,179,1,181', 'photo video'),
+    ('bbox:-1,-181,1,-179.5', 'photo video'),
+    ('bbox:-1,179,1,180', 'photo'),
+])
+def test_assets_across_antimeridian(sess, qs, ids):
+    sess.query(Asset).get(PHOTO_ID).lat = 0
+    sess.query(Asset).get(PHOTO_ID).lng = 179.9
+    sess.query(Asset).get(VIDEO_ID).lat = 0
+    sess.query(Asset).get(VIDEO_ID).lng = -179.9
+    sess.flush()
+    matching = query.assets(sess, [qs])
+    assert set(a.slug for a in matching) == set(ids.split())
+
+
+@pytest.mark.parametrize('qs', ['near:1.2.3,4,5', 'near:1,2,-3', 'bbox:1,2,3', 'bbox:.,1,2,3'])
+def test_bad_locations(sess, qs):
+    with pytest.raises(parsimonious.exceptions.ParseError):
+        query.assets(sess, [qs])
+
+
+@pytest.mark.parametrize('qs, zoom, counts', [
+    ('', 0, [2]),
+    ('', 10, [1, 1]),
+    ('a', 10, [1]),
+    ('audio', 10, []),
+])
+def test_tiles(sess, qs, zoom, counts):
+    tiles = query.tiles(sess, [qs], zoom)
+    assert sorted(t['count'] for t in tiles) == counts
+    for t in tiles:
+        assert 0 <= t['x'] < 2 ** zoom
+        assert 0 <= t['y'] < 2 ** zoom
+    if zoom == 10 and len(tiles) == 2:
+        assert {(t['x'], t['y']) for t in tiles} == {(301, 385), (301, 384)}
+
+
+@pytest.mark.parametrize('zoom', [-1, 31, 64])
+def test_tiles_zoom_out_of_range(sess, zoom):
+    with pytest.raises(ValueError):
+        query.tiles(sess, [''], zoom)
+
+
+def test_parse_cache(sess):
+    query._parse.cache_clear()
+    before = query.TIMINGS['parse_calls']
+    for _ in range(3):
+        matching = query.assets(sess, ['(a or b) not c'])
+        assert set(a.slug for a in matching) == {'photo'}
+    info = query._parse.cache_info()
+    assert (info.hits, info.misses) == (2, 1)
+    assert query.TIMINGS['parse_calls'] == before + 3
+    assert query.stats()['parse_cache']['hits'] == 2
+
+
+@pytest.mark.parametrize('load, unloaded', [
+    (None, {'hashes', 'labels'}),
+    ('detail', {'labels'}),
+    ('listing', {'hashes', 'labels', 'caption', 'filters'}),
+    ('bulk-write', {'caption', 'filters'}),
+    ('ids-only', {'_tags', 'hashes', 'labels', 'path', 'stamp', 'caption'}),
+])
+def test_load_profiles(sess, load, unloaded):
+    asset, = query.assets(sess, ['video'], load=load)
+    state = sqlalchemy.inspect(asset)
+    assert unloaded <= state.unloaded
+    assert not ({'id', 'slug'} & state.unloaded)
+    assert asset.caption == 'Birthday cake!'
+
+
+def test_bulk_write_deletes_cascade(sess):
+    for asset in query.assets(sess, ['b'], load='bulk-write'):
+        sess.delete(asset)
+    sess.flush()
+    assert sess.query(Hash).count() == 1
+
+
 def test_parse_order():
     query.parse_order('stamp')
+
+
+@pytest.mark.parametrize('qs, granularity, expected', [
+    ('', 'year', dict(tags=dict(a=2, b=2, c=2),
+                      media=dict(photo=1, audio=1, video=1),
+                      dates={'2010': 1, '2015': 1, '2016': 1})),
+    ('a', 'month', dict(tags=dict(a=2, b=1, c=1),
+                        media=dict(photo=1, audio=1),
+                        dates={'2015-06': 1, '2016-01': 1})),
+    ('b not a', 'day', dict(tags=dict(b=1, c=1),
+                            media=dict(video=1),
+                            dates={'2010-03-09': 1})),
+    ('x', 'hour', dict(tags={}, media={}, dates={})),
+])
+def test_facets(sess, qs, granularity, expected):
+    assert query.facets(sess, [qs], granularity) == expected
+
+
+def test_tag_counts_follow_tag_writes(sess):
+    def counts():
+        return query.facets(sess, [''])['tags']
+    asset = sess.query(Asset).get(PHOTO_ID)
+    asset.tags.discard('a')
+    sess.flush()
+    assert counts() == dict(a=1, b=2, c=2)
+    asset._tags.add(sess.query(Tag).filter_by(name='c').one())
+    sess.flush()
+    assert counts() == dict(a=1, b=2, c=3)
+    sess.delete(asset)
+    sess.flush()
+    assert counts() == dict(a=1, b=1, c=2)
+
+
+@pytest.mark.parametrize('qs, order, expected', [
+    ('', 'stamp', [('video', 'bc'), ('photo', 'ab'), ('audio', 'ac')]),
+    ('a', 'stamp-', [('audio', 'ac'), ('photo', 'ab')]),
+    ('x', None, []),
+])
+def test_rows(sess, qs, order, expected):
+    rows = sess.execute(query.rows(sess, [qs], order=order)).all()
+    assert [(r.slug, ''.join(sorted(r.tags.split(query.TAG_SEPARATOR))))
+            for r in rows] == expected
+
+
+def test_records_hashes_with_random_order(sess):
+    for _ in range(10):
+        records = query.records(sess, [''], order='rand', limit=1, hashes=True)
+        assert [h.nibbles for h in records[0].hashes] == [records[0].slug]
+
+
+@pytest.mark.parametrize('qs, order, limit', [
+    ('', 'stamp', None),
+    ('a', 'stamp-', None),
+    ('b or c', 'stamp', 1),
+    ('x', None, None),
+])
+def test_records(sess, qs, order, limit):
+    records = query.records(sess, [qs], order=order, limit=limit, hashes=True)
+    assets = query.assets(sess, [qs], order=order, limit=limit, load='detail').all()
+    assert [r.slug for r in records] == [a.slug for a in assets]
+    for record, asset in zip(records, assets):
+        assert not hasattr(record, '__dict__')
+        assert record.tags == asset.tags
+        assert record.is_photo == asset.is_photo
+        assert record.path_for_export('x', 'y', 'z') == asset.path_for_export('x', 'y', 'z')
+        expected, actual = asset.to_dict(), record.to_dict()
+        for item in (expected, actual):
+            item['tags'] = sorted(item['tags'])
+        assert actual == expected
@@ -0,0 +1,226 @@
+from util import *
+
+import json
+import sqlalchemy
+
+from illuminatus import serve, snapshot
+
+
+@pytest.fixture
+def client(sess, monkeypatch):
+    monkeypatch.setattr(serve.sql, 'session', sess)
+    # Keep the server's commits inside the test's transaction.
+    monkeypatch.setattr(sess, 'commit', sess.flush)
+    monkeypatch.setitem(serve.app.config, 'formats', {})
+    serve.app.config['TESTING'] = True
+    return serve.app.test_client()
+
+
+def _counts(sess):
+    return {sess.query(Tag).get(id).name: n
+            for id, n in serve._tag_counts(sess).items()}
+
+
+def test_tag_counts(sess):
+    assert _counts(sess) == dict(a=2, b=2, c=2)
+
+
+def test_tag_counts_without_counts_table(sess):
+    sess.execute(sqlalchemy.text('DROP TABLE tag_counts'))
+    assert _counts(sess) == dict(a=2, b=2, c=2)
+
+
+@pytest.mark.parametrize('by, status', [
+    ('month', 200),
+    ('year', 200),
+    ('week', 400),
+])
+def test_facets_granularity(client, by, status):
+    assert client.get(f'/facets/?by={by}').status_code == status
+
+
+@pytest.mark.parametrize('size', ['0', '-5'])
+def test_preview_rejects_bad_sizes(client, size):
+    assert client.get(f'/asset/photo/preview/?s={size}').status_code == 400
+
+
+@pytest.mark.parametrize('filters', [
+    '{"filter": "hflip"}',
+    '[{"filter": "nope"}]',
+    '[{"filter": "rotate"}]',
+    '[{"filter": "rotate", "degrees": "x"}]',
+])
+def test_add_filters_rejects_bad_stacks(client, filters):
+    response = client.post('/asset/photo/filters/', data=dict(filters=filters))
+    assert response.status_code == 400
+
+
+def test_add_filters_renders_once(client, sess, monkeypatch):
+    changes = []
+    monkeypatch.setattr(serve, '_filters_changed',
+                        lambda asset, previous: changes.append(previous))
+    stack = [dict(filter='hflip'), dict(filter='contrast', percent='120')]
+    response = client.post('/asset/photo/filters/', data=dict(filters=json.dumps(stack)))
+    assert response.status_code == 200
+    assert changes == [None]
+    assert json.loads(sess.query(Asset).get(PHOTO_ID).filters) == [
+        dict(filter='hflip'), dict(filter='contrast', percent=120.0)]
+
+
+def test_row_versions_match_assets(client, sess, monkeypatch):
+    formats = dict(photo=dict(thumb=dict(bbox=[100, 100])))
+    monkeypatch.setitem(serve.app.config, 'formats', formats)
+    sess.query(Asset).get(PHOTO_ID).add_filter(dict(filter='hflip'))
+    sess.flush()
+    items = json.loads(client.get('/query/b/').data)
+    assert items
+    for item in items:
+        asset = sess.query(Asset).get(item['id'])
+        assert item['version'] == asset.version(formats)
+        assert json.loads(client.get(f'/asset/{asset.slug}/').data)['version'] == item['version']
+
+
+def test_delete_removes_proxy(client, sess, tmpdir, monkeypatch):
+    monkeypatch.setitem(serve.app.config, 'thumbnails', str(tmpdir))
+    monkeypatch.setitem(serve.app.config, 'formats', dict(video={}))
+    video = sess.query(Asset).get(VIDEO_ID)
+    proxy = video.proxy_path(str(tmpdir))
+    os.makedirs(os.path.dirname(proxy))
+    open(proxy, 'w').close()
+    assert client.delete('/asset/video/').status_code == 200
+    assert not os.path.exists(proxy)
+    assert sess.query(Asset).get(VIDEO_ID) is None
+
+
+@pytest.mark.parametrize('range_, status, body, content_range', [
+    (None, 200, b'0123456789', None),
+    ('bytes=2-4', 206, b'234', 'bytes 2-4/10'),
+    ('bytes=20-', 416, b'', 'bytes */10'),
+])
+def test_read_packed_ranges(client, sess, tmpdir, monkeypatch, range_, status, body,
+                            content_range):
+    formats = dict(photo=dict(thumb=dict(bbox=[10, 10])))
+    monkeypatch.setitem(serve.app.config, 'thumbnails', str(tmpdir))
+    monkeypatch.setitem(serve.app.config, 'formats', formats)
+    path = sess.query(Asset).get(PHOTO_ID).path_for_render(str(tmpdir), formats['photo']['thumb'])
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as handle:
+        handle.write(b'0123456789')
+    os.makedirs(str(tmpdir.join('.pack')))
+    illuminatus.pack.store(str(tmpdir)).add([path])
+    response = client.get('/asset/photo/read/thumb/',
+                          headers={'Range': range_} if range_ else {})
+    assert response.status_code == status
+    assert response.data == body
+    assert response.headers.get('Content-Range') == content_range
+
+
+@pytest.mark.parametrize('query', ['near:1.2.3,4,5', '(a'])
+def test_bad_queries(client, query):
+    assert client.get(f'/query/{query}/').status_code == 400
+
+
+CONFIG = '''
+tags:
+  groups:
+    - group: letters
+      icon: 🔤
+      hue: 30
+      patterns: ['[ab]', 'c']
+    - group: cake
+      icon: 🎂
+      patterns: ['cake.*']
+'''
+
+
+@pytest.fixture
+def config(client, tmpdir, monkeypatch):
+    path = tmpdir.join('config.yaml')
+    path.write_text(CONFIG, 'utf-8')
+    monkeypatch.setitem(serve.app.config, 'config', str(path))
+    monkeypatch.setattr(serve, '_emoji', lambda: [])
+    monkeypatch.setattr(serve, '_CONFIG', dict(key=None, body=None))
+    return lambda: {t['name']: t for t in json.loads(client.get('/config/').data)['tags']}
+
+
+def test_config_annotates_tags(config):
+    tags = config()
+    assert {n: (t['group'], t['order'], t['count']) for n, t in tags.items()} == {
+        'a': ('letters', '001001', 2),
+        'b': ('letters', '001001', 2),
+        'c': ('letters', '001002', 2),
+    }
+    assert tags['a']['hue'] == 30 and 'editable' not in tags['a']
+
+
+def test_tag_groups(tmpdir):
+    path = tmpdir.join('config.yaml')
+    path.write_text(CONFIG, 'utf-8')
+    groups = serve._tag_groups(str(path), 0)
+    assert [g['group'] for g, _ in groups] == ['letters', 'cake', 'other']
+    matches = {}
+    for name in ('a', 'c', 'ab', 'cake', 'cakes', '[ab]', 'zebra'):
+        for group, patterns in groups:
+            p = serve._match_pattern(patterns, name)
+            if p is not None:
+                matches[name] = (group['group'], p)
+                break
+    assert matches == {
+        'a': ('letters', 0),
+        'c': ('letters', 1),
+        'ab': ('other', 0),
+        'cake': ('cake', 0),
+        'cakes': ('cake', 0),
+        '[ab]': ('letters', 0),
+        'zebra': ('other', 0),
+    }
+
+
+@pytest.mark.parametrize('patterns, name, expected', [
+    ([r'(a)\1', 'b'], 'aa', 0),
+    (['b', r'(a)\1'], 'aa', 1),
+    (['(?P<p0>x)', 'y'], 'x', 0),
+    (['(?P<p0>x)', 'y'], 'y', 1),
+    (['(unbalanced', 'z'], '(unbalanced', 0),
+    (['(unbalanced', 'z'], 'z', 1),
+    (['(unbalanced', 'z'], 'q', None),
+])
+def test_tag_patterns_compile_separately(tmpdir, patterns, name, expected):
+    path = tmpdir.join('config.yaml')
+    path.write_text(json.dumps(
+        dict(tags=dict(groups=[dict(group='g', icon='g', patterns=patterns)]))),
+        'utf-8')
+    (_, compiled), _ = serve._tag_groups(str(path), 0)
+    assert serve._match_pattern(compiled, name) == expected
+
+
+def test_config_rebuilt_after_tag_rename(config, sess, monkeypatch):
+    counted = []
+    tag_counts = serve._tag_counts
+    monkeypatch.setattr(serve, '_tag_counts', lambda s: counted.append(1) or tag_counts(s))
+    assert 'c' in config()
+    assert 'c' in config()
+    assert len(counted) == 1
+    sess.query(Tag).filter_by(name='c').one().name = 'cake'
+    sess.flush()
+    tags = config()
+    assert len(counted) == 2
+    assert 'c' not in tags
+    assert (tags['cake']['group'], tags['cake']['count']) == ('cake', 2)
+
+
+@pytest.mark.parametrize('zoom, status', [(0, 200), (30, 200), (31, 400), (64, 400)])
+def test_tiles_zoom(client, zoom, status):
+    assert client.get(f'/tiles/{zoom}/').status_code == status
+
+
+def test_get_asset_ignores_stale_snapshot(client, sess, tmp_path, monkeypatch):
+    path = str(tmp_path / 'test.db.snapshot')
+    monkeypatch.setitem(serve.app.config, 'snapshot', path)
+    snapshot.rebuild(sess, path)
+    assert serve._get_asset('phot').id == PHOTO_ID
+    sess.add(Asset(slug='photo2', path='/photo2.jpg', medium='photo'))
+    sess.flush()
+    with pytest.raises(sqlalchemy.orm.exc.MultipleResultsFound):
+        serve._get_asset('phot')
+    assert serve._get_asset('photo2').slug == 'photo2'
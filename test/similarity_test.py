@@ -0,0 +1,167 @@
+import numpy as np
+import sqlalchemy
+
+from util import *
+
+from illuminatus import similarity
+
+
+def _brute_force(pairs, seed, min_sim, limit):
+    tags = {}
+    for a, t in pairs:
+        tags.setdefault(a, set()).add(t)
+    df = {}
+    for ts in tags.values():
+        for t in ts:
+            df[t] = df.get(t, 0) + 1
+    scores = []
+    for a, ts in tags.items():
+        if a != seed and ts & tags[seed]:
+            sim = (sum(1 / df[t] for t in ts & tags[seed]) /
+                   sum(1 / df[t] for t in ts | tags[seed]))
+            if sim >= min_sim:
+                scores.append((a, sim))
+    return sorted(scores, key=lambda x: -x[1])[:limit]
+
+
+@pytest.fixture
+def pairs():
+    rng = np.random.RandomState(23)
+    pairs = {(a, t) for a in range(1, 200) for t in rng.randint(1, 40, size=6)}
+    return sorted(pairs)
+
+
+@pytest.mark.parametrize('seed', [1, 7, 100, 199])
+@pytest.mark.parametrize('min_sim', [0, 0.1, 0.3])
+def test_similar(pairs, seed, min_sim):
+    index = similarity.TagIndex(*np.array(pairs).T)
+    expected = _brute_force(pairs, seed, min_sim, 10)
+    actual = index.similar(seed, min_sim, 10)
+    assert [a for a, _ in actual] == [a for a, _ in expected]
+    assert np.allclose([s for _, s in actual], [s for _, s in expected])
+
+
+def test_similar_candidates(pairs):
+    index = similarity.TagIndex(*np.array(pairs).T)
+    everything = dict(index.similar(3, 0, 1000))
+    some = index.similar(3, 0, 1000, candidates=[3, 5, 8, 13, 999])
+    assert [a for a, _ in some] == sorted(
+        {5, 8, 13} & set(everything), key=lambda a: -everything[a])
+    assert np.allclose([s for _, s in some], [everything[a] for a, _ in some])
+
+
+def test_update(pairs):
+    index = similarity.TagIndex(*np.array(pairs).T)
+    index.update(7, [t for a, t in pairs if a == 8])
+    index.update(9, [])
+    index.update(500, [1, 2, 3])
+    updated = [(a, t) for a, t in pairs if a not in (7, 9)]
+    updated += [(7, t) for a, t in pairs if a == 8] + [(500, 1), (500, 2), (500, 3)]
+    for seed in (7, 8, 500):
+        actual = index.similar(seed, 0, 10)
+        expected = _brute_force(updated, seed, 0, 10)
+        assert np.allclose([s for _, s in actual], [s for _, s in expected])
+    assert index.similar(7, 0.99, 10)[0] == (8, 1.0)
+    assert index.similar(9) == []
+
+
+def test_update_matches_rebuild(pairs):
+    index = similarity.TagIndex(*np.array(pairs).T)
+    updates = {7: [t for a, t in pairs if a == 8], 9: [], 500: [1, 2, 77],
+               1: [39, 39], 0: [5]}
+    for a, tags in updates.items():
+        index.update(a, tags)
+    updated = [(a, t) for a, t in pairs if a not in updates]
+    updated += [(a, t) for a, tags in updates.items() for t in set(tags)]
+    expected = similarity.TagIndex(*np.array(updated).T).to_arrays()
+    for name, arr in index.to_arrays().items():
+        np.testing.assert_array_equal(arr, expected[name], err_msg=name)
+
+
+def test_similar_many(pairs):
+    index = similarity.TagIndex(*np.array(pairs).T)
+    index.update(11, [])
+    seeds = [1, 7, 11, 100, 199, 1000, 7]
+    many = index.similar_many(seeds, 0.1, 5)
+    assert sorted(many) == sorted(set(seeds))
+    for seed in seeds:
+        assert many[seed] == index.similar(seed, 0.1, 5)
+
+
+def test_bucket_recall(pairs):
+    assets, buckets = similarity.buckets(*np.array(pairs).T)
+    found = total = 0
+    for i, seed in enumerate(assets):
+        shared = set(assets[(buckets == buckets[i]).any(axis=1)])
+        expected = _brute_force(pairs, seed, 0.5, len(assets))
+        found += sum(a in shared for a, _ in expected)
+        total += len(expected)
+    assert total and found >= 0.95 * total
+
+
+def test_similar_by_tag(sess):
+    similarity.reset()
+    photo = sess.query(Asset).get(PHOTO_ID)
+    similar = photo.similar_by_tag(sess, min_sim=0.3, exhaustive=True)
+    assert set(a.slug for a in similar) == {'audio', 'video'}
+    assert photo.similar_by_tag(sess, min_sim=0.5, exhaustive=True) == []
+    similarity.reset()
+
+
+def test_buckets(pairs):
+    assets, buckets = similarity.buckets(*np.array(pairs).T)
+    assert buckets.shape == (len(assets), similarity.BANDS)
+    # Assets 1 and 2 get identical tags, so they share every bucket.
+    pairs = [(a, t) for a, t in pairs if a != 2] + [(2, t) for a, t in pairs if a == 1]
+    assets, buckets = similarity.buckets(*np.array(pairs).T)
+    assert (buckets[0] == buckets[1]).all()
+    assert not (buckets[0] == buckets[2]).all()
+
+
+def _lsh_rows(sess):
+    return sorted(sess.execute(similarity.tag_lsh.select()).fetchall())
+
+
+def test_candidates(sess):
+    video = sess.query(Asset).get(VIDEO_ID)
+    video.tags = set(sess.query(Asset).get(PHOTO_ID).tags)
+    sess.flush()
+    assert PHOTO_ID in similarity.candidates(sess, VIDEO_ID)
+    assert VIDEO_ID not in similarity.candidates(sess, VIDEO_ID)
+    assert [a.id for a in video.similar_by_tag(sess, min_sim=0.9)] == [PHOTO_ID]
+    similarity.reset()
+
+
+def test_deleted_tags_fall_back_to_exhaustive(sess):
+    video = sess.query(Asset).get(VIDEO_ID)
+    video.tags = set(sess.query(Asset).get(PHOTO_ID).tags)
+    sess.flush()
+    assert similarity.candidates(sess, VIDEO_ID) is not None
+    # Deleting a tag in SQL cascades to asset_tags, bypassing the session.
+    sess.execute(sqlalchemy.text("DELETE FROM tags WHERE name = 'c'"))
+    assert similarity.candidates(sess, AUDIO_ID) is None
+    sess.execute(sqlalchemy.text('DELETE FROM tag_lsh WHERE asset_id = :id'),
+                 dict(id=VIDEO_ID))
+    assert similarity.candidates(sess, VIDEO_ID) is None
+    assert [a.id for a in video.similar_by_tag(sess, min_sim=0.9)] == [PHOTO_ID]
+    similarity.reset()
+
+
+def test_upgrade_creates_missing_structures(sess):
+    conn = sess.connection()
+    written = _lsh_rows(sess)
+    conn.execute(sqlalchemy.text('DROP TABLE tag_lsh'))
+    illuminatus.db.upgrade(conn)
+    assert _lsh_rows(sess) == written
+    assert illuminatus.db.write_generation(conn) is not None
+
+
+def test_rebuild_buckets(sess):
+    sess.query(Asset).get(AUDIO_ID).tags.add('zebra')
+    sess.flush()
+    sess.delete(sess.query(Asset).get(VIDEO_ID))
+    sess.flush()
+    written = _lsh_rows(sess)
+    assert len(written) == 2 * similarity.BANDS
+    similarity.rebuild_buckets(sess.connection(), chunk_size=1)
+    assert _lsh_rows(sess) == written
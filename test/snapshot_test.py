@@ -0,0 +1,78 @@
+import numpy as np
+import os
+
+from util import *
+
+from illuminatus import db, similarity, snapshot
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'test.db.snapshot')
+
+
+def test_write_generation(sess):
+    before = db.write_generation(sess)
+    sess.query(Asset).get(PHOTO_ID).caption = 'hello'
+    sess.flush()
+    assert db.write_generation(sess) == before + 1
+    sess.query(Asset).get(PHOTO_ID).tags.add('zebra')
+    sess.flush()
+    assert db.write_generation(sess) > before + 1
+
+
+def test_roundtrip(sess, path):
+    generation = snapshot.rebuild(sess, path)
+    snap = snapshot.Snapshot(path)
+    assert snap.generation == generation == db.write_generation(sess)
+    for name, arr in similarity.TagIndex.from_db(sess).to_arrays().items():
+        np.testing.assert_array_equal(snap.arrays[f'tags.{name}'], arr)
+        assert not snap.arrays[f'tags.{name}'].flags.writeable
+
+
+def test_lookups(sess, path):
+    sess.add(Hash(asset=sess.query(Asset).get(VIDEO_ID), nibbles='0f', method='dhash-8'))
+    sess.flush()
+    snapshot.rebuild(sess, path)
+    snap = snapshot.Snapshot(path)
+    assert snap.slug_ids('ph') == [PHOTO_ID]
+    assert sorted(snap.slug_ids('')) == [PHOTO_ID, AUDIO_ID, VIDEO_ID]
+    assert snap.slug_ids('x') == []
+    assert snap.hash_asset_ids('dhash-8', '0f') == {VIDEO_ID}
+    assert snap.hash_asset_ids('dhash-8', '0e') == set()
+    assert snap.hash_asset_ids('dhash-8', '0e', 2) == {VIDEO_ID}
+    assert snap.hash_asset_ids('dhash-0', '0f', 2) == set()
+    index = snap.tag_index()
+    expected = similarity.TagIndex.from_db(sess).similar(PHOTO_ID, 0)
+    assert index.similar(PHOTO_ID, 0) == expected
+    # Updates go to private copies of the mapped arrays.
+    index.update(PHOTO_ID, [])
+    assert index.similar(PHOTO_ID, 0) == []
+
+
+def test_load_remaps_replaced_file(sess, path):
+    assert snapshot.load(path) is None
+    snapshot.rebuild(sess, path)
+    first = snapshot.load(path)
+    assert snapshot.load(path) is first
+    slugs = first.arrays['slugs']
+    sess.add(Asset(slug='zzz', path='/zzz.jpg', medium='photo'))
+    sess.flush()
+    snapshot.rebuild(sess, path)
+    second = snapshot.load(path)
+    assert second is not first
+    assert second.generation > first.generation
+    assert len(second.arrays['slugs']) == len(slugs) + 1
+    assert len(slugs) == 3
+
+
+@pytest.mark.parametrize('generation, current, age, expected', [
+    (3, 3, 1000, False),
+    (4, 3, 0, True),
+    (0, -1, 0, True),
+    (None, None, 10, False),
+    (None, None, 300, True),
+    (None, -1, 10, False),
+])
+def test_stale(generation, current, age, expected):
+    assert snapshot._stale(generation, current, age, 300) == expected
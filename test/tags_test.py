@@ -1,3 +1,5 @@
+import re
+
 from util import *
 
 
@@ -12,3 +14,25 @@ def test_add_remove_tags(sess):
     assert 'hello' not in asset.tags
     asset.tags.discard('hello')
     assert 'hello' not in asset.tags
+
+
+@pytest.mark.parametrize('name, pattern', [
+    ('2013', 0), ('1999', 0), ('2013abc', 0), ('january', 1), ('may', 5),
+    ('december', 12), ('1st', 13), ('23rd', 14), ('sunday', 15),
+    ('12am', 22), ('3am', 23), ('11pm', 27), ('kit-nikon-d7000', 28),
+    ('ƒ-2', 29), ('8mm', 32), ('1000mm', 35),
+    ('hello', Tag.USER), ('', Tag.USER), ('3000', Tag.USER), ('mayday', 5),
+])
+def test_classify(name, pattern):
+    assert Tag.classify(name) == pattern
+    # Same as matching each pattern in turn.
+    assert pattern == next(
+        i for i, p in enumerate(Tag.PATTERNS) if re.match(p, name))
+
+
+def test_groups():
+    assert Tag(name='2013').is_date
+    assert Tag(name='4pm').is_time
+    assert Tag(name='kit-nikon').is_metadata
+    assert Tag(name='hello').is_user
+    assert not Tag(name='hello').is_date
@@ -0,0 +1,18 @@
+from util import *
+
+from illuminatus import usage
+
+
+def test_record(tmpdir):
+    reads = usage.Usage(str(tmpdir))
+    reads.record('aa', now=1000)
+    reads.record('bb', now=1000)
+    reads.record('aa', now=1000 + usage.RESOLUTION / 2)
+    assert reads.times() == dict(aa=1000, bb=1000)
+    reads.record('aa', now=1000 + usage.RESOLUTION)
+    assert reads.times() == dict(aa=1000 + usage.RESOLUTION, bb=1000)
+
+
+def test_times_are_shared(tmpdir):
+    usage.Usage(str(tmpdir)).record('aa', now=1000)
+    assert usage.Usage(str(tmpdir)).times() == dict(aa=1000)
@@ -21,6 +21,8 @@ RECORDS = [
     {'path': PHOTO_PATH,
      'medium': 'photo',
      'stamp': '2015-06-02T09:07',
+     'lat': 40.7128,
+     'lng': -74.006,
      'tags': set('ab')},
     {'path': AUDIO_PATH,
      'medium': 'audio',
@@ -31,6 +33,9 @@ RECORDS = [
      'medium': 'video',
      'stamp': '2010-03-09T05:03',
      'duration': 5.334,
+     'caption': 'Birthday cake!',
+     'lat': 40.7306,
+     'lng': -73.9866,
      'tags': set('bc')},
 ]
 